@@ -0,0 +1,329 @@
+"""
+Analysis of stored frames in bulk, e.g. again after the ROIs or the parameters changed.
+
+Frames are listed from a frame store or a directory of pictures, then decoded and analyzed by a pool of
+processes in chunks, each worker reading its frames straight from the files. Every finished chunk is appended
+to a journal next to the output, so an interrupted run resumes where it stopped; the journal becomes
+a table with one row per frame and ROI once every frame is analyzed.
+"""
+import csv
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+
+from analysis.solubility import AnalysisResult, SolubilityAnalyzer
+from imaging.pipeline import decode_image
+from storage.frame_store import FrameStore
+
+PICTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+WHOLE_FILE = -1
+NO_CAMERA = -1
+
+RECORD = struct.Struct('>I')
+"""Codec of the length of each pickled record of a journal."""
+
+
+class FrameTask(NamedTuple):
+    key: str
+    """The frame number in a store, or the path relative to a directory of pictures."""
+    path: str
+    offset: int
+    length: int
+    """The bytes of the frame from {offset}, or WHOLE_FILE."""
+    timestamp: float
+    device_id: str
+    cam_id: int
+
+
+class ChunkResult(NamedTuple):
+    keys: List[str]
+    """The frames of the chunk, analyzed or failed."""
+    rows: List[Tuple]
+    failures: List[Tuple[str, str]]
+    """The key and the error of each frame which couldn't be analyzed."""
+    bytes: int
+
+
+def list_frames(source: str) -> List[FrameTask]:
+    """
+    :param source: A frame store, or a directory of pictures which is walked recursively.
+    :return: The frames, in the order of the store or of their paths.
+    """
+    if os.path.exists(os.path.join(source, FrameStore.INDEX_FILE)):
+        store = FrameStore(source, read_only=True)
+        try:
+            return [FrameTask(str(number), store.segment_path(record.segment), record.offset, record.length,
+                              record.timestamp, record.device_id or '',
+                              record.cam_id if record.cam_id is not None else NO_CAMERA)
+                    for number, record in enumerate(store.records)]
+        finally:
+            store.close()
+
+    tasks = []
+    for directory, directories, files in os.walk(source):
+        directories.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in PICTURE_EXTENSIONS:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, source).replace(os.sep, '/')
+                tasks.append(FrameTask(key, path, 0, WHOLE_FILE, os.path.getmtime(path), '', NO_CAMERA))
+    return tasks
+
+
+def columns(analyzer: SolubilityAnalyzer) -> List[str]:
+    """
+    :return: The columns of the table the results of {analyzer} make.
+    """
+    percentiles = [f'p{value * 100:g}' for value in analyzer.percentiles]
+    return (['frame', 'timestamp', 'device', 'camera', 'roi', 'mean_r', 'mean_g', 'mean_b'] + percentiles
+            + ['transmittance', 'turbidity', 'pattern_correlation', 'scatter', 'elapsed'])
+
+
+def rows(task: FrameTask, result: AnalysisResult) -> Iterator[Tuple]:
+    """
+    :return: The row of every ROI of {result}, in the order of columns(). Missing metrics are NaN.
+    """
+    for roi in result.rois:
+        metrics = (roi.transmittance, roi.turbidity, roi.pattern_correlation, roi.scatter)
+        yield ((task.key, task.timestamp, task.device_id, task.cam_id, roi.name) + tuple(roi.mean)
+               + roi.percentiles + tuple(v if v is not None else np.nan for v in metrics) + (result.elapsed,))
+
+
+# the analyzer and the mapped segments of each worker process
+_worker_analyzer: Optional[SolubilityAnalyzer] = None
+_worker_maps: Dict[str, mmap.mmap] = {}
+
+
+def _init_worker(state: bytes) -> None:
+    global _worker_analyzer
+    # each process takes one core, so OpenCV mustn't spread a frame over the others
+    cv2.setNumThreads(1)
+    _worker_analyzer = pickle.loads(state)
+
+
+def _read(task: FrameTask) -> memoryview:
+    if task.length == WHOLE_FILE:
+        with open(task.path, 'rb') as file:
+            return memoryview(file.read())
+    end = task.offset + task.length
+    mapped = _worker_maps.get(task.path)
+    if mapped is None or len(mapped) < end:
+        with open(task.path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        _worker_maps[task.path] = mapped
+    return memoryview(mapped)[task.offset:end]
+
+
+def _analyze_chunk(tasks: List[FrameTask]) -> ChunkResult:
+    result = ChunkResult([], [], [], 0)
+    size = 0
+    for task in tasks:
+        result.keys.append(task.key)
+        try:
+            data = _read(task)
+            size += len(data)
+            image = decode_image(data)
+            # the view must be released before the segment can be mapped again
+            data.release()
+            result.rows.extend(rows(task, _worker_analyzer.analyze(image)))
+        except (OSError, ValueError, cv2.error) as e:
+            result.failures.append((task.key, str(e)))
+    return result._replace(bytes=size)
+
+
+class Journal:
+    """
+    The chunks analyzed so far by a run, appended as pickled records after a header
+    which describes the run. A torn tail left by an interruption is cut off when it is opened again.
+    """
+    def __init__(self, path: str, header: Dict[str, Any]):
+        """
+        Resume the journal at {path}, or start it.
+        :param header: What the results depend on, e.g. the source and the analyzer.
+        :raise ValueError: if the journal at {path} belongs to a run with another header.
+        """
+        self.path = path
+        self.keys: Set[str] = set()
+        self.rows: List[Tuple] = []
+        self.failures: List[Tuple[str, str]] = []
+        end = 0
+        if os.path.exists(path):
+            records = self.read()
+            found = next(records, None)
+            if found is not None and found[1] != header:
+                raise ValueError(f'{path} was written by another run, delete it to start over.')
+            end = found[0] if found is not None else 0
+            for end, chunk in records:
+                self.add(chunk)
+
+        self.file: BinaryIO = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.file.truncate(end)
+        self.file.seek(end)
+        if end == 0:
+            self.write(header)
+
+    def read(self) -> Iterator[Tuple[int, Any]]:
+        """
+        :return: The end offset and the content of every complete record.
+        """
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + length
+            if end > len(data):
+                break
+            try:
+                record = pickle.loads(data[offset + RECORD.size:end])
+            except (pickle.UnpicklingError, EOFError):
+                break
+            offset = end
+            yield offset, record
+
+    def add(self, chunk: ChunkResult) -> None:
+        self.keys.update(chunk.keys)
+        self.rows.extend(chunk.rows)
+        self.failures.extend(chunk.failures)
+
+    def append(self, chunk: ChunkResult) -> None:
+        self.add(chunk)
+        self.write(chunk)
+
+    def write(self, record: Any) -> None:
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(RECORD.pack(len(data)) + data)
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def check_table_format(path: str) -> None:
+    """
+    :raise ValueError: if write_table can't write to {path}, e.g. to check before analyzing anything.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ('.csv', '.npz', '.parquet'):
+        raise ValueError(f'Unknown table format {extension}, use .csv, .npz or .parquet.')
+    if extension == '.parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('Writing Parquet needs pyarrow, use .csv or .npz otherwise.')
+
+
+def write_table(path: str, names: List[str], table: List[Tuple]) -> None:
+    """
+    Write rows as a table, in the format of the extension of {path}: .csv, .npz or .parquet (needs pyarrow).
+    The file is replaced at once, so that a reader never sees it half written.
+    :raise ValueError: if the format isn't supported.
+    """
+    check_table_format(path)
+    extension = os.path.splitext(path)[1].lower()
+    temporary = path + '.tmp'
+    if extension == '.csv':
+        with open(temporary, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(names)
+            writer.writerows(tuple('' if isinstance(v, float) and np.isnan(v) else v for v in row) for row in table)
+    elif extension in ('.npz', '.parquet'):
+        values = list(zip(*table)) if len(table) > 0 else [()] * len(names)
+        arrays = {}
+        for name, column in zip(names, values):
+            dtype = np.str_ if name in ('frame', 'device', 'roi') else np.int64 if name == 'camera' else np.float64
+            arrays[name] = np.asarray(column, dtype=dtype)
+        if extension == '.npz':
+            with open(temporary, 'wb') as file:
+                np.savez_compressed(file, **arrays)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(pyarrow.table(arrays), temporary)
+    os.replace(temporary, path)
+
+
+class BatchAnalysis:
+    """
+    Analyzes frames on every core, in chunks of {chunk_size} frames.
+    At most two chunks per worker are in flight, so memory doesn't grow with the number of frames.
+    """
+    PROGRESS_INTERVAL = 2.0
+
+    def __init__(self,
+                 analyzer: SolubilityAnalyzer,
+                 workers: Optional[int] = None,
+                 chunk_size: int = 32):
+        """
+        :param analyzer: The analyzer to run.
+        :param workers: The number of processes, or None for one per CPU.
+        :param chunk_size: The frames each worker takes at once.
+        """
+        self.analyzer = analyzer
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def run(self, tasks: List[FrameTask], journal: Journal) -> bool:
+        """
+        Analyze the frames not in {journal} yet, appending each chunk to it. Progress is printed as it goes.
+        :return: True if every frame was analyzed, False if interrupted.
+        """
+        pending = [task for task in tasks if task.key not in journal.keys]
+        total, done, size = len(tasks), len(tasks) - len(pending), 0
+        if done > 0:
+            print(f'Reanalysis: resuming, {done} of {total} frames already analyzed')
+        chunks = iter([pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)])
+
+        state = pickle.dumps(self.analyzer, protocol=pickle.HIGHEST_PROTOCOL)
+        # spawned like the workers of AnalysisExecutor, so that they start the same everywhere
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(state,))
+        in_flight: Set[Future] = set()
+        started_at = reported_at = time.monotonic()
+        analyzed = 0
+        try:
+            while True:
+                while len(in_flight) < self.workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    in_flight.add(pool.submit(_analyze_chunk, chunk))
+                if len(in_flight) == 0:
+                    break
+                finished, in_flight = wait(in_flight, BatchAnalysis.PROGRESS_INTERVAL, FIRST_COMPLETED)
+                for future in finished:
+                    chunk = future.result()
+                    journal.append(chunk)
+                    for key, error in chunk.failures:
+                        print(f'Reanalysis: failed {key}, {error}')
+                    analyzed += len(chunk.keys)
+                    size += chunk.bytes
+
+                now = time.monotonic()
+                if now - reported_at >= BatchAnalysis.PROGRESS_INTERVAL:
+                    reported_at = now
+                    BatchAnalysis.report(done + analyzed, total, analyzed, size, now - started_at)
+        except KeyboardInterrupt:
+            for future in in_flight:
+                future.cancel()
+            print(f'Reanalysis: interrupted after {done + analyzed} of {total} frames, run again to resume')
+            return False
+        finally:
+            pool.shutdown(wait=True)
+        BatchAnalysis.report(done + analyzed, total, analyzed, size, time.monotonic() - started_at)
+        return True
+
+    @staticmethod
+    def report(done: int, total: int, analyzed: int, size: int, elapsed: float) -> None:
+        rate = analyzed / elapsed if elapsed > 0 else 0.0
+        remaining = (total - done) / rate if rate > 0 else 0.0
+        print(f'Reanalysis: {done}/{total} frames ({done / max(total, 1) * 100:.1f} %), {rate:.1f} frames/s, '
+              f'{size / 1024 / 1024 / max(elapsed, 1e-9):.1f} MiB/s, {remaining:.0f} s left')
@@ -0,0 +1,203 @@
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock, Semaphore
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from analysis.solubility import AnalysisResult, SolubilityAnalyzer
+
+# the analyzer each worker process last loaded, by generation
+_worker_generation = -1
+_worker_analyzer: Optional[SolubilityAnalyzer] = None
+
+
+def _analyze(state_name: str, state_size: int, generation: int,
+             frames: List[Tuple[str, Tuple[int, ...], str]]) -> List[AnalysisResult]:
+    """
+    Analyze frames in a worker process. Both the analyzer and the frames are read from shared memory;
+    the analyzer is unpickled only when its generation changed since the last call.
+    :param frames: The shared memory block, shape and dtype of each frame.
+    """
+    global _worker_generation, _worker_analyzer
+    if generation != _worker_generation:
+        state = SharedMemory(state_name)
+        try:
+            _worker_analyzer = pickle.loads(state.buf[:state_size])
+        finally:
+            state.close()
+        _worker_generation = generation
+
+    results = []
+    for frame_name, shape, dtype in frames:
+        block = SharedMemory(frame_name)
+        try:
+            image = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+            results.append(_worker_analyzer.analyze(image))
+            # the view must be released before the block can be closed
+            del image
+        finally:
+            block.close()
+    return results
+
+
+class AnalysisExecutor:
+    """
+    Runs a SolubilityAnalyzer on a pool of processes, off the threads receiving the frames.
+    Frames are copied once into shared memory blocks, which are reused, instead of being pickled.
+    At most {max_pending} submissions are in flight; what happens to one beyond that depends on the policy.
+    A frame group is one submission and is analyzed by one worker.
+    """
+    DROP = 0
+    """Drop what is submitted while the executor is full."""
+    QUEUE = 1
+    """Block the submitting thread until a frame finishes."""
+
+    def __init__(self,
+                 analyzer: SolubilityAnalyzer,
+                 on_result: Callable[[Hashable, AnalysisResult], None],
+                 workers: Optional[int] = None,
+                 max_pending: Optional[int] = None,
+                 policy: int = DROP):
+        """
+        :param analyzer: The analyzer to run. Call update() after changing it.
+        :param on_result: Receives the tag and the result of each submission, on a thread of the executor:
+            an AnalysisResult for a frame, and a list of them for a frame group.
+        :param workers: The number of processes, or None for one per CPU.
+        :param max_pending: The number of submissions in flight, or None for twice the number of processes.
+        :param policy: DROP or QUEUE.
+        """
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.max_pending = max_pending if max_pending is not None else self.workers * 2
+        self.policy = policy
+        self.on_result = on_result
+
+        # spawned workers don't inherit the threads of the host, which forking them would
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        self.slots = Semaphore(self.max_pending)
+        self.lock = Lock()
+        self.free_blocks: List[SharedMemory] = []
+        self.states: Dict[int, List] = {}
+        self.generation = -1
+        self.dropped = 0
+        self.closed = False
+
+        self.update(analyzer)
+
+    def update(self, analyzer: SolubilityAnalyzer) -> None:
+        """
+        Publish a new or changed analyzer to the workers. Frames already submitted keep the former one.
+        :return: None
+        """
+        data = pickle.dumps(analyzer, protocol=pickle.HIGHEST_PROTOCOL)
+        state = SharedMemory(create=True, size=max(len(data), 1))
+        state.buf[:len(data)] = data
+        with self.lock:
+            self.generation += 1
+            # the shared memory block, the number of frames using it, and the size of the pickle
+            self.states[self.generation] = [state, 0, len(data)]
+            self.release_states()
+
+    def submit(self, image: np.ndarray, tag: Hashable = None) -> Optional[Future]:
+        """
+        Queue a frame for analysis. This is safe to call from any thread.
+        :param image: The RGB frame. It is copied, so the caller may reuse it.
+        :param tag: Passed to on_result with the result, e.g. the camera of the frame.
+        :return: The future of the list holding the result, or None if the frame was dropped.
+        """
+        return self.submit_group([image], tag, single=True)
+
+    def submit_group(self,
+                     images: Sequence[np.ndarray],
+                     tag: Hashable = None,
+                     single: bool = False) -> Optional[Future]:
+        """
+        Queue frames captured together for analysis as one unit. This is safe to call from any thread.
+        :param images: The RGB frames. They are copied, so the caller may reuse them.
+        :param tag: Passed to on_result with the results, e.g. the frame group.
+        :param single: Whether on_result gets the only result rather than the list.
+        :return: The future of the list of results, or None if the frames were dropped.
+        """
+        if self.closed:
+            return None
+        if not self.slots.acquire(blocking=self.policy == AnalysisExecutor.QUEUE):
+            self.dropped += 1
+            print(f'Analysis: dropped a submission, {self.dropped} so far')
+            return None
+
+        with self.lock:
+            blocks = [self.take_block(image.nbytes) for image in images]
+            generation = self.generation
+            state = self.states[generation]
+            state[1] += 1
+        try:
+            for image, block in zip(images, blocks):
+                np.ndarray(image.shape, image.dtype, buffer=block.buf)[...] = image
+            frames = [(block.name, image.shape, image.dtype.str) for image, block in zip(images, blocks)]
+            future = self.pool.submit(_analyze, state[0].name, state[2], generation, frames)
+        except BaseException:
+            with self.lock:
+                self.free_blocks.extend(blocks)
+                state[1] -= 1
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.on_done(f, tag, blocks, generation, single))
+        return future
+
+    def on_done(self, future: Future, tag: Hashable, blocks: List[SharedMemory], generation: int, single: bool) -> None:
+        with self.lock:
+            self.free_blocks.extend(blocks)
+            self.states[generation][1] -= 1
+            self.release_states()
+        self.slots.release()
+
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            print(f'Analysis: failed, {error}')
+            return
+        results = future.result()
+        self.on_result(tag, results[0] if single else results)
+
+    def take_block(self, size: int) -> SharedMemory:
+        """
+        :return: A free shared memory block of at least {size} bytes. Must be called with the lock held.
+        """
+        for index, block in enumerate(self.free_blocks):
+            if block.size >= size:
+                return self.free_blocks.pop(index)
+        # no free block fits: replace one of them so that the blocks don't pile up
+        if len(self.free_blocks) > 0:
+            AnalysisExecutor.unlink(self.free_blocks.pop(0))
+        return SharedMemory(create=True, size=size)
+
+    def release_states(self) -> None:
+        """
+        Unlink the former analyzers no frame uses anymore. Must be called with the lock held.
+        """
+        for generation in [g for g, (_, users, _) in self.states.items() if users == 0 and g != self.generation]:
+            AnalysisExecutor.unlink(self.states.pop(generation)[0])
+
+    def shutdown(self) -> None:
+        """
+        Wait for the frames in flight, stop the workers and free the shared memory.
+        :return: None
+        """
+        self.closed = True
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            for block in self.free_blocks:
+                AnalysisExecutor.unlink(block)
+            self.free_blocks.clear()
+            for state in self.states.values():
+                AnalysisExecutor.unlink(state[0])
+            self.states.clear()
+
+    @staticmethod
+    def unlink(block: SharedMemory) -> None:
+        block.close()
+        block.unlink()
@@ -0,0 +1,378 @@
+"""
+Dissolution curves of each vial, updated one analyzed frame at a time.
+
+Every estimator keeps running sums instead of the samples, so a frame costs O(1) however long the run is:
+    OnlineLinearFit     least squares of y against x, optionally forgetting old samples
+    RollingStats        mean, deviation and slope over the last {window} samples
+    ChangeDetector      two-sided CUSUM on the increments, flagging where the rate of change shifts
+    KineticsCurve       all of the above for one signal, plus an exponential-approach fit
+                            y(t) = plateau - (plateau - initial) * exp(-rate * t)
+                        from the regression of dy/dt on y, whose slope is -rate and intercept rate * plateau
+"""
+import math
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Deque, Dict, NamedTuple, Optional, Tuple
+
+from analysis.solubility import AnalysisResult, RoiResult
+
+
+class OnlineLinearFit:
+    """
+    Least squares fit of y = intercept + slope * x from running sums.
+    """
+    def __init__(self, forgetting: float = 1.0):
+        """
+        :param forgetting: The weight kept by the former samples at each update, 1 to keep them all.
+        """
+        self.forgetting = forgetting
+        self.n = self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+
+    def update(self, x: float, y: float) -> None:
+        f = self.forgetting
+        self.n = f * self.n + 1
+        self.sx = f * self.sx + x
+        self.sy = f * self.sy + y
+        self.sxx = f * self.sxx + x * x
+        self.sxy = f * self.sxy + x * y
+        self.syy = f * self.syy + y * y
+
+    @property
+    def slope(self) -> Optional[float]:
+        """None until there are two distinct x values."""
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 1e-12 * max(self.n * self.sxx, 1e-300):
+            return None
+        return (self.n * self.sxy - self.sx * self.sy) / denominator
+
+    @property
+    def intercept(self) -> Optional[float]:
+        slope = self.slope
+        return (self.sy - slope * self.sx) / self.n if slope is not None else None
+
+    @property
+    def r_squared(self) -> Optional[float]:
+        slope = self.slope
+        variance = self.n * self.syy - self.sy * self.sy
+        if slope is None or variance <= 0:
+            return None
+        return min(1.0, slope * (self.n * self.sxy - self.sx * self.sy) / variance)
+
+
+class RollingStats:
+    """
+    Mean, standard deviation and slope over the last {window} samples.
+    The sums are updated as samples enter and leave the window, never recomputed.
+    """
+    def __init__(self, window: int):
+        self.window = window
+        self.samples: Deque[Tuple[float, float]] = deque(maxlen=window)
+        self.st = self.sy = self.stt = self.sty = self.syy = 0.0
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def full(self) -> bool:
+        return len(self.samples) == self.window
+
+    def update(self, t: float, y: float) -> None:
+        if self.full:
+            old_t, old_y = self.samples[0]
+            self.add(old_t, old_y, -1)
+        self.samples.append((t, y))
+        self.add(t, y, 1)
+
+    def add(self, t: float, y: float, sign: int) -> None:
+        self.st += sign * t
+        self.sy += sign * y
+        self.stt += sign * t * t
+        self.sty += sign * t * y
+        self.syy += sign * y * y
+
+    @property
+    def mean(self) -> float:
+        return self.sy / len(self.samples) if len(self.samples) > 0 else 0.0
+
+    @property
+    def std(self) -> float:
+        n = len(self.samples)
+        if n < 2:
+            return 0.0
+        return math.sqrt(max(0.0, (self.syy - self.sy * self.sy / n) / (n - 1)))
+
+    @property
+    def span(self) -> float:
+        """The time covered by the window."""
+        return self.samples[-1][0] - self.samples[0][0] if len(self.samples) > 1 else 0.0
+
+    @property
+    def slope(self) -> float:
+        n = len(self.samples)
+        denominator = n * self.stt - self.st * self.st
+        if n < 2 or denominator <= 0:
+            return 0.0
+        return (n * self.sty - self.st * self.sy) / denominator
+
+
+class ChangeDetector:
+    """
+    Two-sided CUSUM on standardized increments. The mean and deviation of the increments are tracked
+    with exponential weights while no deviation accumulates, and restart from the new regime after each change.
+    """
+    def __init__(self, threshold: float = 8.0, drift: float = 1.0, alpha: float = 0.1, warmup: int = 5):
+        """
+        :param threshold: The cumulative deviation, in standard deviations, which signals a change.
+        :param drift: The deviation per sample tolerated without accumulating.
+        :param alpha: The weight of each increment in the running mean and variance.
+        :param warmup: The increments seen after a change before testing for the next one.
+        """
+        self.threshold = threshold
+        self.drift = drift
+        self.alpha = alpha
+        self.warmup = warmup
+        self.reset()
+
+    def reset(self) -> None:
+        self.mean = 0.0
+        self.variance = 0.0
+        self.seen = 0
+        self.high = self.low = 0.0
+
+    def update(self, increment: float) -> Optional[float]:
+        """
+        :return: The mean increment before the change if this increment completes one, None otherwise.
+        """
+        self.seen += 1
+        if self.seen == 1:
+            self.mean = increment
+            return None
+        if self.seen > self.warmup and self.variance > 0:
+            score = (increment - self.mean) / math.sqrt(self.variance)
+            self.high = max(0.0, self.high + score - self.drift)
+            self.low = max(0.0, self.low - score - self.drift)
+            if self.high > self.threshold or self.low > self.threshold:
+                before = self.mean
+                self.reset()
+                self.seen = 1
+                self.mean = increment
+                return before
+        # the regime is learned only while nothing accumulates, so that a change doesn't become the baseline
+        if self.high == 0 and self.low == 0:
+            delta = increment - self.mean
+            self.mean += self.alpha * delta
+            self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+        return None
+
+
+class ExponentialFit(NamedTuple):
+    initial: float
+    plateau: float
+    rate: float
+    """The rate constant in 1/s."""
+    progress: float
+    """How far the current value is from {initial} to {plateau}, from 0 to 1."""
+
+    @property
+    def half_life(self) -> float:
+        return math.log(2) / self.rate
+
+
+class KineticsCurve:
+    """
+    The dissolution curve of one signal of one vial.
+    It is saturated once, over the last {window} samples, the signal moved less than {tolerance} of its total
+    change so far (or less than its noise), and either the exponential approach, if it fits, is {completion} complete
+    or a change point before those samples marked the endpoint.
+    """
+    SIGNIFICANCE = 3.0
+    """The total change, in standard deviations of the window, below which the signal hasn't moved at all."""
+
+    def __init__(self,
+                 name: str,
+                 window: int = 10,
+                 tolerance: float = 0.02,
+                 completion: float = 0.95,
+                 min_samples: int = 20):
+        """
+        :param name: The vial and signal, e.g. 'front/frame'.
+        :param window: The samples of the rolling statistics.
+        :param tolerance: The fraction of the total change under which the signal counts as flat.
+        :param completion: The progress of the exponential fit required for saturation.
+        :param min_samples: The samples needed before saturation may be reported.
+        """
+        self.name = name
+        self.tolerance = tolerance
+        self.completion = completion
+        self.min_samples = min_samples
+
+        self.count = 0
+        self.started_at: Optional[float] = None
+        self.initial = 0.0
+        self.last: Optional[Tuple[float, float]] = None
+        self.linear = OnlineLinearFit()
+        self.approach = OnlineLinearFit()
+        self.rolling = RollingStats(window)
+        self.changes = ChangeDetector()
+        self.change_points = 0
+        self.endpoint: Optional[float] = None
+        """Seconds since the first sample at which the rate last dropped, the dissolution endpoint."""
+        self.saturated_at: Optional[float] = None
+
+    @property
+    def saturated(self) -> bool:
+        return self.saturated_at is not None
+
+    def update(self, timestamp: float, value: float) -> bool:
+        """
+        Add a sample. Samples older than the last one, e.g. analyzed out of order, are ignored.
+        :param timestamp: The wall-clock time of the frame.
+        :param value: The signal.
+        :return: True if the curve just became saturated.
+        """
+        if self.started_at is None:
+            self.started_at = timestamp
+            self.initial = value
+        t = timestamp - self.started_at
+        if self.last is not None and t <= self.last[0]:
+            return False
+
+        if self.last is not None:
+            last_t, last_value = self.last
+            dt = t - last_t
+            self.approach.update((value + last_value) / 2, (value - last_value) / dt)
+            before = self.changes.update(value - last_value)
+            if before is not None:
+                self.change_points += 1
+                # the rate fell towards zero: the curve is flattening out
+                if abs(self.changes.mean) < abs(before):
+                    self.endpoint = last_t
+        self.last = (t, value)
+        self.count += 1
+        self.linear.update(t, value)
+        self.rolling.update(t, value)
+
+        if self.saturated or self.count < self.min_samples or not self.rolling.full:
+            return False
+        movement = abs(self.rolling.slope) * self.rolling.span
+        total = abs(self.rolling.mean - self.initial)
+        # a signal which hasn't risen above its noise yet hasn't started dissolving, e.g. during an induction period
+        if total <= KineticsCurve.SIGNIFICANCE * self.rolling.std or total == 0:
+            return False
+        if movement > max(self.tolerance * total, self.rolling.std):
+            return False
+        # a curve which isn't exponential may still have visibly ended before the window
+        ended = self.endpoint is not None and self.endpoint <= self.rolling.samples[0][0]
+        fit = self.exponential
+        if fit is not None and fit.progress < self.completion and not ended:
+            return False
+        self.saturated_at = t
+        return True
+
+    @property
+    def exponential(self) -> Optional[ExponentialFit]:
+        """
+        :return: The exponential approach fitted so far, or None if the curve doesn't approach a plateau.
+        """
+        slope, intercept = self.approach.slope, self.approach.intercept
+        if slope is None or slope >= 0:
+            return None
+        rate = -slope
+        plateau = intercept / rate
+        if plateau == self.initial:
+            return None
+        progress = (self.rolling.mean - self.initial) / (plateau - self.initial)
+        return ExponentialFit(self.initial, plateau, rate, min(max(progress, 0.0), 1.0))
+
+    def __str__(self):
+        text = f'{self.name}: {self.count} samples'
+        if self.last is not None:
+            text += f', {self.last[1]:.4g} at {self.last[0]:.0f} s'
+        fit = self.exponential
+        if fit is not None:
+            text += f', plateau {fit.plateau:.4g}, half-life {fit.half_life:.0f} s, {fit.progress * 100:.0f} %'
+        if self.endpoint is not None:
+            text += f', endpoint at {self.endpoint:.0f} s'
+        if self.saturated:
+            text += ', saturated'
+        return text
+
+
+def roi_signal(roi: RoiResult) -> Optional[float]:
+    """
+    :return: The turbidity of a ROI if a blank reference is set, the scatter if a pattern is,
+        its median luminance otherwise.
+    """
+    if roi.turbidity is not None:
+        return roi.turbidity
+    if roi.scatter is not None:
+        return roi.scatter
+    return roi.percentiles[len(roi.percentiles) // 2] if len(roi.percentiles) > 0 else None
+
+
+class KineticsModel:
+    """
+    The curves of every vial seen by every camera, fed with analysis results.
+    {on_saturated} is called once every curve is saturated, e.g. to stop a time-lapse early.
+    This is safe to call from any thread.
+    """
+    def __init__(self,
+                 on_saturated: Optional[Callable[['KineticsModel'], None]] = None,
+                 signal: Callable[[RoiResult], Optional[float]] = roi_signal,
+                 **curve_options):
+        """
+        :param on_saturated: Is called with this model once all of its curves are saturated.
+        :param signal: Picks the value of a ROI to follow.
+        :param curve_options: Passed to each KineticsCurve.
+        """
+        self.on_saturated = on_saturated
+        self.signal = signal
+        self.curve_options = curve_options
+        self.lock = Lock()
+        self.curves: Dict[str, KineticsCurve] = {}
+        self.saturated = False
+        self.started_at: Optional[float] = None
+        """Frames taken before this wall-clock time are ignored, see reset."""
+
+    def update(self, source: str, result: AnalysisResult, timestamp: Optional[float] = None) -> None:
+        """
+        Add the analysis of a frame.
+        :param source: The camera of the frame, e.g. 'front'. Each ROI of each source is a curve.
+        :param result: The analysis.
+        :param timestamp: The wall-clock time of the frame, or None for now.
+        :return: None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.started_at is not None and timestamp < self.started_at:
+                # analyzed late, it belongs to the former run
+                return
+            for roi in result.rois:
+                value = self.signal(roi)
+                if value is None:
+                    continue
+                name = f'{source}/{roi.name}'
+                curve = self.curves.get(name)
+                if curve is None:
+                    curve = self.curves[name] = KineticsCurve(name, **self.curve_options)
+                if curve.update(timestamp, value):
+                    print(f'Kinetics: {curve}')
+            saturated = not self.saturated and len(self.curves) > 0 and all(
+                curve.saturated for curve in self.curves.values())
+            if saturated:
+                self.saturated = True
+        if saturated and self.on_saturated is not None:
+            self.on_saturated(self)
+
+    def reset(self) -> None:
+        """
+        Start over, e.g. for a new time-lapse. Frames taken before now are ignored from then on,
+        since the analysis of the former run may still be in progress.
+        :return: None
+        """
+        with self.lock:
+            self.curves.clear()
+            self.saturated = False
+            self.started_at = time.time()
@@ -0,0 +1,171 @@
+import math
+import time
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+
+class Roi(NamedTuple):
+    """
+    A region of interest, usually one vial, in coordinates relative to the frame size
+    so that the same ROI fits frames of any resolution.
+    """
+    name: str
+    x: float
+    y: float
+    width: float
+    height: float
+
+    def slices(self, shape: Tuple[int, ...]) -> Tuple[slice, slice]:
+        """
+        :return: The row and column slices of this ROI in a frame of {shape}.
+        """
+        height, width = shape[:2]
+        top, left = int(self.y * height), int(self.x * width)
+        bottom = max(top + 1, int((self.y + self.height) * height))
+        right = max(left + 1, int((self.x + self.width) * width))
+        return slice(top, bottom), slice(left, right)
+
+
+WHOLE_FRAME = Roi('frame', 0.0, 0.0, 1.0, 1.0)
+
+
+class RoiResult(NamedTuple):
+    name: str
+    mean: Tuple[float, float, float]
+    """Mean of each RGB channel."""
+    percentiles: Tuple[float, ...]
+    """Luminance at each of the analyzer's percentiles."""
+    transmittance: Optional[float]
+    """Mean luminance relative to the blank reference, if one is set."""
+    turbidity: Optional[float]
+    """-log10 of the transmittance, if a blank reference is set."""
+    pattern_correlation: Optional[float]
+    """Normalized cross-correlation with the displayed pattern, if one is set."""
+    scatter: Optional[float]
+    """Loss of pattern contrast, 1 - max(correlation, 0), if a pattern is set."""
+
+
+class AnalysisResult(NamedTuple):
+    rois: Tuple[RoiResult, ...]
+    elapsed: float
+    """Seconds spent analyzing the frame."""
+
+    def roi(self, name: str) -> Optional[RoiResult]:
+        """
+        :return: The result of the ROI named {name}, or None.
+        """
+        return next((roi for roi in self.rois if roi.name == name), None)
+
+
+class SolubilityAnalyzer:
+    """
+    Computes turbidity and transmittance metrics over vial ROIs of a frame.
+    Every metric is a whole-array OpenCV/NumPy operation on the ROI; the percentiles come from
+    a 256-bin histogram rather than a sort, so a full-resolution frame takes milliseconds.
+    """
+    def __init__(self,
+                 rois: Sequence[Roi] = (WHOLE_FRAME,),
+                 percentiles: Sequence[float] = (5.0, 50.0, 95.0)):
+        """
+        :param rois: The regions to analyze.
+        :param percentiles: The luminance percentiles to report, between 0 and 100.
+        """
+        self.rois = tuple(rois)
+        self.percentiles = np.asarray(percentiles, dtype=np.float64) / 100.0
+        self.blank_luminance: Optional[Dict[str, float]] = None
+        self.pattern: Optional[np.ndarray] = None
+        self.pattern_cache: Dict[Tuple[str, int, int], Tuple[np.ndarray, float]] = {}
+
+    def __getstate__(self):
+        # the resized patterns are rebuilt on demand rather than pickled
+        state = self.__dict__.copy()
+        state['pattern_cache'] = {}
+        return state
+
+    def set_blank(self, image: Optional[np.ndarray]) -> None:
+        """
+        Use {image}, a frame of the clear solvent, as the reference for transmittance.
+        :param image: The RGB frame, or None to stop reporting transmittance.
+        """
+        if image is None:
+            self.blank_luminance = None
+            return
+        gray = SolubilityAnalyzer.luminance(image)
+        self.blank_luminance = {roi.name: float(cv2.mean(gray[roi.slices(gray.shape)])[0]) for roi in self.rois}
+
+    def set_pattern(self, image: Optional[np.ndarray]) -> None:
+        """
+        Use {image}, the picture sent with DISPLAY_SHOW_PICTURE, as the pattern the scatter is measured against.
+        Each ROI is compared with the same relative region of the pattern.
+        :param image: The RGB pattern, or None to stop reporting scatter.
+        """
+        self.pattern = SolubilityAnalyzer.luminance(image) if image is not None else None
+        self.pattern_cache.clear()
+
+    def analyze(self, image: np.ndarray) -> AnalysisResult:
+        """
+        :param image: An HxWx3 RGB frame.
+        :return: The metrics of every ROI.
+        """
+        begin = time.perf_counter()
+        gray = SolubilityAnalyzer.luminance(image)
+        results = tuple(self.analyze_roi(roi, image, gray) for roi in self.rois)
+        return AnalysisResult(results, time.perf_counter() - begin)
+
+    def analyze_roi(self, roi: Roi, image: np.ndarray, gray: np.ndarray) -> RoiResult:
+        rows, columns = roi.slices(image.shape)
+        region = image[rows, columns]
+        region_gray = gray[rows, columns]
+
+        mean = cv2.mean(region)[:3]
+
+        histogram = cv2.calcHist([region_gray], [0], None, [256], [0, 256]).ravel()
+        cumulative = np.cumsum(histogram)
+        ranks = self.percentiles * (cumulative[-1] - 1)
+        percentiles = tuple(float(v) for v in np.searchsorted(cumulative, ranks, side='right'))
+
+        transmittance = turbidity = None
+        if self.blank_luminance is not None:
+            blank = self.blank_luminance.get(roi.name, 0.0)
+            luminance = cv2.mean(region_gray)[0]
+            transmittance = luminance / blank if blank > 0 else None
+            if transmittance is not None:
+                turbidity = -math.log10(max(transmittance, 1e-6))
+
+        correlation = scatter = None
+        if self.pattern is not None:
+            correlation = self.correlate(roi, region_gray)
+            scatter = 1.0 - max(correlation, 0.0)
+
+        return RoiResult(roi.name, mean, percentiles, transmittance, turbidity, correlation, scatter)
+
+    def correlate(self, roi: Roi, region_gray: np.ndarray) -> float:
+        """
+        :return: The normalized cross-correlation between a ROI and its region of the pattern.
+        """
+        height, width = region_gray.shape
+        key = (roi.name, width, height)
+        cached = self.pattern_cache.get(key)
+        if cached is None:
+            # the pattern is resized to the ROI once per ROI size, then reused for every frame
+            pattern = self.pattern[roi.slices(self.pattern.shape)]
+            pattern = cv2.resize(pattern, (width, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+            pattern -= pattern.mean()
+            cached = (pattern, float(np.sqrt(np.dot(pattern.ravel(), pattern.ravel()))))
+            self.pattern_cache[key] = cached
+        pattern, pattern_norm = cached
+
+        region = region_gray.astype(np.float32)
+        region -= region.mean()
+        region_norm = float(np.sqrt(np.dot(region.ravel(), region.ravel())))
+        if pattern_norm == 0 or region_norm == 0:
+            return 0.0
+        return float(np.dot(region.ravel(), pattern.ravel())) / (pattern_norm * region_norm)
+
+    @staticmethod
+    def luminance(image: np.ndarray) -> np.ndarray:
+        if image.ndim == 2:
+            return image
+        return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
@@ -0,0 +1,234 @@
+"""
+End-to-end loopback benchmark of the capture path.
+Fake camera and display clients run in a separate process and answer with synthetic JPEGs,
+so that the CPU time measured is the host's own.
+
+Modes:
+    interactor  a bare Interactor requesting CAMERA_TAKE_PICTURE
+    console     MainConsole capturing front camera groups, stored in a temporary frame store
+    gui         MainWindow capturing full groups: decoded, rendered, stored and analyzed
+    all         every mode above, each in its own process so that peak RSS is its own
+
+Reported: frames per second, p50/p99 round-trip latency, host CPU time and peak RSS.
+The CPU time of the analysis worker processes of the GUI is not included.
+
+Run from the repository root:
+    python -m benchmarks.end_to_end --mode all --count 500 --depth 4 --size 1920x1080
+"""
+import argparse
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from threading import Semaphore, Thread
+from typing import Callable, List, Tuple
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from benchmarks.fake_clients import parse_size
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.handshake import Handshake
+from interaction.protocol import Interactor, recv_frame, send_buffers
+
+MODES = ['interactor', 'console', 'gui']
+TIMEOUT = 30.0
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_clients(port: int, displays: int, args: argparse.Namespace) -> subprocess.Popen:
+    command = [sys.executable, '-m', 'benchmarks.fake_clients',
+               '--port', str(port),
+               '--cameras', '1',
+               '--displays', str(displays),
+               '--size', args.size,
+               '--quality', str(args.quality),
+               '--latency', str(args.latency)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL)
+
+
+def wait_until(condition: Callable[[], bool], idle: Callable[[], None] = lambda: time.sleep(0.01)) -> None:
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('The fake clients did not connect.')
+        idle()
+
+
+def drive(fire: Callable[[], Future], count: int, depth: int) -> List[float]:
+    """
+    Keep {depth} requests in flight until {count} of them are answered.
+    :param fire: Sends a request and returns its future.
+    :return: The round-trip time of each request in seconds.
+    """
+    slots = Semaphore(depth)
+    latencies = []
+    remaining = Semaphore(0)
+
+    def on_done(sent_at: float, _: Future) -> None:
+        latencies.append(time.perf_counter() - sent_at)
+        slots.release()
+        remaining.release()
+
+    for _ in range(count):
+        slots.acquire()
+        sent_at = time.perf_counter()
+        fire().add_done_callback(lambda future, sent_at=sent_at: on_done(sent_at, future))
+    for _ in range(count):
+        remaining.acquire()
+    return latencies
+
+
+def measure(fire: Callable[[], Future],
+            args: argparse.Namespace,
+            idle: Callable[[], None] = lambda: time.sleep(0.01)) -> Tuple[List[float], float, float]:
+    """
+    Drive requests on a thread of their own while {idle} runs on this one, e.g. to process GUI events.
+    :return: The round-trip times, the elapsed wall-clock time and the CPU time of this process.
+    """
+    drive(fire, args.warmup, args.depth)
+    result = []
+    thread = Thread(target=lambda: result.append(drive(fire, args.count, args.depth)), daemon=True)
+    started_at = time.perf_counter()
+    cpu = time.process_time()
+    thread.start()
+    while thread.is_alive():
+        idle()
+    return result[0], time.perf_counter() - started_at, time.process_time() - cpu
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def peak_rss() -> float:
+    """
+    :return: The peak resident set size of this process in MiB, or 0 if it is unknown.
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def report(mode: str, latencies: List[float], elapsed: float, cpu: float) -> None:
+    print(f'{mode:>10}: {len(latencies) / elapsed:8.1f} fps, '
+          f'p50 {percentile(latencies, 0.5) * 1000:7.2f} ms, p99 {percentile(latencies, 0.99) * 1000:7.2f} ms, '
+          f'CPU {cpu:6.2f} s ({cpu / elapsed * 100:5.1f} %), peak RSS {peak_rss():7.1f} MiB')
+
+
+def bench_interactor(args: argparse.Namespace) -> Tuple[List[float], float, float]:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    clients = start_clients(server.getsockname()[1], 0, args)
+    try:
+        client, _ = server.accept()
+        bundle = Bundle.from_bytes(recv_frame(client))
+        handshake = Handshake.from_bundle(bundle)
+        if handshake.negotiated:
+            send_buffers(client, Interactor.frame(handshake.reply(EResponse.OK), handshake.padding))
+        handler = Interactor(client, lambda request: request, None, lambda: None,
+                             padding=handshake.padding, streaming=handshake.streaming)
+        handler.start()
+
+        def fire() -> Future:
+            return handler.request(Bundle(None, ERequest.CAMERA_TAKE_PICTURE, bytes([1])), TIMEOUT)
+
+        result = measure(fire, args)
+        handler.interrupt()
+        return result
+    finally:
+        clients.terminate()
+        server.close()
+
+
+def bench_console(args: argparse.Namespace) -> Tuple[List[float], float, float]:
+    from main_console import MainConsole
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        MainConsole.PORT = port
+        MainConsole.FRAME_DIRECTORY = directory
+        console = MainConsole()
+        Thread(target=console.listen, daemon=True).start()
+        clients = start_clients(port, 1, args)
+        try:
+            wait_until(lambda: len(console.devices) == 2)
+            group = console.capture_group(['front'])
+            return measure(group.fire, args)
+        finally:
+            clients.terminate()
+            console.server.close()
+            console.frames.close()
+
+
+def bench_gui(args: argparse.Namespace) -> Tuple[List[float], float, float]:
+    from PyQt5.QtWidgets import QApplication
+    from main_window import MainWindow
+
+    port = free_port()
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    def idle() -> None:
+        app.processEvents()
+        time.sleep(0.001)
+
+    with tempfile.TemporaryDirectory() as directory:
+        MainWindow.PORT = port
+        MainWindow.FRAME_DIRECTORY = directory
+        window = MainWindow()
+        clients = start_clients(port, 1, args)
+        try:
+            wait_until(lambda: len(window.devices) == 2, idle)
+            # the widgets are updated from the main thread, which only processes events here
+            return measure(window.capture_group.fire, args, idle)
+        finally:
+            clients.terminate()
+            window.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the capture path against fake clients.')
+    parser.add_argument('--mode', choices=MODES + ['all'], default='all')
+    parser.add_argument('--count', type=int, default=500, help='requests to measure')
+    parser.add_argument('--warmup', type=int, default=20, help='requests to send before measuring')
+    parser.add_argument('--depth', type=int, default=1, help='requests in flight at once')
+    parser.add_argument('--size', default='1920x1080', help='picture size, e.g. 1920x1080')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the pictures')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds the clients wait before answering')
+    args = parser.parse_args()
+    # fail here rather than in the fake clients process
+    parse_size(args.size)
+
+    if args.mode == 'all':
+        for mode in MODES:
+            command = [sys.executable, '-m', 'benchmarks.end_to_end'] + sys.argv[1:] + ['--mode', mode]
+            subprocess.run(command)
+        return
+
+    bench = {'interactor': bench_interactor, 'console': bench_console, 'gui': bench_gui}[args.mode]
+    # the host prints every frame it receives, which would dominate the measurement
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        result = bench(args)
+    report(args.mode, *result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Loopback stand-ins for the camera and display phones.
+
+Each fake client does the role handshake and answers the host's requests:
+pictures are synthetic JPEGs of a configurable size, encoded once, and sent after a configurable latency.
+Displays keep the digests of the pictures shown, so DISPLAY_SHOW_CACHED_PICTURE behaves as on a real one.
+Clients may offer compression codecs, which makes them negotiate protocol version 2.
+
+Run from the repository root, e.g. one camera and one display against a running host:
+    python -m benchmarks.fake_clients --cameras 1 --displays 1 --size 1920x1080 --latency 20
+"""
+import argparse
+import hashlib
+import socket
+import time
+from threading import Event, Thread
+from typing import Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ECodec, EHandshakeField, ERequest, EResponse
+from interaction.codec import PROTOCOL_VERSION, FrameCodec
+from interaction.handshake import DISPLAY_PROFILE, Handshake
+from interaction.protocol import Interactor, recv_exactly, send_buffers
+
+PORT = 58431
+
+
+def synthetic_jpeg(size: Tuple[int, int], quality: int = 90, seed: int = 0) -> bytes:
+    """
+    :return: A JPEG of {size} with smooth random content, compressing about as well as a photo.
+    """
+    width, height = size
+    random = np.random.default_rng(seed)
+    coarse = random.integers(0, 256, (max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    image = cv2.add(image, random.integers(0, 16, image.shape, dtype=np.uint8))
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes()
+
+
+class FakeClient(Thread):
+    """
+    A fake camera or display client running on its own thread.
+    Requests are answered one after another, as the phones do.
+    """
+    def __init__(self,
+                 role: ERequest,
+                 host: str = '127.0.0.1',
+                 port: int = PORT,
+                 device_id: Optional[str] = None,
+                 picture: bytes = b'',
+                 latency: float = 0.0,
+                 capabilities: Optional[int] = Handshake.NO_PADDING | Handshake.IMAGE_CACHE | Handshake.HEARTBEAT,
+                 profile: Optional[bytes] = None,
+                 codecs: Optional[Sequence[ECodec]] = None):
+        """
+        :param role: CAMERA or DISPLAY.
+        :param host: The host to connect to.
+        :param port: The port of the host.
+        :param device_id: The device ID to propose, or None to get one assigned.
+        :param picture: The JPEG answered to capture requests.
+        :param latency: Seconds to wait before answering each request.
+        :param capabilities: The capability flags to send, or None for a bare legacy handshake.
+        :param profile: The DISPLAY_PROFILE field to send, or None.
+        :param codecs: The codecs to offer, in order of preference, or None to keep protocol version 1.
+        """
+        super(FakeClient, self).__init__(daemon=True)
+        self.role = role
+        self.address = (host, port)
+        self.device_id = device_id
+        self.picture = picture
+        self.latency = latency
+        self.capabilities = capabilities
+        self.profile = profile
+        self.codecs = codecs
+        self.codec: Optional[FrameCodec] = None
+
+        self.padding = True
+        self.held = set()
+        self.handled = 0
+        self.connected = Event()
+        self.client: Optional[socket.socket] = None
+
+    def handshake(self) -> None:
+        fields = {}
+        if self.capabilities is not None:
+            fields[EHandshakeField.CAPABILITIES] = bytes([self.capabilities])
+        if self.device_id is not None:
+            fields[EHandshakeField.DEVICE_ID] = self.device_id.encode('utf-8')
+        if self.profile is not None:
+            fields[EHandshakeField.DISPLAY_PROFILE] = self.profile
+        if self.codecs is not None:
+            fields[EHandshakeField.VERSION] = bytes([PROTOCOL_VERSION])
+            fields[EHandshakeField.CODECS] = bytes(codec.int() for codec in self.codecs)
+        send_buffers(self.client, Interactor.frame(Bundle(0, self.role, Handshake.encode_fields(fields)), False))
+
+        if len(fields) > 0:
+            # the reply is already framed the way the client asked for
+            self.padding = not self.capabilities or not self.capabilities & Handshake.NO_PADDING
+            reply = Handshake.from_bundle(Bundle.from_bytes(self.read_frame()))
+            self.padding = reply.padding
+            self.device_id = reply.device_id
+            self.codec = reply.frame_codec
+
+    def read_frame(self) -> Optional[memoryview]:
+        header = recv_exactly(self.client, 4)
+        if header is None:
+            return None
+        data = recv_exactly(self.client, int.from_bytes(header, byteorder='big'))
+        # the host pads frames for clients which didn't negotiate otherwise
+        if data is not None and self.padding and recv_exactly(self.client, len(Interactor.PADDING)) is None:
+            return None
+        return data
+
+    def answer(self, bundle: Bundle) -> Optional[Bundle]:
+        """
+        :return: The response to a request of the host, or None to close the connection.
+        """
+        args = b''
+        response = EResponse.OK
+        if bundle.request == ERequest.CAMERA_TAKE_PICTURE or bundle.request == ERequest.DISPLAY_TAKE_PICTURE:
+            args = self.picture
+        elif bundle.request == ERequest.DISPLAY_SHOW_PICTURE:
+            self.held.add(hashlib.sha256(bundle.args).digest())
+        elif bundle.request == ERequest.DISPLAY_SHOW_CACHED_PICTURE:
+            response = EResponse.OK if bytes(bundle.args) in self.held else EResponse.REJECT
+        elif bundle.request == ERequest.ANY_PING:
+            response = EResponse.ACK
+        elif bundle.request == ERequest.ANY_QUIT:
+            return None
+        elif not bundle.request.is_for(self.role):
+            response = EResponse.REJECT
+        return Bundle(bundle.request_id, bundle.request, args, response)
+
+    def run(self) -> None:
+        try:
+            self.client = socket.create_connection(self.address)
+            self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.handshake()
+            self.connected.set()
+            while True:
+                data = self.read_frame()
+                if data is None or len(data) < 3:
+                    break
+                response = self.answer(Bundle.from_bytes(data) if self.codec is None else FrameCodec.decode(data))
+                if response is None:
+                    break
+                if self.latency > 0:
+                    time.sleep(self.latency)
+                send_buffers(self.client, Interactor.frame(response, False, self.codec))
+                self.handled += 1
+        except OSError as e:
+            print(f'{self.role.name.capitalize()} {self.device_id}: {e}')
+        finally:
+            if self.client is not None:
+                self.client.close()
+            self.connected.set()
+
+    def close(self) -> None:
+        if self.client is not None:
+            try:
+                self.client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Connect fake camera and display clients to a host.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--cameras', type=int, default=1)
+    parser.add_argument('--displays', type=int, default=0)
+    parser.add_argument('--size', type=parse_size, default=(1920, 1080), help='picture size, e.g. 1920x1080')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the pictures')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds before each answer')
+    parser.add_argument('--legacy', action='store_true', help='send a bare handshake and expect padding')
+    parser.add_argument('--profile', type=parse_size, default=None, help='screen size the displays report')
+    parser.add_argument('--codecs', default=None, help='codecs to offer, e.g. zstd,zlib, to negotiate version 2')
+    args = parser.parse_args()
+
+    picture = synthetic_jpeg(args.size, args.quality)
+    capabilities = None if args.legacy else Handshake.NO_PADDING | Handshake.IMAGE_CACHE | Handshake.HEARTBEAT
+    profile = DISPLAY_PROFILE.pack(*args.profile, 1, 90) if args.profile is not None else None
+    codecs = [ECodec[name.upper()] for name in args.codecs.split(',')] if args.codecs is not None else None
+    clients = [FakeClient(ERequest.CAMERA, args.host, args.port, picture=picture, latency=args.latency / 1000,
+                          capabilities=capabilities, codecs=codecs)
+               for _ in range(args.cameras)]
+    clients += [FakeClient(ERequest.DISPLAY, args.host, args.port, picture=picture, latency=args.latency / 1000,
+                           capabilities=capabilities, profile=profile, codecs=codecs)
+                for _ in range(args.displays)]
+    for client in clients:
+        client.start()
+    print(f'{len(clients)} clients, pictures of {len(picture)} bytes')
+    for client in clients:
+        client.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Micro-benchmark of Bundle header decoding and request dispatch checks.
+Compares the former linear enum scan with the lookup tables.
+
+Run from the repository root:
+    python -m benchmarks.header_codec
+"""
+import timeit
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+
+COUNT = 200000
+
+
+def legacy_from_bytes(data: bytes, enum):
+    data = int(data[0])
+    for v in enum:
+        if v.int() == data:
+            return v
+    return None
+
+
+def legacy_decode(data: bytes) -> Bundle:
+    return Bundle(
+        data[0],
+        legacy_from_bytes(data[1:2], ERequest),
+        args=data[3:],
+        response=legacy_from_bytes(data[2:3], EResponse)
+    )
+
+
+def legacy_is_for(request: ERequest, flag: ERequest) -> bool:
+    value = flag.int()
+    return (request.int() & value) == value
+
+
+def report(name: str, seconds: float) -> None:
+    print(f'{name:>28}: {seconds / COUNT * 1e9:8.1f} ns')
+
+
+def main():
+    frame = memoryview(Bundle(7, ERequest.ANY_AGAIN, b'\x01', EResponse.ERROR).bytes())
+    request = ERequest.DISPLAY_SHOW_PICTURE
+
+    report('legacy decode', timeit.timeit(lambda: legacy_decode(frame), number=COUNT))
+    report('table decode', timeit.timeit(lambda: Bundle.from_bytes(frame), number=COUNT))
+    report('legacy is_for_display', timeit.timeit(lambda: legacy_is_for(request, ERequest.DISPLAY), number=COUNT))
+    report('cached is_for_display', timeit.timeit(request.is_for_display, number=COUNT))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Throughput of the analysis and storage paths on a recorded session.
+The trace is replayed at full speed, or at a given speed: every captured picture is decoded,
+appended to a temporary frame store and analyzed, as the GUI does with a frame group.
+
+Record a trace with the console or the GUI, then run from the repository root:
+    python main_console.py --record=session.trace
+    python -m benchmarks.replay session.trace [--speed 1] [--workers 4]
+"""
+import argparse
+import math
+import tempfile
+import time
+from concurrent.futures import Future
+from threading import Lock
+
+from analysis.executor import AnalysisExecutor
+from analysis.solubility import SolubilityAnalyzer
+from imaging.pipeline import decode_image
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.registry import DeviceRegistry
+from interaction.replay import TraceReplayer
+from storage.frame_store import FrameStore
+from storage.writer import FrameWriter
+
+CAPTURES = (ERequest.CAMERA_TAKE_PICTURE, ERequest.DISPLAY_TAKE_PICTURE)
+
+
+def reject(bundle: Bundle) -> Bundle:
+    bundle.response = EResponse.ACK if bundle.request == ERequest.ANY_QUIT else EResponse.REJECT
+    return bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a trace through the analysis and storage paths.')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, default=math.inf, help='times faster than recorded, inf by default')
+    parser.add_argument('--workers', type=int, default=None, help='analysis processes, one per CPU by default')
+    parser.add_argument('--no-analysis', action='store_true', help='only decode and store the pictures')
+    args = parser.parse_args()
+
+    devices = DeviceRegistry()
+    counts = {'pictures': 0, 'analyzed': 0, 'failed': 0}
+    lock = Lock()
+
+    def analyzed(_, __) -> None:
+        with lock:
+            counts['analyzed'] += 1
+
+    analysis = None
+    if not args.no_analysis:
+        # every picture is analyzed, so that the replay waits for the workers rather than dropping frames
+        analysis = AnalysisExecutor(SolubilityAnalyzer(), analyzed, args.workers, policy=AnalysisExecutor.QUEUE)
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = FrameWriter(FrameStore(directory))
+
+        def captured(device_id: str, cam_id: int, future: Future) -> None:
+            if future.exception() is not None or future.result().response != EResponse.OK:
+                counts['failed'] += 1
+                return
+            bundle = future.result()
+            counts['pictures'] += 1
+            writer.submit(bundle.args, device_id, cam_id, bundle.request_id, bundle.request)
+            image = decode_image(bundle.view())
+            if analysis is not None:
+                analysis.submit(image, device_id)
+
+        def on_request(device_id: str, bundle: Bundle, future: Future) -> None:
+            if bundle.request in CAPTURES:
+                cam_id = bundle.args[0] if len(bundle.args) > 0 else None
+                future.add_done_callback(lambda f: captured(device_id, cam_id, f))
+
+        replayer = TraceReplayer(args.trace, reject, None,
+                                 devices.accept,
+                                 devices.unregister,
+                                 on_request)
+        started_at = time.monotonic()
+        stats = replayer.run(args.speed)
+        # the pictures still queued are part of the work
+        writer.flush()
+        if analysis is not None:
+            analysis.shutdown()
+        elapsed = time.monotonic() - started_at
+        writer.close()
+
+    print(f'Replayed {stats.frames} frames ({stats.bytes / 1024 / 1024:.1f} MiB) '
+          f'of a {stats.duration:.1f} s session in {stats.elapsed:.2f} s')
+    print(f'{counts["pictures"]} pictures decoded and stored, {counts["analyzed"]} analyzed, '
+          f'{counts["failed"]} failed: {counts["pictures"] / elapsed:.1f} pictures/s, '
+          f'{stats.bytes / 1024 / 1024 / elapsed:.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Loopback benchmark for Interactor.send_bundle.
+Compares the former send path (double serialization, padding copy, two sends)
+with the scatter-gather one, both with and without the legacy padding.
+
+Run from the repository root:
+    python -m benchmarks.send_bundle
+"""
+import socket
+import time
+from threading import Thread
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest
+from interaction.protocol import Interactor
+
+SIZES = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+TOTAL_BYTES = 256 * 1024 * 1024
+
+
+def drain(client: socket.socket) -> None:
+    buffer = memoryview(bytearray(1024 * 1024))
+    while client.recv_into(buffer) > 0:
+        pass
+
+
+def legacy_send(client: socket.socket, bundle: Bundle) -> None:
+    data = bundle.bytes()
+    length_bytes = int.to_bytes(len(data), length=4, byteorder='big')
+    client.send(length_bytes)
+    client.sendall(bundle.bytes() + b'\x00' * 1020)
+
+
+def measure(send, size: int) -> float:
+    """
+    :return: Payload bytes per second sent through {send}.
+    """
+    host, client = socket.socketpair()
+    reader = Thread(target=drain, args=(client,))
+    reader.start()
+
+    bundle = Bundle(0, ERequest.DISPLAY_SHOW_PICTURE, bytes(size))
+    count = max(1, TOTAL_BYTES // size)
+    begin = time.perf_counter()
+    for _ in range(count):
+        send(host, bundle)
+    elapsed = time.perf_counter() - begin
+
+    host.close()
+    reader.join()
+    client.close()
+    return count * size / elapsed
+
+
+def interactor_send(padding: bool):
+    def send(client: socket.socket, bundle: Bundle) -> None:
+        interactor = interactors.get(client)
+        if interactor is None:
+            interactor = Interactor(client, None, None, None, padding=padding)
+            interactors[client] = interactor
+        interactor.send_bundle(bundle)
+
+    interactors = {}
+    return send
+
+
+def main():
+    paths = [('legacy', legacy_send),
+             ('scatter-gather, padding', interactor_send(True)),
+             ('scatter-gather', interactor_send(False))]
+    print(f'{"payload":>10} ' + ' '.join(f'{name:>24}' for name, _ in paths))
+    for size in SIZES:
+        rates = [measure(send, size) / (1024 * 1024) for _, send in paths]
+        print(f'{size // 1024:>8}KB ' + ' '.join(f'{rate:>20.1f}MB/s' for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
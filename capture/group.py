@@ -0,0 +1,167 @@
+import time
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence
+
+from capture.scheduler import Capture
+from interaction.bundle import Bundle
+from interaction.registry import DeviceRegistry
+
+
+class GroupFrame:
+    """
+    The response to one capture of a frame group, with host monotonic timestamps.
+    """
+    def __init__(self, capture: Capture, device_id: Optional[str], sent_at: float):
+        self.capture = capture
+        self.device_id = device_id
+        self.sent_at = sent_at
+        self.received_at: Optional[float] = None
+        self.timestamp: Optional[float] = None
+        """Wall-clock time the response was received at."""
+        self.bundle: Optional[Bundle] = None
+        self.error: Optional[BaseException] = None
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Seconds from sending the request to receiving the response, or None if it failed."""
+        return self.received_at - self.sent_at if self.received_at is not None else None
+
+    def __str__(self):
+        if self.bundle is None:
+            return f'{self.capture.name}@{self.device_id}: {self.error}'
+        return f'{self.capture.name}@{self.device_id}: {self.latency * 1e3:.1f} ms'
+
+
+class FrameGroup:
+    """
+    The frames captured together for one step.
+    """
+    def __init__(self, step: int, frames: List[GroupFrame], timestamp: float):
+        """
+        :param step: The step the group was captured for.
+        :param frames: One frame per capture, in the order of the captures.
+        :param timestamp: The wall-clock time the group was fired at.
+        """
+        self.step = step
+        self.frames = frames
+        self.timestamp = timestamp
+        """Wall-clock time the group was fired at, before its first request was sent."""
+
+    @property
+    def received(self) -> List[GroupFrame]:
+        """The frames whose response arrived."""
+        return [frame for frame in self.frames if frame.bundle is not None]
+
+    @property
+    def complete(self) -> bool:
+        return all(frame.bundle is not None for frame in self.frames)
+
+    @property
+    def skew(self) -> float:
+        """Seconds between the first and the last response received."""
+        times = [frame.received_at for frame in self.received]
+        return max(times) - min(times) if len(times) > 1 else 0.0
+
+    def latencies(self) -> Dict[str, float]:
+        """
+        :return: The latency of each received frame keyed by capture name.
+        """
+        return {frame.capture.name: frame.latency for frame in self.received}
+
+    def __str__(self):
+        return (f'group {self.step}: {str.join(", ", map(str, self.frames))}, '
+                f'skew {self.skew * 1e3:.1f} ms')
+
+
+class CaptureGroup:
+    """
+    Fires several captures at once over their devices and collects the responses into a FrameGroup.
+    Every request is sent before any response is awaited, so a group takes one round trip, not one per capture.
+    """
+    def __init__(self,
+                 devices: DeviceRegistry,
+                 captures: Sequence[Capture],
+                 timeout: Optional[float] = None,
+                 on_group: Optional[Callable[[FrameGroup], None]] = None):
+        """
+        :param devices: The devices to capture with.
+        :param captures: The captures of each group.
+        :param timeout: Seconds to wait for each response, or None to wait forever.
+        :param on_group: Called with each group once all its responses arrived or failed,
+            on the thread of the last one.
+        """
+        self.devices = devices
+        self.captures = tuple(captures)
+        self.timeout = timeout
+        self.on_group = on_group
+
+    def fire(self, step: int = 0) -> Future:
+        """
+        :param step: The step the group is captured for.
+        :return: The future of the FrameGroup. It never fails; failed captures are recorded in their frames.
+        """
+        result = Future()
+        frames = []
+        futures = []
+        fired_at = time.time()
+        for capture in self.captures:
+            handlers = self.devices.route(capture.request, capture.device_id)
+            handler = handlers[0] if len(handlers) > 0 else None
+            frame = GroupFrame(capture, self.devices.device_id(handler) if handler is not None else None,
+                               time.monotonic())
+            frames.append(frame)
+            if handler is None:
+                frame.error = LookupError(f'There is no device for {capture.name}.')
+                futures.append(None)
+            else:
+                try:
+                    futures.append(handler.request(Bundle(None, capture.request, capture.args), self.timeout))
+                except Exception as e:
+                    # e.g. the device disconnected meanwhile; the other captures of the group still go out
+                    frame.error = e
+                    futures.append(None)
+
+        group = FrameGroup(step, frames, fired_at)
+        requested = sum(future is not None for future in futures)
+        remaining = [requested]
+        lock = Lock()
+
+        def on_done(frame: GroupFrame, future: Future) -> None:
+            # responses resolve their future on the receive thread, so this is the host receive time
+            received_at = time.monotonic()
+            error = future.exception()
+            if error is None:
+                frame.received_at = received_at
+                frame.timestamp = time.time()
+                frame.bundle = future.result()
+            else:
+                frame.error = error
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                self.finish(group, result)
+
+        for frame, future in zip(frames, futures):
+            if future is not None:
+                future.add_done_callback(lambda f, frame=frame: on_done(frame, f))
+        # the responses may all be in by now, in which case the last of them finished the group
+        if requested == 0:
+            self.finish(group, result)
+        return result
+
+    def step(self, step: int) -> List[Future]:
+        """
+        Fire a group as the step of a CaptureScheduler.
+        :return: The future of the group.
+        """
+        return [self.fire(step)]
+
+    def finish(self, group: FrameGroup, result: Future) -> None:
+        if self.on_group is not None:
+            try:
+                self.on_group(group)
+            except Exception as e:
+                print(f'Capture group: {e}')
+        result.set_result(group)
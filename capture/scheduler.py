@@ -0,0 +1,181 @@
+import math
+import time
+from concurrent.futures import Future
+from threading import Event, Thread
+from typing import Callable, List, Optional
+
+from interaction.byte_enum import ERequest
+
+
+class JitterStats:
+    """
+    Running statistics of how late the steps of a schedule fire, in seconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.missed = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def add(self, lateness: float) -> None:
+        # Welford's online algorithm
+        self.count += 1
+        delta = lateness - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (lateness - self.mean)
+        self.min = min(self.min, lateness)
+        self.max = max(self.max, lateness)
+
+    @property
+    def stdev(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def __str__(self):
+        if self.count == 0:
+            return f'no step fired, missed {self.missed}, skipped {self.skipped}, failed {self.failed}'
+        return (f'{self.count} steps, lateness mean {self.mean * 1e3:.2f} ms, stdev {self.stdev * 1e3:.2f} ms, '
+                f'min {self.min * 1e3:.2f} ms, max {self.max * 1e3:.2f} ms, '
+                f'missed {self.missed}, skipped {self.skipped}, failed {self.failed}')
+
+
+class Capture:
+    """
+    One capture fired at every step of a schedule.
+    """
+    ALL = ('front', 'rear', 'display')
+
+    def __init__(self, name: str, request: ERequest, args: bytes = b'', device_id: Optional[str] = None):
+        """
+        :param name: Names the capture, e.g. 'front'.
+        :param request: CAMERA_TAKE_PICTURE or DISPLAY_TAKE_PICTURE.
+        :param args: The args of the request, e.g. bytes([cam_id]).
+        :param device_id: The device to capture with, or None for the default device of the role.
+        """
+        self.name = name
+        self.request = request
+        self.args = args
+        self.device_id = device_id
+
+    def __str__(self):
+        return f'{self.name}@{self.device_id or "default"}'
+
+    @staticmethod
+    def parse(name: str) -> 'Capture':
+        """
+        :param name: 'front', 'rear' or 'display', optionally followed by '@device_id'.
+        :return: The capture it names.
+        :raise ValueError: if the name is unknown.
+        """
+        name, _, device_id = name.partition('@')
+        device_id = device_id or None
+        if name == 'front':
+            return Capture(name, ERequest.CAMERA_TAKE_PICTURE, bytes([1]), device_id)
+        if name == 'rear':
+            return Capture(name, ERequest.CAMERA_TAKE_PICTURE, bytes([0]), device_id)
+        if name == 'display':
+            return Capture(name, ERequest.DISPLAY_TAKE_PICTURE, b'', device_id)
+        raise ValueError(f'Unknown capture: {name}')
+
+
+class CaptureScheduler(Thread):
+    """
+    Fires a step of captures at fixed intervals on the monotonic clock.
+    Step n is due at start + n * interval, so the time spent firing never accumulates into drift.
+    A step is skipped while the futures of the former one are still pending.
+    """
+    SKIP = 0
+    """Skip the missed steps and wait for the next deadline."""
+    FIRE_LATE = 1
+    """Fire a missed step once right away, then keep to the original timeline."""
+    RESTART = 2
+    """Fire a missed step right away and restart the timeline from then."""
+
+    def __init__(self,
+                 interval: float,
+                 capture: Callable[[int], List[Future]],
+                 steps: Optional[int] = None,
+                 policy: int = SKIP,
+                 tolerance: Optional[float] = None,
+                 on_finished: Optional[Callable[['CaptureScheduler'], None]] = None):
+        """
+        :param interval: Seconds between steps.
+        :param capture: Fires the captures of step n and returns their futures.
+        :param steps: The number of steps, or None to run until stopped.
+        :param policy: SKIP, FIRE_LATE or RESTART.
+        :param tolerance: Seconds a step may be late before its deadline counts as missed,
+            or None for a tenth of the interval.
+        :param on_finished: Called with the scheduler once it stops.
+        """
+        super(CaptureScheduler, self).__init__(daemon=True)
+        self.interval = interval
+        self.capture = capture
+        self.steps = steps
+        self.policy = policy
+        self.tolerance = tolerance if tolerance is not None else interval / 10
+        self.on_finished = on_finished
+
+        self.stats = JitterStats()
+        self.stop_event = Event()
+        self.in_flight: List[Future] = []
+        self.step = 0
+        """The step due next, counted on the timeline whether it fires or not."""
+
+    def run(self) -> None:
+        try:
+            start = time.monotonic()
+            while not self.stop_event.is_set() and (self.steps is None or self.step < self.steps):
+                deadline = start + self.step * self.interval
+                if self.stop_event.wait(max(0.0, deadline - time.monotonic())):
+                    break
+
+                now = time.monotonic()
+                lateness = now - deadline
+                late = lateness > self.tolerance
+                if late:
+                    if self.policy == CaptureScheduler.SKIP:
+                        # realign to the first deadline still ahead
+                        ahead = self.next_step(start, now)
+                        self.stats.missed += ahead - self.step
+                        self.step = ahead
+                        continue
+                    self.stats.missed += 1
+                    if self.policy == CaptureScheduler.RESTART:
+                        start = now - self.step * self.interval
+
+                self.fire(lateness)
+                self.step += 1
+                if late and self.policy == CaptureScheduler.FIRE_LATE:
+                    # the steps missed meanwhile aren't fired at all
+                    ahead = max(self.step, self.next_step(start, time.monotonic()))
+                    self.stats.missed += ahead - self.step
+                    self.step = ahead
+        finally:
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def next_step(self, start: float, now: float) -> int:
+        """
+        :return: The first step whose deadline is after {now}.
+        """
+        return math.floor((now - start) / self.interval) + 1
+
+    def fire(self, lateness: float) -> None:
+        if any(not future.done() for future in self.in_flight):
+            self.stats.skipped += 1
+            print(f'Schedule: step {self.step} skipped, the former captures are still in flight')
+        else:
+            self.stats.add(lateness)
+            try:
+                self.in_flight = self.capture(self.step)
+            except Exception as e:
+                # a step which can't be fired, e.g. with no device connected, doesn't end the schedule
+                self.stats.failed += 1
+                self.in_flight = []
+                print(f'Schedule: step {self.step} failed, {e}')
+
+    def interrupt(self) -> None:
+        self.stop_event.set()
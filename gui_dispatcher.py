@@ -0,0 +1,60 @@
+from functools import partial
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+
+class GuiDispatcher(QObject):
+    """
+    Moves work from network threads into the GUI thread through queued signals.
+    It must be created on the GUI thread.
+
+    Frames are coalesced per key: when frames arrive faster than the GUI repaints,
+    only the newest frame of each key gets rendered and the older ones are dropped.
+    """
+    called = pyqtSignal(object)
+    frame_arrived = pyqtSignal(object)
+
+    def __init__(self, parent: QObject = None):
+        super(GuiDispatcher, self).__init__(parent)
+
+        self.lock = Lock()
+        self.frames: Dict[Hashable, Tuple[Callable[[Any], None], Any]] = {}
+
+        # noinspection PyUnresolvedReferences
+        self.called.connect(self.on_called, Qt.QueuedConnection)
+        # noinspection PyUnresolvedReferences
+        self.frame_arrived.connect(self.on_frame_arrived, Qt.QueuedConnection)
+
+    def call(self, callback: Callable, *args) -> None:
+        """
+        Run {callback} with {args} on the GUI thread. This is safe to call from any thread.
+        :return: None
+        """
+        # noinspection PyUnresolvedReferences
+        self.called.emit(partial(callback, *args))
+
+    def render(self, key: Hashable, renderer: Callable[[Any], None], frame: Any) -> None:
+        """
+        Render {frame} with {renderer} on the GUI thread, unless a newer frame of {key} comes first.
+        This is safe to call from any thread.
+        :param key: Identifies what the frame is drawn on, e.g. the view.
+        :param renderer: Draws a frame.
+        :param frame: The frame to draw.
+        :return: None
+        """
+        with self.lock:
+            scheduled = key in self.frames
+            self.frames[key] = (renderer, frame)
+        if not scheduled:
+            # noinspection PyUnresolvedReferences
+            self.frame_arrived.emit(key)
+
+    def on_called(self, callback: Callable) -> None:
+        callback()
+
+    def on_frame_arrived(self, key: Hashable) -> None:
+        with self.lock:
+            renderer, frame = self.frames.pop(key)
+        renderer(frame)
@@ -0,0 +1,239 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from imaging.transcode import transcode
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.handshake import DisplayProfile
+from interaction.payload import FilePayload, Payload
+from interaction.registry import DeviceRegistry
+
+
+class CachedPicture:
+    """
+    A picture to show on displays with the SHA-256 digest naming it.
+    """
+    def __init__(self, path: str, digest: bytes, data: Payload):
+        self.path = path
+        self.digest = digest
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class PictureCache:
+    """
+    Pictures read from files and prepared for display profiles, keyed by path, modification time, size and profile,
+    so that an edited file is prepared again.
+    The bytes are kept in an LRU bounded by their total size. Pictures too large for it are kept file-backed
+    in a second LRU bounded by their number: a source file as it is, a transcoded picture written to a file.
+    File-backed pictures don't count against {max_bytes}, since they are only memory-mapped when sent
+    and the OS can drop their pages at any time; they are never read, hashed or transcoded twice.
+    Preparing runs on a worker thread with prepare(), so that callers like the GUI never wait for it.
+    """
+    MAX_BYTES = 64 * 1024 * 1024
+    MAX_FILES = 256
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        """
+        :param max_bytes: The total size of the pictures kept in memory.
+        """
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.pictures: 'OrderedDict[Tuple, CachedPicture]' = OrderedDict()
+        self.size = 0
+        self.files: 'OrderedDict[Tuple, CachedPicture]' = OrderedDict()
+        # holds the transcoded pictures too large for memory, made on the first of them
+        self.directory: Optional[str] = None
+        self.worker = ThreadPoolExecutor(1, thread_name_prefix='picture-cache')
+
+    def get(self, path: str, profile: Optional[DisplayProfile] = None) -> CachedPicture:
+        """
+        :param path: The file of the picture.
+        :param profile: The profile to transcode the picture for, or None for the file as it is.
+        :return: The picture, read, transcoded and hashed only if it isn't cached yet.
+        :raise OSError: if the file can't be read.
+        :raise ValueError: if the file can't be transcoded.
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, profile)
+        with self.lock:
+            for pictures in (self.pictures, self.files):
+                picture = pictures.get(key)
+                if picture is not None:
+                    pictures.move_to_end(key)
+                    return picture
+
+        if profile is not None:
+            data = transcode(FilePayload(path).view(), profile)
+            picture = CachedPicture(path, hashlib.sha256(data).digest(), data)
+            if len(data) > self.max_bytes:
+                picture.data = self.spill(data)
+                self.put_file(key, picture)
+            else:
+                self.put(key, picture)
+            return picture
+
+        if stat.st_size > self.max_bytes:
+            picture = CachedPicture(path, PictureCache.hash_file(path), FilePayload(path))
+            self.put_file(key, picture)
+            return picture
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        picture = CachedPicture(path, hashlib.sha256(data).digest(), data)
+        self.put(key, picture)
+        return picture
+
+    def put(self, key: Tuple, picture: CachedPicture) -> None:
+        if len(picture) > self.max_bytes:
+            return
+        with self.lock:
+            if key not in self.pictures:
+                self.pictures[key] = picture
+                self.size += len(picture)
+            while self.size > self.max_bytes:
+                _, evicted = self.pictures.popitem(last=False)
+                self.size -= len(evicted)
+
+    def put_file(self, key: Tuple, picture: CachedPicture) -> None:
+        with self.lock:
+            previous = self.files.get(key)
+            self.files[key] = picture
+            evicted = [self.files.popitem(last=False)[1] for _ in range(len(self.files) - PictureCache.MAX_FILES)]
+        if previous is not None and previous is not picture:
+            evicted.append(previous)
+        for stale in evicted:
+            PictureCache.remove_spilled(stale)
+
+    def spill(self, data: bytes) -> FilePayload:
+        """
+        Write a transcoded picture too large for memory to a file of the cache.
+        :return: The payload over that file.
+        """
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='solubility_pictures-')
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.picture', delete=False) as file:
+            file.write(data)
+        return FilePayload(file.name)
+
+    @staticmethod
+    def remove_spilled(picture: CachedPicture) -> None:
+        # a source file is only referenced, a spilled one belongs to the cache
+        if isinstance(picture.data, FilePayload) and picture.data.path != picture.path:
+            try:
+                os.remove(picture.data.path)
+            except OSError as e:
+                print(f'Picture cache: cannot remove {picture.data.path}, {e}')
+
+    def close(self) -> None:
+        """
+        Stop the worker and remove the files of the transcoded pictures.
+        :return: None
+        """
+        self.worker.shutdown(wait=False)
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def prepare(self, path: str, profiles: Iterable[Optional[DisplayProfile]]) -> Future:
+        """
+        Prepare a picture for several profiles ahead of time on the worker thread.
+        :return: The future of the list of pictures, one per profile.
+        """
+        profiles = list(profiles)
+        return self.worker.submit(lambda: [self.get(path, profile) for profile in profiles])
+
+    @staticmethod
+    def hash_file(path: str) -> bytes:
+        digest = hashlib.sha256()
+        for chunk in FilePayload(path).chunks(1024 * 1024):
+            digest.update(chunk)
+        return digest.digest()
+
+
+def send_picture(handler, picture: CachedPicture, cached: bool, timeout: Optional[float] = None) -> Future:
+    """
+    Show a picture on a display. A display keeping shown images is asked for the digest first,
+    and the picture itself is sent only if the display doesn't hold it.
+    :param handler: The Interactor or AsyncInteractor of the display.
+    :param picture: The picture to show.
+    :param cached: Whether the display keeps shown images by digest.
+    :param timeout: Seconds to wait for each response, or None to wait forever.
+    :return: The future of the final response bundle.
+    """
+    result = Future()
+
+    def forward(future: Future) -> None:
+        if future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            result.set_result(future.result())
+
+    def send_full() -> None:
+        handler.request(Bundle(None, ERequest.DISPLAY_SHOW_PICTURE, picture.data), timeout).add_done_callback(forward)
+
+    def on_probed(future: Future) -> None:
+        if future.exception() is None and future.result().response == EResponse.OK:
+            result.set_result(future.result())
+        elif isinstance(future.exception(), ConnectionError):
+            result.set_exception(future.exception())
+        else:
+            # this runs as a done-callback, where an error would only be logged and {result} never complete
+            try:
+                send_full()
+            except Exception as e:
+                result.set_exception(e)
+
+    if cached:
+        probe = Bundle(None, ERequest.DISPLAY_SHOW_CACHED_PICTURE, picture.digest)
+        handler.request(probe, timeout).add_done_callback(on_probed)
+    else:
+        send_full()
+    return result
+
+
+def display_profiles(devices: DeviceRegistry) -> List[DisplayProfile]:
+    """
+    :return: The distinct profiles of the connected displays.
+    """
+    profiles = []
+    for device_id in devices.by_role(ERequest.DISPLAY):
+        handshake = devices.handshake(device_id)
+        if handshake is not None and handshake.display_profile not in profiles:
+            profiles.append(handshake.display_profile)
+    return profiles
+
+
+def send_picture_to_displays(devices: DeviceRegistry,
+                             pictures: PictureCache,
+                             path: str,
+                             device_id: Optional[str] = None,
+                             timeout: Optional[float] = None) -> Dict[str, Future]:
+    """
+    Show a picture on the displays a DISPLAY_SHOW_PICTURE request is routed to,
+    each getting it prepared for its own profile.
+    :param devices: The connected devices.
+    :param pictures: The cache to prepare the picture with.
+    :param path: The file of the picture.
+    :param device_id: The display to show it on, or None for the default display.
+    :param timeout: Seconds to wait for each response, or None to wait forever.
+    :return: The futures of the final responses keyed by device ID.
+    :raise OSError: if the file can't be read.
+    :raise ValueError: if the file can't be transcoded.
+    """
+    futures = {}
+    for handler in devices.route(ERequest.DISPLAY_SHOW_PICTURE, device_id):
+        name = devices.device_id(handler)
+        handshake = devices.handshake(name)
+        if handshake is None:
+            continue
+        picture = pictures.get(path, handshake.display_profile)
+        futures[name] = send_picture(handler, picture, handshake.image_cache, timeout)
+    return futures
@@ -0,0 +1,74 @@
+import io
+from typing import Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+"""imdecode flags per JPEG scale denominator. Reduced JPEG decoding skips the discarded DCT coefficients."""
+
+
+def image_size(data: Union[bytes, memoryview]) -> Tuple[int, int]:
+    """
+    Read the size of an encoded image from its header, without decoding it.
+    :return: The width and height.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+
+def reduction_for(size: Tuple[int, int], target: Tuple[int, int]) -> int:
+    """
+    :return: The largest JPEG scale denominator whose reduced image still covers {target}.
+    """
+    width, height = size
+    for scale in (8, 4, 2):
+        if width // scale >= target[0] and height // scale >= target[1]:
+            return scale
+    return 1
+
+
+def decode_image(data: Union[bytes, memoryview], target: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    """
+    Decode an encoded image once into an RGB array.
+    :param data: The JPEG or PNG bytes. They are wrapped, not copied.
+    :param target: The smallest size needed, or None for full resolution.
+        JPEG images are then decoded directly at a reduced resolution covering it.
+    :return: A contiguous HxWx3 uint8 RGB array.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    flag = cv2.IMREAD_COLOR
+    if target is not None and bytes(data[:2]) == b'\xff\xd8':
+        flag = REDUCED_FLAGS[reduction_for(image_size(data), target)]
+
+    image = cv2.imdecode(buffer, flag)
+    if image is None:
+        raise ValueError('Failed to load image.')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+
+class ImagePipeline:
+    """
+    Decodes each captured image once and shares the array between the preview and the analysis.
+    When nothing analyzes the frames, images are decoded at the reduced resolution the preview needs.
+    """
+    def __init__(self, preview_size: Tuple[int, int], analyze: bool = True):
+        """
+        :param preview_size: The size of the preview views.
+        :param analyze: Whether frames are analyzed, which needs them at full resolution.
+        """
+        self.preview_size = preview_size
+        self.analyze = analyze
+
+    def decode(self, data: Union[bytes, memoryview]) -> np.ndarray:
+        """
+        :param data: The encoded image.
+        :return: The RGB array for both the preview and the analysis.
+        """
+        return decode_image(data, None if self.analyze else self.preview_size)
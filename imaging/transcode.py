@@ -0,0 +1,73 @@
+from typing import Optional, Tuple, Union
+
+import cv2
+
+from imaging.pipeline import decode_image, image_size
+from interaction.byte_enum import EImageFormat
+from interaction.handshake import DisplayProfile
+
+EXTENSIONS = {
+    EImageFormat.JPEG: '.jpg',
+    EImageFormat.PNG: '.png',
+    EImageFormat.WEBP: '.webp',
+}
+"""The imencode extension of each image format."""
+
+
+def image_format(data: Union[bytes, memoryview]) -> Optional[EImageFormat]:
+    """
+    :return: The format of an encoded image told by its magic bytes, or None if it is unknown.
+    """
+    head = bytes(data[:12])
+    if head[:2] == b'\xff\xd8':
+        return EImageFormat.JPEG
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return EImageFormat.PNG
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return EImageFormat.WEBP
+    return None
+
+
+def fit(size: Tuple[int, int], bounds: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    :return: The largest size with the aspect ratio of {size} within {bounds}, never larger than {size}.
+        A bound of 0 leaves that dimension unbounded.
+    """
+    width, height = size
+    scale = 1.0
+    if bounds[0] > 0:
+        scale = min(scale, bounds[0] / width)
+    if bounds[1] > 0:
+        scale = min(scale, bounds[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def transcode(data: Union[bytes, memoryview], profile: DisplayProfile) -> Union[bytes, memoryview]:
+    """
+    Resize and re-encode an image for a display.
+    Images already in the format of the profile and within its resolution are returned as they are.
+    :param data: The encoded source image.
+    :param profile: The profile of the display.
+    :return: The encoded image.
+    """
+    size = image_size(data)
+    target = fit(size, (profile.width, profile.height))
+    if target == size and image_format(data) == profile.image_format:
+        return data
+
+    # large JPEG sources are decoded straight at a reduced scale
+    image = decode_image(data, target if target != size else None)
+    if (image.shape[1], image.shape[0]) != target:
+        image = cv2.resize(image, target, interpolation=cv2.INTER_AREA)
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+
+    if profile.image_format == EImageFormat.JPEG:
+        params = [cv2.IMWRITE_JPEG_QUALITY, profile.quality]
+    elif profile.image_format == EImageFormat.WEBP:
+        params = [cv2.IMWRITE_WEBP_QUALITY, profile.quality]
+    else:
+        params = []
+    ok, encoded = cv2.imencode(EXTENSIONS[profile.image_format], image, params)
+    if not ok:
+        raise ValueError(f'Failed to encode image as {profile.image_format.name}.')
+    return encoded.tobytes()
@@ -0,0 +1,396 @@
+import asyncio
+import time
+from concurrent.futures import Future
+from functools import partial
+from threading import Thread
+from typing import Callable, List, Optional, Set, Union
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.codec import FrameCodec
+from interaction.handshake import Handshake
+from interaction.keepalive import Heartbeat, enable_keepalive, resend
+from interaction.payload import materialize
+from interaction.pending import PendingRequest, PendingRequests
+from interaction.protocol import Interactor
+from interaction.stream import STREAM_REQUESTS, FileSink, StreamReceiver
+from monitoring.metrics import METRICS
+from storage.trace import INBOUND, OUTBOUND
+
+
+class AsyncInteractor:
+    """
+    An asyncio counterpart of Interactor.
+    It shares the frame format and handler callbacks with Interactor,
+    but runs as a task on an event loop instead of owning an OS thread.
+    """
+    def __init__(self,
+                 reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter,
+                 request_handler: Callable[[Bundle], Bundle],
+                 response_handler: Callable[[Bundle], None],
+                 on_disconnected: Optional[Callable[[], None]],
+                 padding: bool = True,
+                 stream_sink: Callable[[Bundle], object] = FileSink,
+                 heartbeat: bool = False,
+                 codec: Optional[FrameCodec] = None):
+        """
+        :param padding: Whether the client expects the legacy padding after each frame.
+        :param stream_sink: Makes the sink of each stream received from the client, see StreamReceiver.
+        :param heartbeat: Whether the client answers ANY_PING, so that it is pinged while idle, see Heartbeat.
+        :param codec: The framing of a client which negotiated protocol version 2, or None for version 1.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.request_handler = request_handler
+        self.response_handler = response_handler
+        self.on_disconnected = on_disconnected
+        self.padding = padding
+        self.heartbeat = heartbeat
+        self.codec = codec
+        self.last_bundle = None
+        self.pending = PendingRequests(Interactor.MAX_REQ_ID)
+        self.receiver = StreamReceiver(self.transmit, stream_sink)
+        self.loop = asyncio.get_running_loop()
+        self.task: Optional[asyncio.Task] = None
+        # set once the client is registered, to label its metrics and trace
+        self.device_id: Optional[str] = None
+        self.recorder = None
+        self.received_at = time.monotonic()
+        # the requests of a former session of the same device, sent again once this one runs
+        self.adopted: List[PendingRequest] = []
+
+    @staticmethod
+    async def recv_exactly(reader: asyncio.StreamReader,
+                           length: int,
+                           on_received: Optional[Callable[[], None]] = None) -> Optional[Union[bytes, bytearray]]:
+        """
+        Receive exactly {length} bytes from the stream.
+        :param reader: The stream to receive from.
+        :param length: The number of bytes to receive.
+        :param on_received: Called whenever part of them arrives, see protocol.recv_exactly.
+        :return: The bytes, or None if the peer closed the connection.
+        """
+        if on_received is None:
+            try:
+                return await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return None
+        data = bytearray(length)
+        received = 0
+        while received < length:
+            chunk = await reader.read(length - received)
+            if len(chunk) == 0:
+                return None
+            data[received:received + len(chunk)] = chunk
+            received += len(chunk)
+            on_received()
+        return data
+
+    @staticmethod
+    async def recv_frame(reader: asyncio.StreamReader,
+                         on_received: Optional[Callable[[], None]] = None) -> Optional[Union[bytes, bytearray]]:
+        """
+        Receive a single length-prefixed frame from the stream.
+        :param reader: The stream to receive from.
+        :param on_received: Called whenever part of the frame arrives, see protocol.recv_exactly.
+        :return: The frame without its length prefix, or None if the peer closed the connection.
+        """
+        header = await AsyncInteractor.recv_exactly(reader, 4, on_received)
+        if header is None:
+            return None
+        return await AsyncInteractor.recv_exactly(reader, int.from_bytes(header, byteorder='big'), on_received)
+
+    async def receive(self) -> Optional[Union[bytes, bytearray]]:
+        """
+        Receive a single frame, recording it in the metrics if they are enabled.
+        :return: The frame without its length prefix, or None if the peer closed the connection.
+        """
+        # a large frame from a slow client may take longer than Heartbeat.TIMEOUT to arrive
+        on_received = self.touch if self.heartbeat else None
+        if not METRICS.enabled:
+            return await AsyncInteractor.recv_frame(self.reader, on_received)
+
+        header = await AsyncInteractor.recv_exactly(self.reader, 4, on_received)
+        if header is None:
+            return None
+        # the wait for the length prefix is idle time, not receive time
+        received_at = time.perf_counter()
+        data = await AsyncInteractor.recv_exactly(self.reader, int.from_bytes(header, byteorder='big'), on_received)
+        if data is None:
+            return None
+        if len(data) >= Bundle.HEADER.size:
+            METRICS.received(self.device_id, ERequest.from_int(data[1]), len(data) + 4,
+                             time.perf_counter() - received_at)
+        return data
+
+    def touch(self) -> None:
+        """
+        Note that bytes arrived from the client, so that the heartbeat doesn't take it for dead mid-frame.
+        :return: None
+        """
+        self.received_at = time.monotonic()
+
+    def start(self) -> asyncio.Task:
+        """
+        Schedule the receiving routine on the event loop.
+        :return: The task running this interactor.
+        """
+        self.task = self.loop.create_task(self.run())
+        return self.task
+
+    async def run(self) -> None:
+        """
+        Main routine for this interactor.
+        :return: None
+        """
+        self.received_at = time.monotonic()
+        if self.heartbeat:
+            Heartbeat.instance().watch(self)
+        if len(self.adopted) > 0:
+            resend(self, self.adopted)
+            self.adopted = []
+        try:
+            while True:
+                data = await self.receive()
+                if data is None or len(data) == 0:
+                    break
+
+                self.received_at = time.monotonic()
+                try:
+                    data = memoryview(data)
+                    bundle = Bundle.from_bytes(data) if self.codec is None else FrameCodec.decode(data)
+                except ValueError as e:
+                    print(f'Interactor: invalid frame from {self.device_id}, {e}')
+                    break
+                if self.recorder is not None:
+                    self.recorder.record(INBOUND, self.device_id, bundle)
+                if bundle.request in STREAM_REQUESTS:
+                    # this side never streams, so acknowledgements are not expected
+                    if bundle.response == EResponse.ACK:
+                        continue
+                    bundle = self.receiver.feed(bundle)
+                    if bundle is None:
+                        continue
+
+                if bundle.request_id == Interactor.CLIENT_REQ_ID:
+                    # handle it if it's a request
+                    if bundle.request == ERequest.ANY_AGAIN:
+                        if self.last_bundle is not None:
+                            self.send_bundle(self.last_bundle)
+                            self.last_bundle = None
+                    elif bundle.request == ERequest.ANY_PING:
+                        bundle.response = EResponse.ACK
+                        self.transmit(bundle)
+                    else:
+                        self.send_bundle(self.request_handler(bundle))
+                else:
+                    self.pending.resolve(bundle)
+                    if self.response_handler is not None and bundle.request != ERequest.ANY_PING:
+                        self.response_handler(bundle)
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if self.heartbeat:
+                Heartbeat.instance().unwatch(self)
+            self.writer.close()
+            self.receiver.abort_all()
+            self.pending.fail_all(ConnectionError('Disconnected.'))
+            if self.on_disconnected is not None:
+                self.on_disconnected()
+
+    def request(self, bundle: Bundle, timeout: Optional[float] = None) -> Future:
+        """
+        Send a request with specified request ID.
+        This is safe to call from any thread.
+        :param bundle: The request bundle. A free request ID is allocated if its request ID is None.
+        :param timeout: Seconds to wait for the response, or None to wait forever.
+        :return: A future which resolves to the response bundle. Wrap it with asyncio.wrap_future to await it.
+        """
+        future = Interactor.add_pending(self.pending, bundle, timeout)
+        if METRICS.enabled:
+            METRICS.track(future, self.device_id, bundle.request)
+        self.call_soon(self.send_bundle, bundle)
+        return future
+
+    def ping(self, timeout: Optional[float] = None) -> Optional[Future]:
+        """
+        Send ANY_PING. Sends are only queued on the transport, so it never waits behind another one.
+        This is safe to call from any thread.
+        :param timeout: Seconds to wait for the response, or None to wait forever.
+        :return: The future of the response.
+        """
+        return self.request(Bundle(None, ERequest.ANY_PING), timeout)
+
+    def send_bundle(self, bundle: Bundle) -> None:
+        """
+        Queue a bundle on the transport as a single length-prefixed frame.
+        Must be called on the event loop thread.
+        :param bundle: The bundle to send.
+        :return: None
+        """
+        self.last_bundle = bundle
+        self.transmit(bundle)
+
+    def transmit(self, bundle: Bundle) -> None:
+        """
+        Queue a bundle on the transport without remembering it for ANY_AGAIN.
+        Must be called on the event loop thread.
+        :param bundle: The bundle to send.
+        :return: None
+        """
+        buffers = [materialize(buffer) for buffer in Interactor.frame(bundle, self.padding, self.codec)]
+        if self.recorder is not None:
+            self.recorder.record(OUTBOUND, self.device_id, bundle)
+        self.writer.writelines(buffers)
+        if METRICS.enabled:
+            METRICS.sent(self.device_id, bundle.request, sum(len(buffer) for buffer in buffers))
+
+    def adopt(self, entries: List[PendingRequest]) -> None:
+        """
+        Take over the requests a former session of the same device left unanswered.
+        They are sent again once this interactor runs, see resend.
+        :return: None
+        """
+        self.adopted.extend(entries)
+
+    def call_soon(self, callback: Callable, *args) -> None:
+        """
+        Run {callback} on the event loop, directly if already on it.
+        :return: None
+        """
+        try:
+            running = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            running = False
+
+        if running:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def interrupt(self) -> None:
+        """
+        Cancel the receiving routine and close the connection.
+        This is safe to call from any thread.
+        :return: None
+        """
+        if self.task is not None:
+            self.call_soon(self.task.cancel)
+
+
+class AsyncServer(Thread):
+    """
+    A host server serving every client on one asyncio event loop.
+    The loop runs on this thread so that blocking front ends (the console, the Qt window)
+    can use it as they use the listener thread. {serve} may also be awaited on an existing loop.
+    """
+    HANDSHAKE_TIMEOUT = 10.0
+
+    def __init__(self,
+                 port: int,
+                 request_handler: Callable[[Bundle], Bundle],
+                 response_handler: Callable[[Bundle], None],
+                 on_handshake: Callable[[Handshake, AsyncInteractor], EResponse],
+                 on_disconnected: Callable[[AsyncInteractor], None],
+                 host: str = '0.0.0.0'):
+        """
+        :param port: The port to listen on.
+        :param request_handler: Handles requests from clients, as for Interactor.
+        :param response_handler: Handles responses from clients, as for Interactor.
+        :param on_handshake: Evaluates the role of a new client. The client is served only if this returns OK.
+        :param on_disconnected: Is called with the interactor of an accepted client once it disconnects.
+        :param host: The address to bind.
+        """
+        super(AsyncServer, self).__init__(daemon=True)
+
+        self.host = host
+        self.port = port
+        self.request_handler = request_handler
+        self.response_handler = response_handler
+        self.on_handshake = on_handshake
+        self.on_disconnected = on_disconnected
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.task: Optional[asyncio.Task] = None
+        self.clients: Set[AsyncInteractor] = set()
+
+    def run(self) -> None:
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        """
+        Accept and serve clients until cancelled.
+        Cancelling it closes the listening socket and every client connection.
+        :return: None
+        """
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        server = await asyncio.start_server(self.accept, self.host, self.port)
+        print('Listen: Start listening')
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            tasks = [client.task for client in self.clients if client.task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address = writer.get_extra_info('peername')
+        print(f'Listen: accept, {address}')
+        client_socket = writer.get_extra_info('socket')
+        if client_socket is not None:
+            enable_keepalive(client_socket)
+        try:
+            data = await asyncio.wait_for(AsyncInteractor.recv_frame(reader), AsyncServer.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            data = None
+        if data is None or len(data) < 3:
+            print(f'Listen: invalid handshake, {address}')
+            writer.close()
+            return
+
+        try:
+            bundle = Bundle.from_bytes(memoryview(data))
+        except ValueError as e:
+            print(f'Listen: invalid handshake, {address}, {e}')
+            writer.close()
+            return
+        handshake = Handshake.from_bundle(bundle)
+        client = AsyncInteractor(reader, writer,
+                                 self.request_handler,
+                                 self.response_handler,
+                                 None,
+                                 padding=handshake.padding,
+                                 heartbeat=handshake.heartbeat,
+                                 codec=handshake.frame_codec)
+        client.on_disconnected = partial(self.disconnected, client)
+
+        # requests to the registered client only run on the loop once this returns, after the reply is queued
+        bundle.response = self.on_handshake(handshake, client)
+        # only clients which sent handshake fields expect a reply
+        if handshake.negotiated:
+            writer.writelines(Interactor.frame(handshake.reply(bundle.response), handshake.padding))
+        if bundle.response == EResponse.OK:
+            self.clients.add(client)
+            client.start()
+        else:
+            writer.close()
+
+    def disconnected(self, client: AsyncInteractor) -> None:
+        self.clients.discard(client)
+        self.on_disconnected(client)
+
+    def interrupt(self) -> None:
+        """
+        Stop serving and disconnect every client.
+        This is safe to call from any thread.
+        :return: None
+        """
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
@@ -1,14 +1,27 @@
+import struct
+from typing import Optional, Union
+
 from interaction.byte_enum import ERequest, EResponse
+from interaction.payload import Payload, materialize
 
 
 class Bundle:
     """
     A bundle for interaction with clients.
+    {args} may be bytes, a memoryview (e.g. over a receive buffer or an mmap) or a FilePayload;
+    it is only turned into bytes when {view} or {bytes} asks for it.
     """
+    __slots__ = ('request_id', 'request', 'args', 'response')
+
+    HEADER = struct.Struct('>BBB')
+    """Codec of the header: request ID, request and response."""
+    FRAME_HEADER = struct.Struct('>IBBB')
+    """Codec of the length prefix of a frame followed by the header."""
+
     def __init__(self,
-                 request_id: int,
+                 request_id: Optional[int],
                  request: ERequest,
-                 args: bytes = b'',
+                 args: Payload = b'',
                  response: EResponse = EResponse.NONE):
         self.request_id = request_id
         self.request = request
@@ -21,15 +34,30 @@ class Bundle:
         """
         return self.__bytes__()
 
+    def header(self) -> bytes:
+        """
+        :return: Serialize the header of this bundle, everything but {args}.
+        """
+        return Bundle.HEADER.pack(self.request_id, self.request.value, self.response.value)
+
+    def frame_header(self) -> bytes:
+        """
+        :return: Serialize the length prefix of the frame of this bundle together with its header.
+        """
+        return Bundle.FRAME_HEADER.pack(Bundle.HEADER.size + len(self.args),
+                                        self.request_id, self.request.value, self.response.value)
+
+    def view(self) -> Union[bytes, bytearray, memoryview]:
+        """
+        :return: {args} as a bytes-like object. File-backed payloads are memory-mapped, not read.
+        """
+        return materialize(self.args)
+
     def __bytes__(self):
         """
         :return: Serialize this bundle into byte array.
         """
-        return b''.join([
-            bytes([self.request_id]),
-            self.request.bytes(),
-            self.response.bytes(),
-            self.args])
+        return b''.join([self.header(), self.view()])
 
     def __str__(self):
         """
@@ -43,18 +71,50 @@ class Bundle:
                     self.response.int()])
 
     def __iter__(self):
-        return iter([self.request_id, self.request, self.args, self.response])
+        return iter((self.request_id, self.request, self.args, self.response))
 
     @staticmethod
-    def from_bytes(data: bytes):
+    def from_bytes(data: Union[bytes, memoryview]):
         """
         Deserialize a byte array into a bundle instance.
+        If {data} is a memoryview, {args} becomes a view over it without copying the payload.
         :param data:
         :return:
+        :raise ValueError: if {data} is shorter than the header, or its request or response is unknown.
         """
+        if len(data) < Bundle.HEADER.size:
+            raise ValueError('Truncated frame.')
+        request_id, request_value, response_value = Bundle.HEADER.unpack_from(data)
+        # looked up inline rather than through decode_request, since this runs for every frame
+        request = ERequest.from_int(request_value)
+        if request is None:
+            raise ValueError(f'Unknown request {request_value}.')
+        response = EResponse.from_int(response_value)
+        if response is None:
+            raise ValueError(f'Unknown response {response_value}.')
         return Bundle(
-            data[0],
-            ERequest.from_bytes(data[1:2]),
-            args=data[3:],
-            response=EResponse.from_bytes(data[2:3])
+            request_id,
+            request,
+            args=data[Bundle.HEADER.size:],
+            response=response
         )
+
+    @staticmethod
+    def decode_request(value: int) -> ERequest:
+        """
+        :raise ValueError: if {value} is not a request.
+        """
+        request = ERequest.from_int(value)
+        if request is None:
+            raise ValueError(f'Unknown request {value}.')
+        return request
+
+    @staticmethod
+    def decode_response(value: int) -> EResponse:
+        """
+        :raise ValueError: if {value} is not a response.
+        """
+        response = EResponse.from_int(value)
+        if response is None:
+            raise ValueError(f'Unknown response {value}.')
+        return response
@@ -1,4 +1,7 @@
 from enum import Enum, EnumMeta
+from typing import Dict, List, Optional
+
+_DECODE_TABLES: Dict[EnumMeta, List[Optional['ByteEnum']]] = {}
 
 
 class ByteEnum(Enum):
@@ -17,11 +20,30 @@ class ByteEnum(Enum):
 
     @staticmethod
     def from_bytes(data: bytes, enum: EnumMeta):
-        data = int(data[0])
+        return ByteEnum.from_int(data[0], enum)
+
+    @staticmethod
+    def from_int(value: int, enum: EnumMeta):
+        """
+        Look up the element of {enum} whose value is {value}.
+        :return: The element, or None if there is no such element.
+        """
+        table = _DECODE_TABLES.get(enum)
+        if table is None:
+            table = ByteEnum.decode_table(enum)
+        return table[value]
+
+    @staticmethod
+    def decode_table(enum: EnumMeta) -> List[Optional['ByteEnum']]:
+        """
+        Build the 256-entry table mapping each byte value to its element of {enum}.
+        :return: The table, which is cached for later lookups.
+        """
+        table = [None] * 256
         for v in enum:
-            if v.int() == data:
-                return v
-        return None
+            table[v.int()] = v
+        _DECODE_TABLES[enum] = table
+        return table
 
 
 class ERequest(ByteEnum):
@@ -47,28 +69,49 @@ class ERequest(ByteEnum):
     """Request to make display to take a picture."""
     DISPLAY_SHOW_PICTURE = DISPLAY | 0x20
     """Request to make display to display an image."""
+    DISPLAY_SHOW_CACHED_PICTURE = DISPLAY | 0x30
+    """Request to make display to display an image it holds, named by the SHA-256 digest in the args.
+    The display answers OK if it holds the image and REJECT otherwise."""
 
     ANY_QUIT = ANY | 0x10
     """Request to terminate connection."""
     ANY_AGAIN = ANY | 0x20
     """Request to get the last bundle again."""
+    ANY_STREAM_BEGIN = ANY | 0x30
+    """Starts a chunked stream carrying the args of a large bundle."""
+    ANY_STREAM_CHUNK = ANY | 0x40
+    """Carries the next chunk of a stream, or acknowledges received chunks if its response is ACK."""
+    ANY_STREAM_END = ANY | 0x50
+    """Ends a chunked stream."""
+    ANY_PING = ANY | 0x60
+    """A heartbeat, answered with ACK, which both ends may send to a peer with the HEARTBEAT capability."""
 
     def is_for(self, request):
-        value = request.int()
-        return (self.int() & value) == value
+        value = request.value
+        return (self.value & value) == value
 
     def is_for_camera(self):
-        return self.is_for(ERequest.CAMERA)
+        return self in _CAMERA_REQUESTS
 
     def is_for_display(self):
-        return self.is_for(ERequest.DISPLAY)
+        return self in _DISPLAY_REQUESTS
 
     def is_for_any(self):
-        return self.is_for(ERequest.ANY)
+        return self in _ANY_REQUESTS
 
     @staticmethod
     def from_bytes(data: bytes, enum: EnumMeta = None):
-        return ByteEnum.from_bytes(data, ERequest)
+        return ByteEnum.from_int(data[0], ERequest)
+
+    @staticmethod
+    def from_int(value: int, enum: EnumMeta = None):
+        return ByteEnum.from_int(value, ERequest)
+
+
+# masks of ERequest.is_for_* computed once instead of on each dispatch
+_CAMERA_REQUESTS = frozenset(v for v in ERequest if v.is_for(ERequest.CAMERA))
+_DISPLAY_REQUESTS = frozenset(v for v in ERequest if v.is_for(ERequest.DISPLAY))
+_ANY_REQUESTS = frozenset(v for v in ERequest if v.is_for(ERequest.ANY))
 
 
 class EResponse(ByteEnum):
@@ -88,4 +131,74 @@ class EResponse(ByteEnum):
 
     @staticmethod
     def from_bytes(data: bytes, enum: EnumMeta = None):
-        return ByteEnum.from_bytes(data, EResponse)
+        return ByteEnum.from_int(data[0], EResponse)
+
+    @staticmethod
+    def from_int(value: int, enum: EnumMeta = None):
+        return ByteEnum.from_int(value, EResponse)
+
+
+class EHandshakeField(ByteEnum):
+    """
+    An enum class to represent optional fields of the role handshake.
+    """
+    NONE = 0
+    """An empty enum instance."""
+    CAPABILITIES = 0x01
+    """Capability flags supported by the client."""
+    DEVICE_ID = 0x02
+    """A UTF-8 name identifying the client device across connections."""
+    DISPLAY_PROFILE = 0x03
+    """The screen width and height (u16 each), preferred image format and quality (u8 each) of a display."""
+    VERSION = 0x04
+    """The newest protocol version (u8) the client speaks. Clients which don't send it speak version 1."""
+    CODECS = 0x05
+    """The compression codecs (u8 each) the client can decode, in order of preference.
+    The reply carries the one the host chose."""
+
+    @staticmethod
+    def from_bytes(data: bytes, enum: EnumMeta = None):
+        return ByteEnum.from_int(data[0], EHandshakeField)
+
+    @staticmethod
+    def from_int(value: int, enum: EnumMeta = None):
+        return ByteEnum.from_int(value, EHandshakeField)
+
+
+class ECodec(ByteEnum):
+    """
+    An enum class to represent the compression of the args of a frame.
+    """
+    NONE = 0
+    """The args are sent as they are."""
+    ZLIB = 0x01
+    ZSTD = 0x02
+    LZ4 = 0x03
+    """LZ4 frame format."""
+
+    @staticmethod
+    def from_bytes(data: bytes, enum: EnumMeta = None):
+        return ByteEnum.from_int(data[0], ECodec)
+
+    @staticmethod
+    def from_int(value: int, enum: EnumMeta = None):
+        return ByteEnum.from_int(value, ECodec)
+
+
+class EImageFormat(ByteEnum):
+    """
+    An enum class to represent image encodings displays accept.
+    """
+    NONE = 0
+    """An empty enum instance."""
+    JPEG = 0x01
+    PNG = 0x02
+    WEBP = 0x03
+
+    @staticmethod
+    def from_bytes(data: bytes, enum: EnumMeta = None):
+        return ByteEnum.from_int(data[0], EImageFormat)
+
+    @staticmethod
+    def from_int(value: int, enum: EnumMeta = None):
+        return ByteEnum.from_int(value, EImageFormat)
@@ -0,0 +1,158 @@
+"""
+Compression of the args of frames exchanged with clients which negotiated protocol version 2.
+
+A version 2 frame has one more byte after the header, the codec its args are compressed with:
+    length (u32), request ID (u8), request (u8), response (u8), codec (u8), args
+The codec is chosen frame by frame from the args: pictures already compressed (JPEG, WebP) and small args
+are sent as they are, PNG is compressed at the fastest level since deflate already went over it,
+and anything else, e.g. raw frames, at the default level. Compressed args are only sent if they are
+at least {FrameCodec.MIN_SAVING} smaller.
+zstd and LZ4 are offered when zstandard and lz4 are installed; zlib is always available.
+"""
+import struct
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ECodec
+from interaction.payload import Payload, materialize
+
+PROTOCOL_VERSION = 2
+"""The newest protocol version the host speaks."""
+CODEC_VERSION = 2
+"""The first protocol version whose frames carry a codec byte."""
+
+HEADER = struct.Struct('>BBBB')
+"""Codec of the header of a version 2 frame: request ID, request, response and codec."""
+FRAME_HEADER = struct.Struct('>IBBBB')
+"""Codec of the length prefix of a version 2 frame followed by its header."""
+
+NO_COMPRESSION = 0
+FAST_COMPRESSION = 1
+DEFAULT_COMPRESSION = 2
+
+Compress = Callable[[Payload, bool], bytes]
+"""Compresses args, at the fastest level if asked."""
+Decompress = Callable[[Payload], bytes]
+
+COMPRESSORS: Dict[ECodec, Tuple[Compress, Decompress]] = {
+    ECodec.ZLIB: (lambda data, fast: zlib.compress(data, 1 if fast else 6), zlib.decompress),
+}
+if zstandard is not None:
+    COMPRESSORS[ECodec.ZSTD] = (lambda data, fast: zstandard.compress(data, 1 if fast else 3), zstandard.decompress)
+if lz4 is not None:
+    COMPRESSORS[ECodec.LZ4] = (lambda data, fast: lz4.frame.compress(data), lz4.frame.decompress)
+
+PREFERENCE = (ECodec.ZSTD, ECodec.LZ4, ECodec.ZLIB)
+"""The codecs the host offers, best first."""
+
+
+def supported_codecs() -> Tuple[ECodec, ...]:
+    """
+    :return: The codecs available on this host, best first.
+    """
+    return tuple(codec for codec in PREFERENCE if codec in COMPRESSORS)
+
+
+def choose_codec(offered: Sequence[ECodec]) -> ECodec:
+    """
+    :param offered: The codecs a client can decode, in its order of preference.
+    :return: The first of them available on this host, or NONE.
+    """
+    return next((codec for codec in offered if codec in COMPRESSORS), ECodec.NONE)
+
+
+def compression_for(args: Payload) -> int:
+    """
+    :return: How the args should be compressed, judging by what they start with.
+    """
+    head = bytes(materialize(args)[:12])
+    if head[:2] == b'\xff\xd8' or (head[:4] == b'RIFF' and head[8:12] == b'WEBP'):
+        return NO_COMPRESSION
+    if head[:4] == b'\x89PNG':
+        return FAST_COMPRESSION
+    return DEFAULT_COMPRESSION
+
+
+class FrameCodec:
+    """
+    Frames bundles for a connection which negotiated protocol version 2, compressing their args with {codec}.
+    """
+    MIN_SIZE = 1024
+    """Args smaller than this are never compressed."""
+    MIN_SAVING = 0.05
+
+    def __init__(self, codec: ECodec = ECodec.NONE):
+        """
+        :param codec: The codec the peer chose, or NONE to only send args as they are.
+        """
+        self.codec = codec
+        self.compress: Optional[Compress] = COMPRESSORS[codec][0] if codec != ECodec.NONE else None
+
+    def compression(self, args: Payload) -> int:
+        """
+        :return: How the args would be compressed, e.g. to compress every chunk of a stream alike.
+        """
+        if self.compress is None or len(args) < FrameCodec.MIN_SIZE:
+            return NO_COMPRESSION
+        return compression_for(args)
+
+    def encode(self, args: Payload, compression: Optional[int] = None) -> Tuple[ECodec, Payload]:
+        """
+        :param args: The args to send.
+        :param compression: How to compress them, or None to choose from the args.
+        :return: The codec applied and the args to send, which are {args} themselves if not compressed.
+        """
+        if compression is None:
+            compression = self.compression(args)
+        if compression == NO_COMPRESSION or self.compress is None or len(args) < FrameCodec.MIN_SIZE:
+            return ECodec.NONE, args
+        data = materialize(args)
+        compressed = self.compress(data, compression == FAST_COMPRESSION)
+        if len(compressed) > len(data) * (1 - FrameCodec.MIN_SAVING):
+            return ECodec.NONE, args
+        return self.codec, compressed
+
+    def frame(self, bundle: Bundle, compression: Optional[int] = None) -> List[Payload]:
+        """
+        Split a bundle into the buffers of its version 2 frame.
+        :param compression: How to compress the args, or None to choose from the args.
+        :return: The buffers to send in order.
+        """
+        codec, args = self.encode(bundle.args, compression)
+        return [FRAME_HEADER.pack(HEADER.size + len(args),
+                                  bundle.request_id, bundle.request.value, bundle.response.value, codec.value),
+                args]
+
+    @staticmethod
+    def decode(data: memoryview) -> Bundle:
+        """
+        Parse a version 2 frame. Args which weren't compressed stay a view over {data}.
+        :param data: The frame without its length prefix.
+        :return: The bundle with its args decompressed.
+        :raise ValueError: if the frame is truncated, its request or response is unknown,
+            or it is compressed with a codec this host lacks or wrongly.
+        """
+        if len(data) < HEADER.size:
+            raise ValueError('Truncated frame.')
+        request_id, request, response, value = HEADER.unpack_from(data)
+        request, response = Bundle.decode_request(request), Bundle.decode_response(response)
+        args = data[HEADER.size:]
+        codec = ECodec.from_int(value)
+        if codec != ECodec.NONE:
+            if codec not in COMPRESSORS:
+                raise ValueError(f'Unsupported codec {value}.')
+            try:
+                args = COMPRESSORS[codec][1](args)
+            except Exception as e:
+                raise ValueError(f'Corrupt {codec.name} args, {e}')
+        return Bundle(request_id, request, args, response)
@@ -0,0 +1,193 @@
+import struct
+from typing import Dict, NamedTuple, Optional
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ECodec, EHandshakeField, EImageFormat, EResponse
+from interaction.codec import CODEC_VERSION, PROTOCOL_VERSION, FrameCodec, choose_codec
+
+DISPLAY_PROFILE = struct.Struct('>HHBB')
+"""Codec of the DISPLAY_PROFILE field: width, height, image format and quality."""
+
+
+class DisplayProfile(NamedTuple):
+    """
+    What a display wants pictures encoded as. A width or height of 0 leaves that dimension unbounded.
+    """
+    width: int
+    height: int
+    image_format: EImageFormat
+    quality: int
+    """The encoder quality from 1 to 100, for lossy formats."""
+
+
+DEFAULT_DISPLAY_PROFILE = DisplayProfile(0, 0, EImageFormat.JPEG, 90)
+"""The profile of displays which don't report one: JPEG at the resolution of the source."""
+
+
+class Handshake:
+    """
+    Optional fields a client appends to its role bundle.
+    The fields are encoded in {args} as a sequence of (field, length, value) triples.
+    Old clients send a bare role bundle; they get no reply and keep the legacy framing.
+    Clients which send VERSION and CODECS and get version 2 back use the frames of FrameCodec
+    from the frame after the reply on, in both directions.
+    """
+    NO_PADDING = 0x01
+    """Capability flag of clients which don't expect padding after each frame."""
+    STREAMING = 0x02
+    """Capability flag of clients which accept large payloads as chunked streams."""
+
+    IMAGE_CACHE = 0x04
+    """Capability flag of displays which keep shown images by digest for DISPLAY_SHOW_CACHED_PICTURE."""
+
+    HEARTBEAT = 0x08
+    """Capability flag of clients which answer ANY_PING, so that a silent client can be told from a dead one."""
+
+    SUPPORTED_CAPABILITIES = NO_PADDING | STREAMING | IMAGE_CACHE | HEARTBEAT
+    """Capability flags the host is able to honor."""
+
+    def __init__(self, bundle: Bundle, fields: Optional[Dict[EHandshakeField, bytes]] = None):
+        self.bundle = bundle
+        self.fields = fields if fields is not None else {}
+
+        value = self.fields.get(EHandshakeField.DEVICE_ID, b'')
+        self.device_id: Optional[str] = value.decode('utf-8', errors='replace') if len(value) > 0 else None
+        """The device ID proposed by the client, replaced by the one it is registered with once accepted."""
+
+    @property
+    def role(self):
+        return self.bundle.request
+
+    @property
+    def negotiated(self) -> bool:
+        """
+        :return: True if the client sent any handshake field and expects a reply.
+        """
+        return len(self.fields) > 0
+
+    @property
+    def capabilities(self) -> int:
+        """
+        :return: Capability flags both the client and the host support.
+        """
+        value = self.fields.get(EHandshakeField.CAPABILITIES, b'\x00')
+        return (value[0] if len(value) > 0 else 0) & Handshake.SUPPORTED_CAPABILITIES
+
+    @property
+    def padding(self) -> bool:
+        """
+        :return: True if the client still expects the legacy padding after each frame.
+        """
+        return not self.capabilities & Handshake.NO_PADDING
+
+    @property
+    def streaming(self) -> bool:
+        """
+        :return: True if the client accepts chunked streams.
+        """
+        return bool(self.capabilities & Handshake.STREAMING)
+
+    @property
+    def heartbeat(self) -> bool:
+        """
+        :return: True if the client answers ANY_PING.
+        """
+        return bool(self.capabilities & Handshake.HEARTBEAT)
+
+    @property
+    def image_cache(self) -> bool:
+        """
+        :return: True if the client keeps shown images by digest.
+        """
+        return bool(self.capabilities & Handshake.IMAGE_CACHE)
+
+    @property
+    def version(self) -> int:
+        """
+        :return: The protocol version both the client and the host speak.
+        """
+        value = self.fields.get(EHandshakeField.VERSION, b'')
+        return min(value[0], PROTOCOL_VERSION) if len(value) > 0 else 1
+
+    @property
+    def codec(self) -> ECodec:
+        """
+        :return: The codec to compress args with, the first the client offered which the host has, or NONE.
+        """
+        if self.version < CODEC_VERSION:
+            return ECodec.NONE
+        offered = (ECodec.from_int(value) for value in self.fields.get(EHandshakeField.CODECS, b''))
+        return choose_codec([codec for codec in offered if codec is not None])
+
+    @property
+    def frame_codec(self) -> Optional[FrameCodec]:
+        """
+        :return: The framing of the connection after the reply, or None for the framing of version 1.
+        """
+        return FrameCodec(self.codec) if self.version >= CODEC_VERSION else None
+
+    @property
+    def display_profile(self) -> DisplayProfile:
+        """
+        :return: The profile reported by a display, or the default one.
+        """
+        value = self.fields.get(EHandshakeField.DISPLAY_PROFILE, b'')
+        if len(value) < DISPLAY_PROFILE.size:
+            return DEFAULT_DISPLAY_PROFILE
+        width, height, image_format, quality = DISPLAY_PROFILE.unpack_from(value)
+        image_format = EImageFormat.from_int(image_format)
+        if image_format is None or image_format == EImageFormat.NONE:
+            image_format = DEFAULT_DISPLAY_PROFILE.image_format
+        return DisplayProfile(width, height, image_format, min(max(quality, 1), 100))
+
+    def reply(self, response: EResponse) -> Bundle:
+        """
+        Build the reply for a negotiated handshake.
+        :param response: The response for the proposed role.
+        :return: The reply bundle carrying the accepted fields.
+        """
+        fields = {EHandshakeField.CAPABILITIES: bytes([self.capabilities])}
+        if self.device_id is not None:
+            fields[EHandshakeField.DEVICE_ID] = self.device_id.encode('utf-8')
+        if EHandshakeField.VERSION in self.fields:
+            fields[EHandshakeField.VERSION] = bytes([self.version])
+            fields[EHandshakeField.CODECS] = self.codec.bytes()
+        return Bundle(self.bundle.request_id,
+                      self.bundle.request,
+                      Handshake.encode_fields(fields),
+                      response)
+
+    @staticmethod
+    def encode_fields(fields: Dict[EHandshakeField, bytes]) -> bytes:
+        """
+        Serialize handshake fields into byte array.
+        :param fields: The field values.
+        :return: The serialized fields.
+        """
+        data = bytearray()
+        for field, value in fields.items():
+            if len(value) > 255:
+                raise ValueError(f'Handshake field {field} is too long.')
+            data += bytes([field.int(), len(value)])
+            data += value
+        return bytes(data)
+
+    @staticmethod
+    def from_bundle(bundle: Bundle):
+        """
+        Parse handshake fields out of a role bundle.
+        Unknown fields are skipped so that newer clients can talk to this host.
+        :param bundle: The role bundle sent by the client.
+        :return: The handshake instance.
+        """
+        fields = {}
+        args = bundle.args
+        offset = 0
+        while offset + 2 <= len(args):
+            field = EHandshakeField.from_bytes(args[offset:offset + 1])
+            length = args[offset + 1]
+            value = bytes(args[offset + 2:offset + 2 + length])
+            offset += 2 + length
+            if field is not None and field != EHandshakeField.NONE:
+                fields[field] = value
+        return Handshake(bundle, fields)
@@ -0,0 +1,185 @@
+"""
+Detection of clients which dropped off the network without closing their connection.
+
+Every accepted socket gets TCP keepalive, so that the kernel finds a dead peer within
+KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT seconds even for legacy clients.
+Clients with the HEARTBEAT capability are also pinged with ANY_PING once idle for {Heartbeat.INTERVAL},
+and disconnected once nothing arrived from them for {Heartbeat.TIMEOUT}, whatever the kernel thinks.
+"""
+import socket
+import time
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest
+from interaction.pending import PendingRequest
+
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+USER_TIMEOUT = 30
+"""Seconds sent data may stay unacknowledged before the connection is dropped, where the platform supports it."""
+
+REPLAYABLE = frozenset({ERequest.CAMERA_TAKE_PICTURE,
+                        ERequest.DISPLAY_TAKE_PICTURE,
+                        ERequest.DISPLAY_SHOW_PICTURE,
+                        ERequest.DISPLAY_SHOW_CACHED_PICTURE})
+"""Requests which are safe to send again to a device which reconnected before answering them."""
+
+
+def enable_keepalive(client) -> None:
+    """
+    Turn on TCP keepalive on an accepted socket. Options the platform lacks are skipped.
+    :param client: The socket, or the socket of an asyncio transport.
+    :return: None
+    """
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    options = (('TCP_KEEPIDLE', KEEPALIVE_IDLE),
+               # the name of TCP_KEEPIDLE on macOS
+               ('TCP_KEEPALIVE', KEEPALIVE_IDLE),
+               ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+               ('TCP_KEEPCNT', KEEPALIVE_COUNT),
+               ('TCP_USER_TIMEOUT', USER_TIMEOUT * 1000))
+    for name, value in options:
+        option = getattr(socket, name, None)
+        if option is None:
+            continue
+        try:
+            client.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError:
+            pass
+
+
+def settle(future: Future, result=None, error: Optional[BaseException] = None) -> None:
+    """
+    Complete {future} unless it is already done.
+    :return: None
+    """
+    if future.done():
+        return
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except Exception:
+        # it was completed by another thread in between
+        pass
+
+
+def forward(source: Future, target: Future) -> None:
+    """
+    Complete {target} as {source} completes.
+    :return: None
+    """
+    def done(_: Future) -> None:
+        if source.cancelled():
+            target.cancel()
+            return
+        error = source.exception()
+        settle(target, None if error is not None else source.result(), error)
+    source.add_done_callback(done)
+
+
+def resend(handler, entries: List[PendingRequest]) -> None:
+    """
+    Send again on {handler} the requests a former session of its device left unanswered.
+    The futures the callers hold complete with the new responses. Requests which aren't REPLAYABLE,
+    e.g. toggling the torch, fail with ConnectionError instead, as do those whose deadline passed.
+    :param handler: The Interactor or AsyncInteractor of the new session.
+    :param entries: The requests taken from the former session.
+    :return: None
+    """
+    now = time.monotonic()
+    for entry in entries:
+        if entry.future.done():
+            continue
+        if entry.bundle.request not in REPLAYABLE:
+            settle(entry.future, error=ConnectionError('The session was taken over.'))
+            continue
+        timeout = entry.deadline - now if entry.deadline is not None else None
+        if timeout is not None and timeout <= 0:
+            settle(entry.future, error=TimeoutError(f'Request {entry.bundle.request_id} timed out.'))
+            continue
+        try:
+            future = handler.request(Bundle(None, entry.bundle.request, entry.bundle.args), timeout)
+        except (OSError, RuntimeError, ValueError) as e:
+            settle(entry.future, error=e)
+            continue
+        forward(future, entry.future)
+
+
+class Heartbeat(Thread):
+    """
+    A single daemon thread pinging the watched handlers which went idle and disconnecting the silent ones.
+    A handler is an Interactor or an AsyncInteractor; both have {received_at}, {ping} and {interrupt}.
+    An Interactor which is busy sending is not pinged until it is done.
+    """
+    INTERVAL = 5.0
+    """Seconds without receiving anything before a client is pinged."""
+    TIMEOUT = 15.0
+    """Seconds without receiving anything before a client is taken for dead."""
+    CHECK_INTERVAL = 1.0
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.lock = Lock()
+        # the time each handler was last pinged at
+        self.handlers: Dict[object, float] = {}
+        self.stop_event = Event()
+
+    @staticmethod
+    def instance():
+        with Heartbeat._instance_lock:
+            if Heartbeat._instance is None:
+                Heartbeat._instance = Heartbeat()
+                Heartbeat._instance.start()
+            return Heartbeat._instance
+
+    def watch(self, handler) -> None:
+        with self.lock:
+            self.handlers[handler] = 0.0
+
+    def unwatch(self, handler) -> None:
+        with self.lock:
+            self.handlers.pop(handler, None)
+
+    def run(self) -> None:
+        while not self.stop_event.wait(Heartbeat.CHECK_INTERVAL):
+            self.check(time.monotonic())
+
+    def check(self, now: float) -> None:
+        """
+        Ping or disconnect the handlers as their idle time requires.
+        :param now: The monotonic time.
+        :return: None
+        """
+        with self.lock:
+            handlers = list(self.handlers.items())
+        for handler, pinged_at in handlers:
+            idle = now - handler.received_at
+            if idle >= Heartbeat.TIMEOUT:
+                print(f'Keepalive: {handler.device_id} silent for {idle:.0f} s, disconnecting')
+                self.unwatch(handler)
+                handler.interrupt()
+            elif idle >= Heartbeat.INTERVAL and now - pinged_at >= Heartbeat.INTERVAL:
+                with self.lock:
+                    if handler not in self.handlers:
+                        continue
+                try:
+                    # the answer only matters by arriving, which updates {received_at}
+                    future = handler.ping(Heartbeat.INTERVAL)
+                except (OSError, RuntimeError):
+                    self.unwatch(handler)
+                    handler.interrupt()
+                    continue
+                # None while a long send, e.g. of a picture, is under way; it is pinged again at the next check
+                if future is not None:
+                    with self.lock:
+                        if handler in self.handlers:
+                            self.handlers[handler] = now
@@ -0,0 +1,86 @@
+import mmap
+import os
+from typing import BinaryIO, Iterator, Optional, Union
+
+
+class FilePayload:
+    """
+    A payload backed by a byte range of a file.
+    It is memory-mapped only when materialized, and sockets send it with {sendfile},
+    so large images travel without being loaded into Python bytes.
+    """
+    __slots__ = ('path', 'offset', 'length', '_view')
+
+    def __init__(self, path: str, offset: int = 0, length: Optional[int] = None):
+        """
+        :param path: The file holding the payload.
+        :param offset: The offset of the payload in the file.
+        :param length: The length of the payload, or None for the rest of the file.
+        """
+        self.path = path
+        self.offset = offset
+        self.length = length if length is not None else os.path.getsize(path) - offset
+        self._view: Optional[memoryview] = None
+
+    def __len__(self):
+        return self.length
+
+    def __bytes__(self):
+        return bytes(self.view())
+
+    def open(self) -> BinaryIO:
+        """
+        :return: The backing file opened for reading and positioned at the payload.
+        """
+        file = open(self.path, 'rb')
+        file.seek(self.offset)
+        return file
+
+    def view(self) -> memoryview:
+        """
+        Map the payload into memory. The mapping is made once and shared by later calls.
+        :return: A read-only view over the payload.
+        """
+        if self._view is None:
+            if self.length == 0:
+                self._view = memoryview(b'')
+            else:
+                # mmap offsets must be aligned to the allocation granularity
+                start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+                with open(self.path, 'rb') as file:
+                    mapped = mmap.mmap(file.fileno(),
+                                       self.offset - start + self.length,
+                                       access=mmap.ACCESS_READ,
+                                       offset=start)
+                self._view = memoryview(mapped)[self.offset - start:]
+        return self._view
+
+    def chunks(self, size: int) -> Iterator[memoryview]:
+        """
+        Iterate over the payload in views of at most {size} bytes.
+        """
+        view = self.view()
+        for offset in range(0, self.length, size):
+            yield view[offset:offset + size]
+
+
+Payload = Union[bytes, bytearray, memoryview, FilePayload]
+"""Any value Bundle.args may hold."""
+
+
+def slice_payload(payload: Payload, offset: int, length: int) -> Payload:
+    """
+    :return: {length} bytes of {payload} from {offset}, without reading or copying them.
+    """
+    if isinstance(payload, FilePayload):
+        return FilePayload(payload.path, payload.offset + offset, length)
+    return memoryview(payload)[offset:offset + length]
+
+
+def materialize(payload: Payload) -> Union[bytes, bytearray, memoryview]:
+    """
+    :return: {payload} as a bytes-like object, mapping file-backed payloads into memory.
+    """
+    if isinstance(payload, FilePayload):
+        return payload.view()
+    return payload
@@ -0,0 +1,184 @@
+import heapq
+import time
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from interaction.bundle import Bundle
+
+
+class PendingRequest:
+    """
+    A request sent on a connection and waiting for its response.
+    """
+    def __init__(self, bundle: Bundle, deadline: Optional[float]):
+        self.bundle = bundle
+        self.future = Future()
+        self.sent_at = time.monotonic()
+        self.deadline = deadline
+        self.expired = False
+
+
+class PendingRequests:
+    """
+    A correlation table of the requests in flight on one connection, keyed by request ID.
+    It hands out free request IDs, refuses to reuse an ID while it is outstanding
+    and resolves a future per request once its response arrives.
+
+    A request which timed out keeps its ID reserved for {QUARANTINE} seconds,
+    so that a late response can't be taken for the response of a newer request.
+    """
+    QUARANTINE = 30.0
+
+    def __init__(self, max_id: int):
+        """
+        :param max_id: The largest request ID which may be allocated.
+        """
+        self.max_id = max_id
+        self.lock = Lock()
+        self.entries: Dict[int, PendingRequest] = {}
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, request_id: int):
+        return request_id in self.entries
+
+    def allocate(self) -> int:
+        """
+        Find a request ID which is not outstanding.
+        IDs are handed out round robin so that a recently used ID is reused as late as possible.
+        :return: The free request ID.
+        """
+        with self.lock:
+            for _ in range(self.max_id + 1):
+                request_id = self.next_id
+                self.next_id = request_id + 1 if request_id < self.max_id else 0
+                if request_id not in self.entries:
+                    return request_id
+        raise RuntimeError('Every request ID is in flight.')
+
+    def add(self, bundle: Bundle, timeout: Optional[float] = None) -> Future:
+        """
+        Register a request before it is sent.
+        :param bundle: The request bundle. Its request ID must not be outstanding.
+        :param timeout: Seconds to wait for the response before failing with TimeoutError, or None to wait forever.
+        :return: A future which resolves to the response bundle.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        entry = PendingRequest(bundle, deadline)
+        with self.lock:
+            if bundle.request_id in self.entries:
+                raise ValueError(f'Request ID {bundle.request_id} is still in flight.')
+            self.entries[bundle.request_id] = entry
+        if deadline is not None:
+            TimeoutReaper.instance().schedule(deadline, self, bundle.request_id, entry)
+        return entry.future
+
+    def resolve(self, bundle: Bundle) -> Optional[PendingRequest]:
+        """
+        Complete the request matching a response.
+        :param bundle: The response bundle.
+        :return: The completed request, or None if nothing was waiting for it.
+        """
+        with self.lock:
+            entry = self.entries.pop(bundle.request_id, None)
+        if entry is None or entry.expired:
+            return None
+        if not entry.future.done():
+            entry.future.set_result(bundle)
+        return entry
+
+    def discard(self, request_id: int, error: Optional[BaseException] = None) -> None:
+        """
+        Forget a request, e.g. because it couldn't be sent.
+        :param request_id: The request ID to release.
+        :param error: The exception to fail its future with.
+        :return: None
+        """
+        with self.lock:
+            entry = self.entries.pop(request_id, None)
+        if entry is not None and error is not None and not entry.future.done():
+            entry.future.set_exception(error)
+
+    def expire(self, request_id: int, entry: PendingRequest) -> None:
+        """
+        Fail a request whose deadline passed and quarantine its ID.
+        :return: None
+        """
+        with self.lock:
+            if self.entries.get(request_id) is not entry:
+                return
+            if entry.expired:
+                # the quarantine is over
+                del self.entries[request_id]
+                return
+            entry.expired = True
+        if not entry.future.done():
+            entry.future.set_exception(TimeoutError(f'Request {request_id} timed out.'))
+        TimeoutReaper.instance().schedule(time.monotonic() + PendingRequests.QUARANTINE,
+                                          self, request_id, entry)
+
+    def take_all(self) -> List[PendingRequest]:
+        """
+        Remove every outstanding request without completing it, e.g. to send it again on another connection.
+        :return: The requests which were outstanding and haven't timed out.
+        """
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if not entry.expired]
+            self.entries.clear()
+        return entries
+
+    def fail_all(self, error: BaseException) -> List[PendingRequest]:
+        """
+        Fail every outstanding request, e.g. once the connection is lost.
+        :param error: The exception to fail the futures with.
+        :return: The requests which were outstanding.
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        for entry in entries:
+            if not entry.future.done():
+                entry.future.set_exception(error)
+        return entries
+
+
+class TimeoutReaper(Thread):
+    """
+    A single daemon thread expiring the deadlines of every PendingRequests table.
+    """
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        super(TimeoutReaper, self).__init__(daemon=True)
+        self.condition = Condition()
+        self.heap: List[Tuple[float, int, PendingRequests, int, PendingRequest]] = []
+        self.sequence = 0
+
+    @staticmethod
+    def instance():
+        with TimeoutReaper._instance_lock:
+            if TimeoutReaper._instance is None:
+                TimeoutReaper._instance = TimeoutReaper()
+                TimeoutReaper._instance.start()
+            return TimeoutReaper._instance
+
+    def schedule(self, deadline: float, table: PendingRequests, request_id: int, entry: PendingRequest) -> None:
+        with self.condition:
+            # the sequence number keeps the heap from comparing tables
+            self.sequence += 1
+            heapq.heappush(self.heap, (deadline, self.sequence, table, request_id, entry))
+            if self.heap[0][1] == self.sequence:
+                self.condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while len(self.heap) == 0 or self.heap[0][0] > time.monotonic():
+                    timeout = self.heap[0][0] - time.monotonic() if len(self.heap) > 0 else None
+                    self.condition.wait(timeout)
+                _, _, table, request_id, entry = heapq.heappop(self.heap)
+            table.expire(request_id, entry)
@@ -1,9 +1,110 @@
 from interaction.bundle import Bundle
-from typing import Callable
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import Future
 import socket
-from threading import Thread
+import time
+from threading import Thread, Lock
 
-from interaction.byte_enum import ERequest
+from interaction.byte_enum import ERequest, EResponse
+from interaction.codec import FrameCodec
+from interaction.keepalive import Heartbeat, enable_keepalive, resend, settle
+from interaction.pending import PendingRequest, PendingRequests
+from interaction.payload import FilePayload, Payload, slice_payload
+from interaction.stream import ACK, BEGIN, STREAM_REQUESTS, FileSink, OutgoingStream, StreamReceiver
+from monitoring.metrics import METRICS
+from storage.trace import INBOUND, OUTBOUND
+
+
+def recv_exactly(client: socket.socket,
+                 length: int,
+                 on_received: Optional[Callable[[], None]] = None) -> Optional[memoryview]:
+    """
+    Receive exactly {length} bytes from the socket.
+    The buffer is allocated once for the announced length and filled in place,
+    so the payload is never copied or concatenated on the way.
+    :param client: The socket to receive from.
+    :param length: The number of bytes to receive.
+    :param on_received: Called whenever part of them arrives, e.g. to tell a slow transfer from a dead peer.
+    :return: A view over the received bytes, or None if the peer closed the connection.
+    """
+    view = memoryview(bytearray(length))
+    received = 0
+    while received < length:
+        size = client.recv_into(view[received:], length - received)
+        if size == 0:
+            return None
+        received += size
+        if on_received is not None:
+            on_received()
+    return view
+
+
+def recv_frame(client: socket.socket, on_received: Optional[Callable[[], None]] = None) -> Optional[memoryview]:
+    """
+    Receive a single length-prefixed frame from the socket.
+    :param client: The socket to receive from.
+    :param on_received: Called whenever part of the frame arrives, see recv_exactly.
+    :return: A view over the frame without its length prefix, or None if the peer closed the connection.
+    """
+    header = recv_exactly(client, 4, on_received)
+    if header is None:
+        return None
+    return recv_exactly(client, int.from_bytes(header, byteorder='big'), on_received)
+
+
+def recv_handshake(client: socket.socket, timeout: float) -> Optional[memoryview]:
+    """
+    Receive the role bundle of a client which was just accepted, and turn on keepalive on its socket.
+    :param client: The accepted socket.
+    :param timeout: Seconds to wait for the bundle, so that a silent client doesn't hold up the listener.
+    :return: The frame of the bundle, or None if the client closed the connection or sent nothing in time.
+    """
+    enable_keepalive(client)
+    client.settimeout(timeout)
+    try:
+        return recv_frame(client)
+    except socket.timeout:
+        return None
+    finally:
+        client.settimeout(None)
+
+
+def send_buffers(client: socket.socket, buffers: List[Payload]) -> None:
+    """
+    Send several buffers back to back without joining them into one.
+    Uses scatter-gather {sendmsg} where the platform has it and falls back to {sendall} per buffer.
+    File-backed payloads are sent with {sendfile}.
+    :param client: The socket to send to.
+    :param buffers: The buffers to send in order.
+    :return: None
+    """
+    views = []
+    for buffer in buffers:
+        if isinstance(buffer, FilePayload):
+            send_views(client, views)
+            views = []
+            with buffer.open() as file:
+                client.sendfile(file, buffer.offset, buffer.length)
+        elif len(buffer) > 0:
+            views.append(memoryview(buffer).cast('B'))
+    send_views(client, views)
+
+
+def send_views(client: socket.socket, views: List[memoryview]) -> None:
+    if not hasattr(client, 'sendmsg'):
+        for view in views:
+            client.sendall(view)
+        return
+
+    while len(views) > 0:
+        sent = client.sendmsg(views)
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
 
 
 class Interactor(Thread):
@@ -14,20 +115,53 @@ class Interactor(Thread):
     BUFFER_SIZE = 1024
     MAX_REQ_ID = 254
     CLIENT_REQ_ID = 255
+    PADDING = bytes(1020)
+    """Trailing bytes legacy clients expect after each frame."""
+    STREAM_THRESHOLD = 4 * 1024 * 1024
+    """Requests with larger args are streamed to clients which accept streams."""
+    STREAM_CHUNK_SIZE = 256 * 1024
+    STREAM_WINDOW = 2 * 1024 * 1024
+    HANDSHAKE_TIMEOUT = 10.0
 
     def __init__(self,
                  client: socket.socket,
                  request_handler: Callable[[Bundle], Bundle],
                  response_handler: Callable[[Bundle], None],
-                 on_disconnected: Callable[[], None]):
+                 on_disconnected: Callable[[], None],
+                 padding: bool = True,
+                 streaming: bool = False,
+                 stream_sink: Callable[[Bundle], object] = FileSink,
+                 heartbeat: bool = False,
+                 codec: Optional[FrameCodec] = None):
+        """
+        :param padding: Whether the client expects the legacy padding after each frame.
+        :param streaming: Whether the client accepts large requests as chunked streams.
+        :param stream_sink: Makes the sink of each stream received from the client, see StreamReceiver.
+        :param heartbeat: Whether the client answers ANY_PING, so that it is pinged while idle, see Heartbeat.
+        :param codec: The framing of a client which negotiated protocol version 2, or None for version 1.
+        """
         super(Interactor, self).__init__()
 
         self.client = client
         self.request_handler = request_handler
         self.response_handler = response_handler
         self.on_disconnected = on_disconnected
+        self.padding = padding
+        self.streaming = streaming
+        self.heartbeat = heartbeat
+        self.codec = codec
         self.stop = True
         self.last_bundle = None
+        self.send_lock = Lock()
+        self.pending = PendingRequests(Interactor.MAX_REQ_ID)
+        self.receiver = StreamReceiver(self.transmit, stream_sink)
+        self.outgoing: Dict[int, OutgoingStream] = {}
+        # set once the client is registered, to label its metrics and trace
+        self.device_id: Optional[str] = None
+        self.recorder = None
+        self.received_at = time.monotonic()
+        # the requests of a former session of the same device, sent again once this one runs
+        self.adopted: List[PendingRequest] = []
 
     def run(self) -> None:
         """
@@ -35,57 +169,282 @@ class Interactor(Thread):
         :return: None
         """
         self.stop = False
-        while not self.stop:
-            # receive data
-            data = self.client.recv(4)
-            length = int.from_bytes(data, byteorder='big')
-            print('Estimated size:', length)
-
-            data = b''
-            while len(data) < length:
-                buffer = self.client.recv(length)
-                data += buffer
-            print('Received size:', len(data))
-
-            if len(data) != 0:
-                bundle = Bundle.from_bytes(data)
-                request_id, request, args, response = bundle
-
-                if request_id == Interactor.CLIENT_REQ_ID:
-                    # handle it if it's a request
-                    if bundle.request == ERequest.ANY_AGAIN:
-                        if self.last_bundle is not None:
-                            self.send_bundle(self.last_bundle)
-                            self.last_bundle = None
-                    else:
-                        response_bundle = self.request_handler(bundle)
-                        self.send_bundle(response_bundle)
+        self.received_at = time.monotonic()
+        if self.heartbeat:
+            Heartbeat.instance().watch(self)
+        if len(self.adopted) > 0:
+            resend(self, self.adopted)
+            self.adopted = []
+        try:
+            while not self.stop:
+                # receive data
+                try:
+                    data = self.receive()
+                except OSError:
+                    data = None
+                if data is not None and len(data) != 0:
+                    self.received_at = time.monotonic()
+                    try:
+                        bundle = Bundle.from_bytes(data) if self.codec is None else FrameCodec.decode(data)
+                    except ValueError as e:
+                        print(f'Interactor: invalid frame from {self.device_id}, {e}')
+                        break
+                    if self.recorder is not None:
+                        self.recorder.record(INBOUND, self.device_id, bundle)
+
+                    if bundle.request in STREAM_REQUESTS:
+                        bundle = self.feed_stream(bundle)
+                        if bundle is None:
+                            continue
+                    self.dispatch(bundle)
                 else:
-                    # if response, send bundle to window via signal
-                    self.response_handler(bundle)
+                    break
+        finally:
+            if self.heartbeat:
+                Heartbeat.instance().unwatch(self)
+            self.receiver.abort_all()
+            for stream in list(self.outgoing.values()):
+                stream.close()
+            self.pending.fail_all(ConnectionError('Disconnected.'))
+            self.on_disconnected()
+
+    def receive(self) -> Optional[memoryview]:
+        """
+        Receive a single frame, recording it in the metrics if they are enabled.
+        :return: The frame without its length prefix, or None if the peer closed the connection.
+        """
+        # a large frame from a slow client may take longer than Heartbeat.TIMEOUT to arrive
+        on_received = self.touch if self.heartbeat else None
+        if not METRICS.enabled:
+            return recv_frame(self.client, on_received)
+
+        header = recv_exactly(self.client, 4, on_received)
+        if header is None:
+            return None
+        # the wait for the length prefix is idle time, not receive time
+        received_at = time.perf_counter()
+        data = recv_exactly(self.client, int.from_bytes(header, byteorder='big'), on_received)
+        if data is not None and len(data) >= Bundle.HEADER.size:
+            METRICS.received(self.device_id, ERequest.from_int(data[1]), len(data) + 4,
+                             time.perf_counter() - received_at)
+        return data
+
+    def touch(self) -> None:
+        """
+        Note that bytes arrived from the client, so that the heartbeat doesn't take it for dead mid-frame.
+        :return: None
+        """
+        self.received_at = time.monotonic()
+
+    def dispatch(self, bundle: Bundle) -> None:
+        """
+        Pass a received bundle to the handler it belongs to.
+        :param bundle: The received bundle.
+        :return: None
+        """
+        if bundle.request_id == Interactor.CLIENT_REQ_ID:
+            # handle it if it's a request
+            if bundle.request == ERequest.ANY_AGAIN:
+                if self.last_bundle is not None:
+                    self.send_bundle(self.last_bundle)
+                    self.last_bundle = None
+            elif bundle.request == ERequest.ANY_PING:
+                bundle.response = EResponse.ACK
+                self.transmit(bundle)
             else:
-                break
-        self.on_disconnected()
+                response_bundle = self.request_handler(bundle)
+                self.send_bundle(response_bundle)
+        else:
+            # if response, complete the pending request and pass it to the handler
+            self.pending.resolve(bundle)
+            # heartbeats are answered by the connection, not by the front end
+            if self.response_handler is not None and bundle.request != ERequest.ANY_PING:
+                self.response_handler(bundle)
+
+    def feed_stream(self, bundle: Bundle) -> Optional[Bundle]:
+        """
+        Handle a stream frame, either an acknowledgement for a stream being sent or a part of one being received.
+        :param bundle: The stream frame.
+        :return: The reassembled bundle once a received stream ends, None otherwise.
+        """
+        if bundle.response == EResponse.ACK:
+            stream = self.outgoing.get(bundle.request_id)
+            if stream is not None and len(bundle.args) == ACK.size:
+                stream.acknowledge(ACK.unpack_from(bundle.args)[0])
+            return None
+        return self.receiver.feed(bundle)
 
-    def request(self, bundle: Bundle) -> None:
+    def request(self, bundle: Bundle, timeout: Optional[float] = None) -> Future:
         """
         Send a request with specified request ID.
-        :param bundle: The request bundle
+        Many requests may be in flight at once, but not two with the same request ID.
+        :param bundle: The request bundle. A free request ID is allocated if its request ID is None.
+        :param timeout: Seconds to wait for the response, or None to wait forever.
+        :return: A future which resolves to the response bundle.
+        """
+        future = Interactor.add_pending(self.pending, bundle, timeout)
+        if METRICS.enabled:
+            METRICS.track(future, self.device_id, bundle.request)
+        if self.streaming and len(bundle.args) > Interactor.STREAM_THRESHOLD:
+            # a stream is paced by the client, so it is sent from its own thread
+            Thread(target=self.stream, args=(bundle,), daemon=True).start()
+            return future
+
+        try:
+            self.send_bundle(bundle)
+        except OSError as e:
+            self.pending.discard(bundle.request_id, e)
+            raise
+        return future
+
+    def ping(self, timeout: Optional[float] = None) -> Optional[Future]:
+        """
+        Send ANY_PING unless another frame is being sent, which the ping would have to wait behind.
+        {send_lock} is held from the check to the send, so that no other send can slip in between.
+        :param timeout: Seconds to wait for the response, or None to wait forever.
+        :return: The future of the response, or None if a send is under way.
+        """
+        if not self.send_lock.acquire(blocking=False):
+            return None
+        try:
+            bundle = Bundle(None, ERequest.ANY_PING)
+            future = Interactor.add_pending(self.pending, bundle, timeout)
+            if METRICS.enabled:
+                METRICS.track(future, self.device_id, bundle.request)
+            try:
+                self.transmit(bundle, locked=True)
+            except OSError as e:
+                self.pending.discard(bundle.request_id, e)
+                raise
+            return future
+        finally:
+            self.send_lock.release()
+
+    def stream(self, bundle: Bundle) -> None:
+        """
+        Send a bundle as a chunked stream, waiting for acknowledgements so that
+        at most {STREAM_WINDOW} bytes are in flight. Blocks until the stream is sent.
+        :param bundle: The bundle to stream. Its request ID identifies the stream.
         :return: None
         """
-        if bundle.request_id > Interactor.MAX_REQ_ID:
+        request_id = bundle.request_id
+        window = Interactor.STREAM_WINDOW
+        stream = OutgoingStream(window)
+        self.outgoing[request_id] = stream
+        self.last_bundle = bundle
+        # every chunk is compressed alike, as only the first one shows what the args are
+        compression = self.codec.compression(bundle.args) if self.codec is not None else None
+        try:
+            total = len(bundle.args)
+            self.transmit(Bundle(request_id, ERequest.ANY_STREAM_BEGIN,
+                                 BEGIN.pack(bundle.request.value, bundle.response.value, total, window)))
+
+            chunk_size = min(Interactor.STREAM_CHUNK_SIZE, window // 2)
+            for offset in range(0, total, chunk_size):
+                size = min(chunk_size, total - offset)
+                stream.wait_window(size)
+                self.transmit(Bundle(request_id, ERequest.ANY_STREAM_CHUNK,
+                                     slice_payload(bundle.args, offset, size)), compression)
+                stream.sent += size
+
+            self.transmit(Bundle(request_id, ERequest.ANY_STREAM_END))
+        except OSError as e:
+            self.pending.discard(request_id, e)
+        finally:
+            del self.outgoing[request_id]
+
+    @staticmethod
+    def add_pending(pending: PendingRequests, bundle: Bundle, timeout: Optional[float]) -> Future:
+        """
+        Allocate a request ID for {bundle} if needed and register it in {pending}.
+        :return: The future of the request.
+        """
+        if bundle.request_id is None:
+            bundle.request_id = pending.allocate()
+        elif bundle.request_id > Interactor.MAX_REQ_ID:
             raise ValueError('Out of request id range.')
 
-        self.send_bundle(bundle)
+        return pending.add(bundle, timeout)
 
     def send_bundle(self, bundle: Bundle) -> None:
-        data = bundle.bytes()
-        length_bytes = int.to_bytes(len(data), length=4, byteorder='big')
-
+        """
+        Send a bundle as a single length-prefixed frame.
+        The header and {args} go out in one scatter-gather write without being joined.
+        :param bundle: The bundle to send.
+        :return: None
+        """
         self.last_bundle = bundle
+        self.transmit(bundle)
+
+    def transmit(self, bundle: Bundle, compression: Optional[int] = None, locked: bool = False) -> None:
+        """
+        Send a bundle as a single frame without remembering it for ANY_AGAIN.
+        :param bundle: The bundle to send.
+        :param compression: How to compress its args if a codec was negotiated, or None to choose from them.
+        :param locked: Whether the caller already holds {send_lock}.
+        :return: None
+        """
+        buffers = Interactor.frame(bundle, self.padding, self.codec, compression)
+        # recorded before it is sent, so that its response can't be recorded first
+        if self.recorder is not None:
+            self.recorder.record(OUTBOUND, self.device_id, bundle)
+        if locked:
+            send_buffers(self.client, buffers)
+        else:
+            with self.send_lock:
+                send_buffers(self.client, buffers)
+        if METRICS.enabled:
+            METRICS.sent(self.device_id, bundle.request, sum(len(buffer) for buffer in buffers))
+
+    @staticmethod
+    def frame(bundle: Bundle,
+              padding: bool = True,
+              codec: Optional[FrameCodec] = None,
+              compression: Optional[int] = None) -> List[Payload]:
+        """
+        Split a bundle into the buffers of its length-prefixed frame.
+        :param bundle: The bundle to frame.
+        :param padding: Whether to append the legacy padding.
+        :param codec: The framing of protocol version 2, or None for version 1.
+        :param compression: How the codec compresses the args, or None to choose from them.
+        :return: The buffers to send in order.
+        """
+        if codec is not None:
+            buffers = codec.frame(bundle, compression)
+        else:
+            buffers = [bundle.frame_header(), bundle.args]
+        if padding:
+            buffers.append(Interactor.PADDING)
+        return buffers
+
+    def adopt(self, entries: List[PendingRequest]) -> None:
+        """
+        Take over the requests a former session of the same device left unanswered.
+        They are sent again once this interactor runs, see resend.
+        :return: None
+        """
+        self.adopted.extend(entries)
 
-        self.client.send(length_bytes)
-        self.client.send(bundle.bytes() + b'\x00' * 1020)
+    def abandon(self) -> None:
+        """
+        Fail the requests of an interactor whose client was lost before it started,
+        both those it adopted and those sent to it meanwhile.
+        :return: None
+        """
+        error = ConnectionError('Disconnected.')
+        for entry in self.adopted:
+            settle(entry.future, error=error)
+        self.adopted = []
+        self.pending.fail_all(error)
 
     def interrupt(self):
+        """
+        Stop the receiving routine.
+        The socket is shut down so that a blocking receive returns right away.
+        :return: None
+        """
         self.stop = True
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
@@ -0,0 +1,205 @@
+from concurrent.futures import Future
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.handshake import Handshake
+from storage.trace import TraceRecorder
+
+
+class DeviceRegistry:
+    """
+    Connected clients keyed by device ID and indexed by role.
+    A handler is an Interactor or an AsyncInteractor; both have {request}.
+    Lookups by device ID, by role and by handler are dictionary accesses,
+    and the handlers to broadcast to are kept as a ready-made tuple.
+    """
+    ROLES = (ERequest.CAMERA, ERequest.DISPLAY)
+
+    def __init__(self):
+        self.lock = RLock()
+        self.devices: Dict[str, object] = {}
+        self.roles: Dict[ERequest, Dict[str, object]] = {role: {} for role in DeviceRegistry.ROLES}
+        self.device_ids: Dict[int, Tuple[str, ERequest]] = {}
+        self.handshakes: Dict[str, Handshake] = {}
+        self.broadcast_handlers: Tuple = ()
+        self.counters: Dict[ERequest, int] = {role: 0 for role in DeviceRegistry.ROLES}
+        # records the session of every client registered while it is set
+        self.recorder: Optional[TraceRecorder] = None
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, device_id: str):
+        return device_id in self.devices
+
+    def accept(self, handshake: Handshake, handler) -> EResponse:
+        """
+        Evaluate the role proposed by a new client and register it.
+        Clients which don't name themselves get a device ID like 'camera-1'.
+        The registered ID is written back to {handshake.device_id}.
+        A client naming a device which is still registered takes over its session: the former handler,
+        most likely a connection which died silently, is interrupted and {handler} adopts its pending requests.
+        :param handshake: The handshake sent by the client.
+        :param handler: The Interactor or AsyncInteractor serving the client.
+        :return: OK if the client is registered, ERROR otherwise.
+        """
+        role = handshake.role
+        if role not in self.roles:
+            print(f'Listen: unknown')
+            return EResponse.ERROR
+
+        name = role.name.lower()
+        previous = None
+        with self.lock:
+            device_id = handshake.device_id
+            if device_id is None:
+                device_id = self.next_device_id(role)
+            else:
+                previous = self.devices.get(device_id)
+            if previous is not None:
+                # taken before the former handler is interrupted, which would fail them
+                handler.adopt(previous.pending.take_all())
+                self.unregister(previous)
+            if not self.register(device_id, role, handler):
+                print(f'Listen: {name} {device_id}, error')
+                return EResponse.ERROR
+            self.handshakes[device_id] = handshake
+            if self.recorder is not None:
+                self.recorder.connect(device_id, handshake.bundle)
+
+        handshake.device_id = device_id
+        if previous is not None:
+            previous.interrupt()
+            print(f'Listen: {name} {device_id}, took over the former session')
+        print(f'Listen: {name} {device_id}, ok')
+        return EResponse.OK
+
+    def next_device_id(self, role: ERequest) -> str:
+        with self.lock:
+            while True:
+                self.counters[role] += 1
+                device_id = f'{role.name.lower()}-{self.counters[role]}'
+                if device_id not in self.devices:
+                    return device_id
+
+    def register(self, device_id: str, role: ERequest, handler) -> bool:
+        """
+        Register a handler under {device_id}.
+        :return: False if the device ID is already taken.
+        """
+        with self.lock:
+            if device_id in self.devices:
+                return False
+            self.devices[device_id] = handler
+            self.roles[role][device_id] = handler
+            self.device_ids[id(handler)] = (device_id, role)
+            self.broadcast_handlers = tuple(self.devices.values())
+        handler.device_id = device_id
+        handler.recorder = self.recorder
+        return True
+
+    def unregister(self, handler) -> Optional[Tuple[str, ERequest]]:
+        """
+        Remove a handler, usually once its client disconnected.
+        :param handler: The handler to remove.
+        :return: The device ID and role it was registered with, or None if it wasn't.
+        """
+        with self.lock:
+            entry = self.device_ids.get(id(handler))
+            if entry is None or self.devices.get(entry[0]) is not handler:
+                return None
+            device_id, role = entry
+            del self.device_ids[id(handler)]
+            del self.devices[device_id]
+            del self.roles[role][device_id]
+            self.handshakes.pop(device_id, None)
+            self.broadcast_handlers = tuple(self.devices.values())
+            if self.recorder is not None:
+                self.recorder.disconnect(device_id)
+        return entry
+
+    def get(self, device_id: str):
+        """
+        :return: The handler registered under {device_id}, or None.
+        """
+        return self.devices.get(device_id)
+
+    def handshake(self, device_id: str) -> Optional[Handshake]:
+        """
+        :return: The handshake the device registered with, or None.
+        """
+        return self.handshakes.get(device_id)
+
+    def device_id(self, handler) -> Optional[str]:
+        """
+        :return: The device ID {handler} is registered under, or None.
+        """
+        entry = self.device_ids.get(id(handler))
+        return entry[0] if entry is not None else None
+
+    def default(self, role: ERequest):
+        """
+        :return: The earliest registered handler with {role}, or None.
+        """
+        handlers = self.roles[role]
+        return next(iter(handlers.values()), None) if len(handlers) > 0 else None
+
+    def by_role(self, role: ERequest) -> Dict[str, object]:
+        """
+        :return: A snapshot of the handlers with {role} keyed by device ID.
+        """
+        with self.lock:
+            return dict(self.roles[role])
+
+    def has_role(self, role: ERequest) -> bool:
+        return len(self.roles[role]) > 0
+
+    def route(self, request: ERequest, device_id: Optional[str] = None) -> List:
+        """
+        Find the handlers a request goes to.
+        A named device gets it alone. Otherwise ANY_* requests are broadcast to every device,
+        and camera or display requests go to the default device of that role.
+        :param request: The request to route.
+        :param device_id: The device to send to, or None.
+        :return: The handlers to send the request to.
+        """
+        if device_id is not None:
+            handler = self.devices.get(device_id)
+            return [handler] if handler is not None else []
+        if request.is_for_any():
+            return list(self.broadcast_handlers)
+
+        role = ERequest.CAMERA if request.is_for_camera() else ERequest.DISPLAY
+        handler = self.default(role)
+        return [handler] if handler is not None else []
+
+    def request(self,
+                bundle: Bundle,
+                device_id: Optional[str] = None,
+                timeout: Optional[float] = None) -> List[Future]:
+        """
+        Send a request to the devices it is routed to.
+        Each device allocates the request ID on its own if the request ID of {bundle} is None.
+        :param bundle: The request bundle.
+        :param device_id: The device to send to, or None to route by request.
+        :param timeout: Seconds to wait for each response, or None to wait forever.
+        :return: The futures of the request, one per device it was sent to.
+        """
+        return list(self.request_devices(bundle, device_id, timeout).values())
+
+    def request_devices(self,
+                        bundle: Bundle,
+                        device_id: Optional[str] = None,
+                        timeout: Optional[float] = None) -> Dict[str, Future]:
+        """
+        Same as request, but the futures are keyed by the device ID they were sent to.
+        """
+        handlers = self.route(bundle.request, device_id)
+        futures = {}
+        for handler in handlers:
+            # each device gets its own copy so that the allocated request IDs don't mix up
+            copy = bundle if len(handlers) == 1 else Bundle(bundle.request_id, bundle.request, bundle.args)
+            futures[self.device_id(handler)] = handler.request(copy, timeout)
+        return futures
@@ -0,0 +1,187 @@
+import math
+import time
+from concurrent.futures import Future
+from functools import partial
+from threading import Event
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.handshake import Handshake
+from interaction.keepalive import settle
+from interaction.pending import PendingRequest
+from interaction.protocol import Interactor
+from interaction.stream import BEGIN, STREAM_REQUESTS
+from monitoring.metrics import METRICS
+from storage.trace import OUTBOUND, TraceConnection, TraceDisconnection, TraceFrame, read_trace
+
+
+class ReplayInteractor(Interactor):
+    """
+    An Interactor fed with the frames of a trace instead of a socket.
+    Everything it would send is dropped, and it never runs as a thread.
+    """
+    def __init__(self,
+                 device_id: str,
+                 request_handler: Callable[[Bundle], Bundle],
+                 response_handler: Callable[[Bundle], None],
+                 on_disconnected: Optional[Callable[[], None]]):
+        super(ReplayInteractor, self).__init__(None, request_handler, response_handler, on_disconnected,
+                                               padding=False)
+        self.device_id = device_id
+        self.stop = False
+
+    def feed(self, bundle: Bundle) -> None:
+        """
+        Handle a frame received in the trace, as run() handles a frame received from the socket.
+        :return: None
+        """
+        if bundle.request in STREAM_REQUESTS:
+            bundle = self.feed_stream(bundle)
+            if bundle is None:
+                return
+        self.dispatch(bundle)
+
+    def expect(self, bundle: Bundle) -> Optional[Tuple[Bundle, Future]]:
+        """
+        Register a request sent in the trace, so that its response in the trace resolves it.
+        :param bundle: The request, or the beginning of the stream it was sent as.
+        :return: The request and the future of its response, or None if {bundle} is not a request.
+        """
+        if bundle.request_id == Interactor.CLIENT_REQ_ID or bundle.response != EResponse.NONE:
+            return None
+        if bundle.request == ERequest.ANY_STREAM_BEGIN:
+            request, _, _, _ = BEGIN.unpack_from(bundle.args)
+            bundle = Bundle(bundle.request_id, ERequest.from_int(request))
+        elif bundle.request in STREAM_REQUESTS:
+            return None
+        # a request ID still outstanding here was never answered in the trace
+        self.pending.discard(bundle.request_id, TimeoutError(f'Request {bundle.request_id} was not answered.'))
+        return bundle, self.pending.add(bundle)
+
+    def adopt(self, entries: List[PendingRequest]) -> None:
+        # the requests sent again are in the trace, where expect() registers them anew
+        for entry in entries:
+            settle(entry.future, error=ConnectionError('The session was taken over.'))
+
+    def transmit(self, bundle: Bundle, compression: Optional[int] = None, locked: bool = False) -> None:
+        if METRICS.enabled:
+            METRICS.sent(self.device_id, bundle.request, Bundle.FRAME_HEADER.size + len(bundle.args))
+
+    def disconnect(self) -> None:
+        """
+        Tear down as run() does once the socket is closed.
+        :return: None
+        """
+        if self.stop:
+            return
+        self.stop = True
+        self.receiver.abort_all()
+        self.pending.fail_all(ConnectionError('Disconnected.'))
+        if self.on_disconnected is not None:
+            self.on_disconnected()
+
+    def interrupt(self) -> None:
+        self.disconnect()
+
+
+class ReplayStats(NamedTuple):
+    frames: int
+    """The frames received in the trace which were fed to the handlers."""
+    bytes: int
+    """The payload bytes of those frames."""
+    duration: float
+    """The seconds the recorded session lasted."""
+    elapsed: float
+    """The seconds the replay took."""
+
+
+class TraceReplayer:
+    """
+    Feeds a recorded session back through the handlers of Interactor, the way the clients sent it.
+    Each recorded client is accepted again through {on_handshake} with a ReplayInteractor,
+    the requests the host sent are registered so that their recorded responses resolve them,
+    and what the clients sent is dispatched at the recorded pace, scaled by a speed factor.
+    """
+    MAX_SPEED = math.inf
+
+    def __init__(self,
+                 path: str,
+                 request_handler: Callable[[Bundle], Bundle],
+                 response_handler: Callable[[Bundle], None],
+                 on_handshake: Callable[[Handshake, ReplayInteractor], EResponse],
+                 on_disconnected: Callable[[ReplayInteractor], None],
+                 on_request: Optional[Callable[[str, Bundle, Future], None]] = None):
+        """
+        :param path: The trace file.
+        :param request_handler: Handles requests from clients, as for Interactor.
+        :param response_handler: Handles responses from clients, as for Interactor.
+        :param on_handshake: Evaluates the role of a recorded client, as for AsyncServer.
+        :param on_disconnected: Is called with the interactor of a recorded client once it disconnects.
+        :param on_request: Is called with the device ID, the bundle and the future of each recorded host request,
+            e.g. to process its response as the front end which sent it would.
+        """
+        self.path = path
+        self.request_handler = request_handler
+        self.response_handler = response_handler
+        self.on_handshake = on_handshake
+        self.on_disconnected = on_disconnected
+        self.on_request = on_request
+        self.handlers: Dict[str, ReplayInteractor] = {}
+        self.stop_event = Event()
+
+    def run(self, speed: float = 1.0) -> ReplayStats:
+        """
+        Replay the trace. Blocks until it is replayed or interrupted.
+        :param speed: How many times faster than recorded to replay, or MAX_SPEED not to wait at all.
+        :return: What was replayed.
+        """
+        frames = 0
+        size = 0
+        duration = 0.0
+        started_at = time.monotonic()
+        try:
+            for event in read_trace(self.path):
+                duration = event.time
+                if speed != TraceReplayer.MAX_SPEED:
+                    delay = started_at + event.time / speed - time.monotonic()
+                    if delay > 0 and self.stop_event.wait(delay):
+                        break
+                if self.stop_event.is_set():
+                    break
+
+                if isinstance(event, TraceFrame):
+                    handler = self.handlers.get(event.device_id)
+                    if handler is None:
+                        continue
+                    if event.direction == OUTBOUND:
+                        expected = handler.expect(event.bundle)
+                        if expected is not None and self.on_request is not None:
+                            self.on_request(event.device_id, *expected)
+                    else:
+                        frames += 1
+                        size += len(event.bundle.args)
+                        handler.feed(event.bundle)
+                elif isinstance(event, TraceConnection):
+                    self.connect(event)
+                elif isinstance(event, TraceDisconnection):
+                    handler = self.handlers.pop(event.device_id, None)
+                    if handler is not None:
+                        handler.disconnect()
+        finally:
+            for handler in list(self.handlers.values()):
+                handler.disconnect()
+            self.handlers.clear()
+        return ReplayStats(frames, size, duration, time.monotonic() - started_at)
+
+    def connect(self, event: TraceConnection) -> None:
+        handshake = Handshake.from_bundle(event.bundle)
+        # the client is registered again under the ID it had
+        handshake.device_id = event.device_id
+        handler = ReplayInteractor(event.device_id, self.request_handler, self.response_handler, None)
+        handler.on_disconnected = partial(self.on_disconnected, handler)
+        if self.on_handshake(handshake, handler) == EResponse.OK:
+            self.handlers[event.device_id] = handler
+
+    def interrupt(self) -> None:
+        self.stop_event.set()
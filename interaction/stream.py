@@ -0,0 +1,178 @@
+"""
+Chunked streaming of large payloads.
+
+A stream carries the args of one logical bundle in several frames sharing its request ID:
+    ANY_STREAM_BEGIN  args: request, response, total length (u64), window (u32)
+    ANY_STREAM_CHUNK  args: the next bytes of the payload
+    ANY_STREAM_END    args: none
+The receiver acknowledges the bytes it consumed with ANY_STREAM_CHUNK frames whose response is ACK
+and whose args hold the total number of bytes consumed so far (u64).
+The sender never has more than {window} bytes unacknowledged.
+A malformed stream frame aborts its stream and is answered with the same frame whose response is REJECT.
+"""
+import os
+import struct
+import tempfile
+from threading import Condition
+from typing import Callable, Dict, Optional
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+from interaction.payload import FilePayload, Payload
+
+STREAM_REQUESTS = frozenset([ERequest.ANY_STREAM_BEGIN, ERequest.ANY_STREAM_CHUNK, ERequest.ANY_STREAM_END])
+
+BEGIN = struct.Struct('>BBQI')
+"""Codec of the args of ANY_STREAM_BEGIN: request, response, total length and window."""
+ACK = struct.Struct('>Q')
+"""Codec of the args of an acknowledgement: the number of bytes consumed."""
+
+
+class FileSink:
+    """
+    A stream sink writing the payload straight to a file as the chunks arrive.
+    The finished payload is a FilePayload over that file; whoever handles the bundle owns the file.
+    """
+    DIRECTORY = os.path.join(tempfile.gettempdir(), 'solubility_streams')
+
+    def __init__(self, bundle: Bundle):
+        os.makedirs(FileSink.DIRECTORY, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=FileSink.DIRECTORY,
+                                                prefix=f'{bundle.request.name.lower()}-',
+                                                delete=False)
+
+    def write(self, data: memoryview) -> None:
+        self.file.write(data)
+
+    def close(self) -> Payload:
+        self.file.close()
+        return FilePayload(self.file.name)
+
+    def abort(self) -> None:
+        self.file.close()
+        os.remove(self.file.name)
+
+
+class IncomingStream:
+    def __init__(self, header: Bundle, total: int, window: int, sink):
+        self.header = header
+        self.total = total
+        self.window = window
+        self.sink = sink
+        self.received = 0
+        self.acknowledged = 0
+
+
+class StreamReceiver:
+    """
+    Reassembles the streams coming in on one connection.
+    """
+    def __init__(self,
+                 send: Callable[[Bundle], None],
+                 sink_factory: Callable[[Bundle], object] = FileSink):
+        """
+        :param send: Sends an acknowledgement bundle back to the peer.
+        :param sink_factory: Makes the sink of a new stream from its header bundle.
+            A sink has write(data), close() returning the payload, and abort().
+        """
+        self.send = send
+        self.sink_factory = sink_factory
+        self.streams: Dict[int, IncomingStream] = {}
+
+    def feed(self, bundle: Bundle) -> Optional[Bundle]:
+        """
+        Handle a stream frame.
+        :param bundle: A bundle whose request is ANY_STREAM_BEGIN, ANY_STREAM_CHUNK or ANY_STREAM_END.
+        :return: The reassembled bundle once its stream ends, None otherwise.
+        """
+        if bundle.request == ERequest.ANY_STREAM_BEGIN:
+            if len(bundle.args) != BEGIN.size:
+                return self.reject(bundle, f'its header has {len(bundle.args)} bytes instead of {BEGIN.size}')
+            request, response, total, window = BEGIN.unpack_from(bundle.args)
+            request, response = ERequest.from_int(request), EResponse.from_int(response)
+            if request is None or response is None:
+                return self.reject(bundle, 'its request or response is unknown')
+            header = Bundle(bundle.request_id, request, b'', response)
+            previous = self.streams.pop(bundle.request_id, None)
+            if previous is not None:
+                previous.sink.abort()
+            self.streams[bundle.request_id] = IncomingStream(header, total, window, self.sink_factory(header))
+            return None
+
+        stream = self.streams.get(bundle.request_id)
+        if stream is None:
+            print(f'Stream {bundle.request_id} is unknown.')
+            return None
+
+        if bundle.request == ERequest.ANY_STREAM_CHUNK:
+            if stream.received + len(bundle.args) > stream.total:
+                return self.reject(bundle, f'it exceeds its {stream.total} bytes')
+            stream.sink.write(bundle.args)
+            stream.received += len(bundle.args)
+            # acknowledge every half window so that the sender never stalls on a full one
+            if stream.received - stream.acknowledged >= stream.window // 2:
+                stream.acknowledged = stream.received
+                self.send(Bundle(bundle.request_id, ERequest.ANY_STREAM_CHUNK,
+                                 ACK.pack(stream.received), EResponse.ACK))
+            return None
+
+        if len(bundle.args) != 0:
+            return self.reject(bundle, 'its end has args')
+        del self.streams[bundle.request_id]
+        if stream.received != stream.total:
+            print(f'Stream {bundle.request_id} ended after {stream.received} of {stream.total} bytes.')
+            stream.sink.abort()
+            return None
+        stream.header.args = stream.sink.close()
+        return stream.header
+
+    def reject(self, bundle: Bundle, reason: str) -> None:
+        """
+        Abort the stream of a malformed frame and answer the frame with REJECT.
+        :param bundle: The malformed frame.
+        :param reason: What is wrong with it, for the log.
+        :return: None
+        """
+        print(f'Stream {bundle.request_id} is rejected, {reason}.')
+        stream = self.streams.pop(bundle.request_id, None)
+        if stream is not None:
+            stream.sink.abort()
+        self.send(Bundle(bundle.request_id, bundle.request, b'', EResponse.REJECT))
+
+    def abort_all(self) -> None:
+        for stream in self.streams.values():
+            stream.sink.abort()
+        self.streams.clear()
+
+
+class OutgoingStream:
+    """
+    The flow-control state of a stream being sent.
+    """
+    def __init__(self, window: int):
+        self.window = window
+        self.sent = 0
+        self.acknowledged = 0
+        self.closed = False
+        self.condition = Condition()
+
+    def acknowledge(self, consumed: int) -> None:
+        with self.condition:
+            self.acknowledged = max(self.acknowledged, consumed)
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait_window(self, size: int) -> None:
+        """
+        Block until {size} more bytes fit in the window.
+        :raise ConnectionError: if the connection is closed meanwhile.
+        """
+        with self.condition:
+            while not self.closed and self.sent + size - self.acknowledged > self.window:
+                self.condition.wait()
+            if self.closed:
+                raise ConnectionError('Stream closed.')
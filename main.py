@@ -1,9 +1,12 @@
 import sys
 from PyQt5.QtWidgets import QApplication
 from main_window import MainWindow
+from monitoring.export import export_from_args
+from storage.trace import recorder_from_args
 
 if __name__ == '__main__':
+    export_from_args(sys.argv)
     app = QApplication(sys.argv)
-    win = MainWindow()
+    win = MainWindow(use_asyncio='--asyncio' in sys.argv, recorder=recorder_from_args(sys.argv))
     win.show()
     sys.exit(app.exec())
@@ -1,11 +1,25 @@
+import os
 import socket
+import sys
+from functools import partial
+from concurrent.futures import Future
 from threading import Thread
+from typing import Dict, List, Optional
 
-from interaction.protocol import Interactor
+from capture.group import CaptureGroup, FrameGroup
+from capture.scheduler import Capture, CaptureScheduler
+from imaging.picture_cache import PictureCache, send_picture_to_displays
+from interaction.protocol import Interactor, recv_handshake, send_buffers
+from interaction.handshake import Handshake
+from interaction.async_server import AsyncServer
+from interaction.registry import DeviceRegistry
 from interaction.bundle import Bundle
+from interaction.payload import FilePayload
 from interaction.byte_enum import ERequest, EResponse
-
-i = 0
+from monitoring.export import export_from_args
+from storage.frame_store import FrameStore
+from storage.trace import TraceRecorder, recorder_from_args
+from storage.writer import FrameWriter
 
 
 def digest_response(bundle: Bundle) -> None:
@@ -14,22 +28,16 @@ def digest_response(bundle: Bundle) -> None:
     :param bundle: The bundle instance for the request.
     :return: None
     """
-    global i
-    print(f'ClientResp: {bundle}')
-    if bundle.request == ERequest.CAMERA_TAKE_PICTURE:
-        with open(f'{i}.jpeg', 'wb+') as file:
-            file.write(bundle.args)
-        print(f'File saved: {i}.jpeg')
-        i += 1
+    if bundle.request == ERequest.CAMERA_TAKE_PICTURE or bundle.request == ERequest.DISPLAY_TAKE_PICTURE:
+        # pictures are stored by whoever requested them, which knows the device and the camera
+        print('Picture OK')
     elif bundle.request == ERequest.CAMERA_TOGGLE_TORCH:
         print('Toggle OK')
-    elif bundle.request == ERequest.DISPLAY_TAKE_PICTURE:
-        with open(f'{i}.jpeg', 'wb+') as file:
-            file.write(bundle.args)
-        print(f'File saved: {i}.jpeg')
-        i += 1
     elif bundle.request == ERequest.DISPLAY_SHOW_PICTURE:
         print('Display OK')
+    elif bundle.request == ERequest.DISPLAY_SHOW_CACHED_PICTURE:
+        # a display which doesn't hold the picture gets it in full right after
+        print('Display OK' if bundle.response == EResponse.OK else 'Display: not cached')
     else:
         print('Unknown')
     print()
@@ -52,30 +60,54 @@ def handle_client_request(bundle: Bundle) -> Bundle:
 
 class MainConsole(Thread):
     PORT = 58431
+    CAPTURE_TIMEOUT = 30.0
+    FRAME_DIRECTORY = 'frames'
+    SCHEDULE_POLICIES = {'skip': CaptureScheduler.SKIP,
+                         'late': CaptureScheduler.FIRE_LATE,
+                         'restart': CaptureScheduler.RESTART}
 
-    def __init__(self):
+    def __init__(self, use_asyncio: bool = False, recorder: Optional[TraceRecorder] = None):
+        """
+        :param use_asyncio: Serve every client on one asyncio event loop instead of a thread per client.
+        :param recorder: Records the session of every client, see TraceRecorder.
+        """
         super(MainConsole, self).__init__()
 
-        self.camera_handler: Interactor = None
-        self.display_handler: Interactor = None
-        self.request_id = 0
+        self.devices = DeviceRegistry()
+        self.devices.recorder = recorder
+        self.scheduler: Optional[CaptureScheduler] = None
+        # frames are written on an I/O thread, never on the thread receiving them
+        self.pictures = PictureCache()
+        self.frames = FrameWriter(FrameStore(MainConsole.FRAME_DIRECTORY))
 
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind(('0.0.0.0', MainConsole.PORT))
-        self.server.listen(10)
+        if use_asyncio:
+            self.server = AsyncServer(MainConsole.PORT,
+                                      handle_client_request,
+                                      digest_response,
+                                      self.accept_client,
+                                      self.client_disconnected)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind(('0.0.0.0', MainConsole.PORT))
+            self.server.listen(10)
 
     def run(self) -> None:
         # start socket thread
-        Thread(target=MainConsole.listen, args=(self,)).start()
+        if isinstance(self.server, AsyncServer):
+            self.server.start()
+        else:
+            Thread(target=MainConsole.listen, args=(self,)).start()
 
         while True:
             line = input().split(' ')
 
-            self.request_id += 1
-            if self.request_id > Interactor.MAX_REQ_ID:
-                self.request_id = 0
+            # a trailing '@device_id' sends the request to that device only
+            device_id = None
+            if len(line) > 1 and line[-1].startswith('@'):
+                device_id = line.pop()[1:]
 
-            bundle: Bundle = Bundle(self.request_id, ERequest.NONE)
+            # request IDs are allocated by each device when the request is sent
+            bundle: Bundle = Bundle(None, ERequest.NONE)
             if len(line) > 0:
                 if line[0] == 'cmd':
                     if len(line) > 1:
@@ -97,36 +129,178 @@ class MainConsole(Thread):
                                 print('cmd -d [filename]')
                             else:
                                 path = str.join(' ', line[2:])
-                                with open(path, 'rb+') as file:
-                                    bundle.args = file.read()
-                                bundle.request = ERequest.DISPLAY_SHOW_PICTURE
+                                try:
+                                    bundle.args = FilePayload(path)
+                                    bundle.request = ERequest.DISPLAY_SHOW_PICTURE
+                                except OSError as e:
+                                    print(f'Cannot show {path}: {e}')
                         else:
                             print('cmd [-c(capture) or -t(torch) or -d(display)]')
                     else:
                         print('cmd [-c(capture) or -t(torch) or -d(display)]')
+                elif line[0] == 'group':
+                    try:
+                        self.capture_group(line[1:]).fire()
+                    except ValueError:
+                        print('group [front|rear|display[@device_id] ...]')
+                elif line[0] == 'schedule':
+                    self.schedule(line[1:])
                 elif line[0] == 'quit':
                     bundle.request = ERequest.ANY_QUIT
+                elif line[0] == 'frames':
+                    print(f'{len(self.frames.store)} frames stored, {self.frames.depth} queued '
+                          f'(peak {self.frames.peak_depth} of {self.frames.max_queue}), {self.frames.dropped} dropped')
+                elif line[0] == 'list':
+                    for role in DeviceRegistry.ROLES:
+                        for name in self.devices.by_role(role):
+                            print(f'{role.name.lower()}: {name}')
                 else:
                     print('unknown command')
 
             if bundle.request != ERequest.NONE:
-                if bundle.request.is_for_camera():
-                    if self.camera_handler is None:
+                if bundle.request == ERequest.DISPLAY_SHOW_PICTURE:
+                    futures = self.show_picture(bundle.args.path, device_id)
+                else:
+                    futures = self.devices.request_devices(bundle, device_id)
+                if bundle.request == ERequest.CAMERA_TAKE_PICTURE or bundle.request == ERequest.DISPLAY_TAKE_PICTURE:
+                    cam_id = bundle.args[0] if len(bundle.args) > 0 else None
+                    for name, future in futures.items():
+                        future.add_done_callback(partial(self.capture_received, name, cam_id))
+                if len(futures) == 0:
+                    if device_id is not None:
+                        print(f'There is no device {device_id}')
+                    elif bundle.request.is_for_any():
+                        print('There is no client')
+                    elif bundle.request.is_for_camera():
                         print('There is no camera')
                     else:
-                        self.camera_handler.request(bundle)
-                elif bundle.request.is_for_display():
-                    if self.display_handler is None:
                         print('There is no display')
-                    else:
-                        self.display_handler.request(bundle)
-                elif bundle.request.is_for_any():
-                    if self.camera_handler is not None:
-                        self.camera_handler.request(bundle)
-                        self.camera_handler = None
-                    if self.display_handler is not None:
-                        self.display_handler.request(bundle)
-                        self.display_handler = None
+
+    def schedule(self, args: List[str]) -> None:
+        """
+        Start or stop a time-lapse.
+            schedule [interval] [steps] [skip|late|restart] [front|rear|display[@device_id] ...]
+            schedule stop
+        Without captures, every step captures with the front, rear and display cameras.
+        :param args: The arguments of the command.
+        :return: None
+        """
+        usage = 'schedule [interval] [steps] [skip|late|restart] [front|rear|display ...] or schedule stop'
+        if len(args) == 0:
+            print(usage)
+            return
+        if args[0] == 'stop':
+            if self.scheduler is not None:
+                self.scheduler.interrupt()
+            else:
+                print('There is no schedule')
+            return
+        if self.scheduler is not None:
+            print('A schedule is already running')
+            return
+
+        try:
+            interval = float(args[0])
+            args = args[1:]
+            steps = None
+            if len(args) > 0 and args[0].isdigit():
+                steps = int(args.pop(0))
+            policy = CaptureScheduler.SKIP
+            if len(args) > 0 and args[0] in MainConsole.SCHEDULE_POLICIES:
+                policy = MainConsole.SCHEDULE_POLICIES[args.pop(0)]
+            group = self.capture_group(args)
+        except ValueError:
+            print(usage)
+            return
+
+        print(f'Schedule: every {interval} s, {str.join(", ", map(str, group.captures))}')
+        self.scheduler = CaptureScheduler(interval,
+                                          group.step,
+                                          steps,
+                                          policy,
+                                          on_finished=self.schedule_finished)
+        self.scheduler.start()
+
+    def show_picture(self, path: str, device_id: Optional[str]) -> Dict[str, Future]:
+        """
+        Show a picture on displays, transcoded for each of them,
+        and sending only its digest to the displays which already hold it.
+        :param path: The file of the picture.
+        :param device_id: The display to show it on, or None for the default display.
+        :return: The futures of the responses keyed by device ID.
+        """
+        try:
+            return send_picture_to_displays(self.devices, self.pictures, path, device_id)
+        except (OSError, ValueError) as e:
+            print(f'Cannot show {path}: {e}')
+            return {}
+
+    def capture_group(self, names: List[str]) -> CaptureGroup:
+        """
+        :param names: The captures of the group, e.g. 'front' or 'display@device_id', or none for all of them.
+        :return: The capture group.
+        :raise ValueError: if a name is unknown.
+        """
+        captures = [Capture.parse(name) for name in (names or Capture.ALL)]
+        return CaptureGroup(self.devices, captures, MainConsole.CAPTURE_TIMEOUT, self.group_captured)
+
+    def group_captured(self, group: FrameGroup) -> None:
+        print(f'Captured {group}')
+        for frame in group.received:
+            cam_id = frame.capture.args[0] if len(frame.capture.args) > 0 else None
+            self.store_picture(frame.bundle, frame.device_id, cam_id, frame.timestamp)
+
+    def capture_received(self, device_id: str, cam_id: Optional[int], future: Future) -> None:
+        if future.exception() is None:
+            self.store_picture(future.result(), device_id, cam_id)
+
+    def store_picture(self,
+                      bundle: Bundle,
+                      device_id: Optional[str],
+                      cam_id: Optional[int],
+                      timestamp: Optional[float] = None) -> None:
+        """
+        Queue a captured picture for the frame store.
+        :param bundle: The response bundle carrying the picture.
+        :param device_id: The device which captured it.
+        :param cam_id: The camera which captured it, if the device has several.
+        :param timestamp: The wall-clock time it was received at, or None for now.
+        :return: None
+        """
+        future = self.frames.submit(bundle.args, device_id, cam_id, bundle.request_id, bundle.request, timestamp)
+        future.add_done_callback(partial(MainConsole.picture_stored, bundle))
+
+    @staticmethod
+    def picture_stored(bundle: Bundle, future: Future) -> None:
+        if future.exception() is None:
+            print(f'Frame stored: #{future.result()}')
+        # a streamed picture arrives in a temporary file, which is not needed once stored
+        if isinstance(bundle.args, FilePayload):
+            os.remove(bundle.args.path)
+
+    def schedule_finished(self, scheduler: CaptureScheduler) -> None:
+        print(f'Schedule: finished, {scheduler.stats}')
+        self.scheduler = None
+
+    def accept_client(self, handshake: Handshake, handler) -> EResponse:
+        """
+        Evaluate the role proposed by a new client and register it.
+        :param handshake: The handshake sent by the client.
+        :param handler: The Interactor or AsyncInteractor serving the client.
+        :return: OK if the client is accepted, ERROR otherwise.
+        """
+        return self.devices.accept(handshake, handler)
+
+    def client_disconnected(self, handler) -> None:
+        """
+        Unregister a disconnected client.
+        :param handler: The Interactor or AsyncInteractor which served the client.
+        :return: None
+        """
+        entry = self.devices.unregister(handler)
+        if entry is not None:
+            device_id, role = entry
+            print(f'{role.name.capitalize()} disconnected: {device_id}')
 
     def listen(self):
         print('Listen: Start listening')
@@ -134,48 +308,53 @@ class MainConsole(Thread):
             # accept client to evaluate
             client, address = self.server.accept()
             print(f'Listen: accept, {address}')
-            client.recv(4)  # skip message length
-            data = client.recv(Interactor.BUFFER_SIZE)
-            bundle = Bundle.from_bytes(data)
-            role = bundle.request
-
-            # evaluate proposed role
-            if role == ERequest.CAMERA:
-                if self.camera_handler is not None:
-                    print(f'Listen: camera, error')
-                    bundle.response = EResponse.ERROR
-                else:
-                    print(f'Listen: camera, ok')
-
-                    def on_disconnected():
-                        self.camera_handler = None
-                        print('Camera disconnected')
-
-                    self.camera_handler = Interactor(client,
-                                                     handle_client_request,
-                                                     digest_response,
-                                                     on_disconnected)
-                    self.camera_handler.start()
-                    bundle.response = EResponse.OK
-            elif role == ERequest.DISPLAY:
-                if self.display_handler is not None:
-                    print(f'Listen: display, error')
-                    bundle.response = EResponse.ERROR
+            handler = None
+            try:
+                data = recv_handshake(client, Interactor.HANDSHAKE_TIMEOUT)
+                if data is None or len(data) < 3:
+                    print(f'Listen: invalid handshake, {address}')
+                    client.close()
+                    continue
+                try:
+                    bundle = Bundle.from_bytes(data)
+                except ValueError as e:
+                    print(f'Listen: invalid handshake, {address}, {e}')
+                    client.close()
+                    continue
+                handshake = Handshake.from_bundle(bundle)
+
+                handler = Interactor(client,
+                                     handle_client_request,
+                                     digest_response,
+                                     None,
+                                     padding=handshake.padding,
+                                     streaming=handshake.streaming,
+                                     heartbeat=handshake.heartbeat,
+                                     codec=handshake.frame_codec)
+                handler.on_disconnected = partial(self.client_disconnected, handler)
+                # other threads can send requests to the handler as soon as it is registered, e.g. broadcasts,
+                # and they wait on its send lock so that the reply is the first frame the client receives
+                with handler.send_lock:
+                    bundle.response = self.accept_client(handshake, handler)
+                    # only clients which sent handshake fields expect a reply
+                    if handshake.negotiated:
+                        send_buffers(client, Interactor.frame(handshake.reply(bundle.response), handshake.padding))
+                if bundle.response == EResponse.OK:
+                    handler.start()
                 else:
-                    print(f'Listen: display, ok')
-
-                    def on_disconnected():
-                        self.display_handler = None
-                        print('Display disconnected')
-
-                    self.display_handler = Interactor(client,
-                                                      handle_client_request,
-                                                      digest_response,
-                                                      on_disconnected)
-                    self.display_handler.start()
-                    bundle.response = EResponse.OK
-            else:
-                print(f'Listen: unknown')
-                bundle.response = EResponse.ERROR
+                    client.close()
+
+                handle_client_request(bundle)
+            except OSError as e:
+                # e.g. the client reset right after its handshake; the listener goes on
+                print(f'Listen: {address} lost during the handshake, {e}')
+                if handler is not None:
+                    self.client_disconnected(handler)
+                    handler.abandon()
+                client.close()
+
 
-            handle_client_request(bundle)
+if __name__ == '__main__':
+    export_from_args(sys.argv)
+    console = MainConsole(use_asyncio='--asyncio' in sys.argv, recorder=recorder_from_args(sys.argv))
+    console.start()
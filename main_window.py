@@ -1,21 +1,37 @@
 import os
-import io
-from typing import Any
+from functools import partial
+from typing import List, Optional, Tuple, Union
 from enum import Enum
 import socket
+from concurrent.futures import Future
 
 import cv2.cv2 as cv2
-from PyQt5.QtCore import QSize, QRect, QMetaObject, QCoreApplication, pyqtSignal
-from PyQt5.QtWidgets import QMainWindow, QWidget, QLabel, QPushButton, QGroupBox, QFileDialog
-from PyQt5.QtGui import QColor, QPalette, QPixmap, QMouseEvent, QCloseEvent
+from PyQt5.QtCore import Qt, QSize, QRect, QMetaObject, QCoreApplication, pyqtSignal
+from PyQt5.QtWidgets import QMainWindow, QWidget, QLabel, QPushButton, QGroupBox, QFileDialog, QDoubleSpinBox
+from PyQt5.QtGui import QColor, QPalette, QPixmap, QImage, QMouseEvent, QCloseEvent
 
 import numpy as np
-from PIL import Image
 
+from analysis.executor import AnalysisExecutor
+from analysis.kinetics import KineticsModel
+from analysis.solubility import AnalysisResult, SolubilityAnalyzer
+from capture.group import CaptureGroup, FrameGroup
+from capture.scheduler import Capture, CaptureScheduler
+from gui_dispatcher import GuiDispatcher
+from imaging.picture_cache import CachedPicture, PictureCache, display_profiles, send_picture_to_displays
+from imaging.pipeline import ImagePipeline, decode_image
 from interruptable_thread import InterruptableThread
-from interaction.protocol import Interactor
+from interaction.protocol import Interactor, recv_handshake, send_buffers
+from interaction.handshake import Handshake
+from interaction.async_server import AsyncServer
+from interaction.registry import DeviceRegistry
 from interaction.bundle import Bundle
+from interaction.payload import FilePayload, materialize
 from interaction.byte_enum import ERequest, EResponse
+from monitoring.metrics import METRICS
+from storage.frame_store import FrameStore
+from storage.trace import TraceRecorder
+from storage.writer import FrameWriter
 
 
 def set_widget_background_color(widget: QWidget, color: QColor):
@@ -27,17 +43,19 @@ def set_widget_background_color(widget: QWidget, color: QColor):
     widget.show()
 
 
-def show_image(view: QLabel, data: bytes):
-    pixmap = QPixmap()
-    if pixmap.loadFromData(data, 'JPEG'):
-        if pixmap.width() > pixmap.height():
-            pixmap = pixmap.scaledToWidth(view.width())
-        elif pixmap.width() < pixmap.height():
-            pixmap = pixmap.scaledToHeight(view.height())
+def show_image(view: QLabel, image: np.ndarray):
+    """
+    Show a decoded RGB image, wrapping its buffer in a QImage instead of decoding it again.
+    """
+    height, width = image.shape[:2]
+    qimage = QImage(image.data, width, height, image.strides[0], QImage.Format_RGB888)
+    if width > height:
+        qimage = qimage.scaledToWidth(view.width(), Qt.SmoothTransformation)
+    elif width < height:
+        qimage = qimage.scaledToHeight(view.height(), Qt.SmoothTransformation)
 
-        view.setPixmap(pixmap)
-    else:
-        raise ValueError('Failed to load image.')
+    # fromImage copies the pixels, so {image} may be released afterwards
+    view.setPixmap(QPixmap.fromImage(qimage))
 
 
 class MainWindow(QMainWindow):
@@ -60,10 +78,16 @@ class MainWindow(QMainWindow):
             self.double_clicked.emit(a0)
 
     PORT = 58431
+    CAPTURE_TIMEOUT = 30.0
+    FRAME_DIRECTORY = 'frames'
     instance = None
 
     # noinspection PyTypeChecker
-    def __init__(self):
+    def __init__(self, use_asyncio: bool = False, recorder: Optional[TraceRecorder] = None):
+        """
+        :param use_asyncio: Serve every client on one asyncio event loop instead of a thread per client.
+        :param recorder: Records the session of every client, see TraceRecorder.
+        """
         super(QMainWindow, self).__init__()
 
         # MainWindow
@@ -80,6 +104,15 @@ class MainWindow(QMainWindow):
         self.torch_toggle_button.setGeometry(QRect(280, 210, 75, 23))
         self.torch_toggle_button.setObjectName("torch_toggle_button")
 
+        # # Time-lapse
+        self.time_lapse_button = QPushButton(self.central_widget)
+        self.time_lapse_button.setGeometry(QRect(360, 210, 75, 23))
+        self.time_lapse_button.setObjectName("time_lapse_button")
+
+        self.time_lapse_interval_box = QDoubleSpinBox(self.central_widget)
+        self.time_lapse_interval_box.setGeometry(QRect(440, 210, 85, 23))
+        self.time_lapse_interval_box.setObjectName("time_lapse_interval_box")
+
         # # Front Camera
         self.front_camera_view = QLabel(self.central_widget)
         self.front_camera_view.setGeometry(QRect(10, 10, 256, 158))
@@ -129,6 +162,10 @@ class MainWindow(QMainWindow):
         self.send_image_to_display_button.setGeometry(QRect(10, 395, 75, 23))
         self.send_image_to_display_button.setObjectName("send_image_to_display_button")
 
+        self.capture_all_button = QPushButton(self.central_widget)
+        self.capture_all_button.setGeometry(QRect(450, 240, 75, 23))
+        self.capture_all_button.setObjectName("capture_all_button")
+
         # Client States
         self.client_state_group_box = QGroupBox(self.central_widget)
         self.client_state_group_box.setGeometry(QRect(280, 238, 161, 91))
@@ -159,32 +196,57 @@ class MainWindow(QMainWindow):
         QMetaObject.connectSlotsByName(self)
 
         # Starting Socket Interaction
-        self.camera_handler: Interactor = None
-        self.display_handler: Interactor = None
-        self.request_id = 0
+        self.devices = DeviceRegistry()
+        self.devices.recorder = recorder
+        self.dispatcher = GuiDispatcher(self)
+        # the view of each manual capture by request and request ID
         self.capture_requests = {}
+        # every camera captures at once for a frame group, which is analyzed as one unit
+        self.capture_group = CaptureGroup(self.devices,
+                                          [Capture.parse(name) for name in Capture.ALL],
+                                          MainWindow.CAPTURE_TIMEOUT,
+                                          self.on_frame_group)
+        self.scheduler: Optional[CaptureScheduler] = None
+        # frames are written on an I/O thread, never on the thread receiving them
+        self.frames = FrameWriter(FrameStore(MainWindow.FRAME_DIRECTORY))
+        # captured images are decoded once for both the preview and process_image
+        self.pipeline = ImagePipeline((self.front_camera_view.width(), self.front_camera_view.height()))
         self.image_path = ''
+        self.pictures = PictureCache()
+        self.displaying_picture: Optional[CachedPicture] = None
+        self.pattern_digest: Optional[bytes] = None
+        self.analyzer = SolubilityAnalyzer()
+        # frames are analyzed on worker processes so that the receive threads never wait for them
+        self.analysis = AnalysisExecutor(self.analyzer, self.on_analysis_result)
+        # the curve of every vial is followed across frame groups, and a time-lapse stops once they all plateau
+        self.kinetics = KineticsModel(self.on_saturated)
+
+        if use_asyncio:
+            # the event loop runs on its own thread and the handlers are called from it
+            self.server = AsyncServer(MainWindow.PORT,
+                                      MainWindow.handle_client_request,
+                                      MainWindow.digest_response,
+                                      self.accept_client,
+                                      self.client_disconnected)
+            self.listener = self.server
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind(('0.0.0.0', MainWindow.PORT))
+            self.server.listen(10)
 
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind(('0.0.0.0', MainWindow.PORT))
-        self.server.listen(10)
-
-        self.listener = InterruptableThread(MainWindow.listen, (self,))
+            self.listener = InterruptableThread(MainWindow.listen, (self,))
         self.listener.start()
 
         MainWindow.instance = self
 
-    def increase_request_id(self) -> int:
-        self.request_id += 1
-        if self.request_id > Interactor.MAX_REQ_ID:
-            self.request_id = 0
-        return self.request_id
-
     def init_translation(self):
         _translate = QCoreApplication.translate
         self.setWindowTitle(_translate("main_window", "Solubility Measurement"))
 
         self.torch_toggle_button.setText(_translate("main_window", "Torch"))
+        self.time_lapse_button.setText(_translate("main_window", "Time-lapse"))
+        self.capture_all_button.setText(_translate("main_window", "Capture All"))
+        self.time_lapse_interval_box.setSuffix(_translate("main_window", " s"))
 
         self.front_camera_capture_button.setText(_translate("main_window", "Capture"))
         self.front_camera_label.setText(_translate("main_window", "Front Camera"))
@@ -211,6 +273,9 @@ class MainWindow(QMainWindow):
         set_widget_background_color(self.display_state_view, MainWindow.Theme.STATE_UNAVAILABLE.value)
 
         self.torch_toggle_button.setEnabled(False)
+        self.capture_all_button.setEnabled(False)
+        self.time_lapse_interval_box.setRange(0.1, 86400.0)
+        self.time_lapse_interval_box.setValue(60.0)
         self.front_camera_capture_button.setEnabled(False)
         self.rear_camera_capture_button.setEnabled(False)
         self.display_camera_capture_button.setEnabled(False)
@@ -223,39 +288,40 @@ class MainWindow(QMainWindow):
     def init_events(self):
         def request_toggle_torch(_: QMouseEvent):
             self.torch_toggle_button.setEnabled(False)
-            bundle = Bundle(self.increase_request_id(), ERequest.CAMERA_TOGGLE_TORCH)
-            self.camera_handler.request(bundle)
+            bundle = Bundle(None, ERequest.CAMERA_TOGGLE_TORCH)
+            self.devices.request(bundle)
         self.torch_toggle_button.clicked.connect(request_toggle_torch)
 
+        # captures are pipelined, so the buttons stay enabled while they are in flight
         def request_front_capture(_: QMouseEvent):
-            self.front_camera_capture_button.setEnabled(False)
-            self.rear_camera_capture_button.setEnabled(False)
-            bundle = Bundle(self.increase_request_id(), ERequest.CAMERA_TAKE_PICTURE, bytes([1]))
-            self.camera_handler.request(bundle)
-            self.capture_requests[bundle.request_id] = 1
+            self.request_capture(1)
         self.front_camera_capture_button.clicked.connect(request_front_capture)
 
         def request_rear_capture(_: QMouseEvent):
-            self.front_camera_capture_button.setEnabled(False)
-            self.rear_camera_capture_button.setEnabled(False)
-            bundle = Bundle(self.increase_request_id(), ERequest.CAMERA_TAKE_PICTURE, bytes([0]))
-            self.camera_handler.request(bundle)
-            self.capture_requests[bundle.request_id] = 0
+            self.request_capture(0)
         self.rear_camera_capture_button.clicked.connect(request_rear_capture)
 
         def request_display_capture(_: QMouseEvent):
             self.display_camera_capture_button.setEnabled(False)
-            bundle = Bundle(self.increase_request_id(), ERequest.DISPLAY_TAKE_PICTURE)
-            self.display_handler.request(bundle)
+            self.request_display_capture()
         self.display_camera_capture_button.clicked.connect(request_display_capture)
 
+        def request_capture_all(_: QMouseEvent):
+            self.capture_group.fire()
+        self.capture_all_button.clicked.connect(request_capture_all)
+
+        def toggle_time_lapse(_: QMouseEvent):
+            if self.scheduler is not None:
+                self.scheduler.interrupt()
+            else:
+                self.start_time_lapse(self.time_lapse_interval_box.value())
+        self.time_lapse_button.clicked.connect(toggle_time_lapse)
+
         def request_displaying_image(_: QMouseEvent):
             if os.path.exists(self.image_path):
                 # self.send_image_to_display_button.setEnabled(False)
-                with open(self.image_path, 'rb') as file:
-                    image = file.read()
-                bundle = Bundle(self.increase_request_id(), ERequest.DISPLAY_SHOW_PICTURE, image)
-                self.display_handler.request(bundle)
+                # the picture is prepared and sent on the worker of the cache
+                self.pictures.worker.submit(self.show_picture, self.image_path)
             else:
                 self.image_path_label.setText("File doesn't exist.")
         self.send_image_to_display_button.clicked.connect(request_displaying_image)
@@ -268,6 +334,8 @@ class MainWindow(QMainWindow):
             if len(file_names) == 0:
                 return
             self.image_path = file_names[0]
+            # transcode for the connected displays before the picture is sent
+            self.pictures.prepare(self.image_path, [None] + display_profiles(self.devices))
 
             file_name = self.image_path.split(os.sep)[-1]
             self.image_path_label.setText(file_name)
@@ -277,87 +345,291 @@ class MainWindow(QMainWindow):
         # noinspection PyUnresolvedReferences
         self.image_path_label.double_clicked.connect(browse_image)
 
+    def request_capture(self, cam_id: int) -> Optional[Future]:
+        """
+        Capture with a camera of the default camera device. This is safe to call from any thread.
+        :param cam_id: 1 for the front camera, 0 for the rear camera.
+        :return: The future of the response, or None if there is no camera.
+        """
+        handler = self.devices.default(ERequest.CAMERA)
+        if handler is None:
+            return None
+        # the view is looked up by request ID, so the ID is allocated before the request is sent
+        bundle = Bundle(handler.pending.allocate(), ERequest.CAMERA_TAKE_PICTURE, bytes([cam_id]))
+        view = self.front_camera_view if cam_id == 1 else self.rear_camera_view
+        key = (bundle.request, bundle.request_id)
+        self.capture_requests[key] = view
+        future = handler.request(bundle, MainWindow.CAPTURE_TIMEOUT)
+        future.add_done_callback(partial(self.capture_received, self.devices.device_id(handler), cam_id, key))
+        return future
+
+    def request_display_capture(self) -> Optional[Future]:
+        """
+        Capture with the camera of the default display device. This is safe to call from any thread.
+        :return: The future of the response, or None if there is no display.
+        """
+        handler = self.devices.default(ERequest.DISPLAY)
+        if handler is None:
+            return None
+        bundle = Bundle(handler.pending.allocate(), ERequest.DISPLAY_TAKE_PICTURE)
+        key = (bundle.request, bundle.request_id)
+        self.capture_requests[key] = self.display_camera_view
+        future = handler.request(bundle, MainWindow.CAPTURE_TIMEOUT)
+        future.add_done_callback(partial(self.capture_received, self.devices.device_id(handler), None, key))
+        return future
+
+    def capture_received(self,
+                         device_id: str,
+                         cam_id: Optional[int],
+                         key: Tuple[ERequest, int],
+                         future: Future) -> None:
+        """
+        Store and show a capture requested from the GUI. It runs on a network thread once the request completes,
+        whether it succeeded or not, so that its view is never left in {capture_requests}.
+        :param key: The request and request ID the view was registered under.
+        :return: None
+        """
+        view = self.capture_requests.pop(key, None)
+        if key[0] == ERequest.DISPLAY_TAKE_PICTURE:
+            self.dispatcher.call(self.display_camera_capture_button.setEnabled, True)
+        if future.exception() is not None:
+            print(f'Capture failed: {future.exception()}')
+            return
+
+        bundle = future.result()
+        self.store_picture(bundle, device_id, cam_id)
+        if view is not None:
+            with METRICS.timer('decode_seconds', device_id, bundle.request):
+                img = self.pipeline.decode(bundle.view())
+            self.dispatcher.render(view, partial(show_image, view), img)
+            MainWindow.process_image(img, view.objectName())
+
+    def store_picture(self,
+                      bundle: Bundle,
+                      device_id: Optional[str],
+                      cam_id: Optional[int],
+                      timestamp: Optional[float] = None) -> None:
+        """
+        Queue a captured picture for the frame store.
+        :param bundle: The response bundle carrying the picture.
+        :param device_id: The device which captured it.
+        :param cam_id: The camera which captured it, if the device has several.
+        :param timestamp: The wall-clock time it was received at, or None for now.
+        :return: None
+        """
+        if isinstance(bundle.args, FilePayload):
+            # the picture is still decoded for the views once its file is removed, so it is mapped beforehand
+            bundle.args.view()
+        future = self.frames.submit(bundle.args, device_id, cam_id, bundle.request_id, bundle.request, timestamp)
+        future.add_done_callback(partial(MainWindow.picture_stored, bundle))
+
+    @staticmethod
+    def picture_stored(bundle: Bundle, future: Future) -> None:
+        if future.exception() is None:
+            print(f'Frame stored: #{future.result()}')
+        # a streamed picture arrives in a temporary file, which is not needed once stored
+        if isinstance(bundle.args, FilePayload):
+            try:
+                os.remove(bundle.args.path)
+            except OSError as e:
+                print(f'Cannot remove {bundle.args.path}: {e}')
+
+    def show_picture(self, path: str) -> None:
+        """
+        Show a picture on the displays, transcoded for each of them. It runs on the worker of the picture cache.
+        :param path: The file of the picture.
+        :return: None
+        """
+        try:
+            # the source picture is kept as the pattern of the analysis
+            self.displaying_picture = self.pictures.get(path)
+            send_picture_to_displays(self.devices, self.pictures, path)
+        except (OSError, ValueError) as e:
+            print(f'Cannot show {path}: {e}')
+            self.dispatcher.call(self.image_path_label.setText, 'Error occurred.')
+
+    def capture_view(self, name: str) -> QLabel:
+        """
+        :return: The view showing the capture named {name}.
+        """
+        if name == 'front':
+            return self.front_camera_view
+        if name == 'rear':
+            return self.rear_camera_view
+        return self.display_camera_view
+
+    def on_frame_group(self, group: FrameGroup) -> None:
+        """
+        Show the frames of a group and queue them for analysis together. It runs on a network thread.
+        :param group: The frames captured together.
+        :return: None
+        """
+        print(f'Captured {group}')
+        images = []
+        for frame in group.received:
+            cam_id = frame.capture.args[0] if len(frame.capture.args) > 0 else None
+            self.store_picture(frame.bundle, frame.device_id, cam_id, frame.timestamp)
+            view = self.capture_view(frame.capture.name)
+            with METRICS.timer('decode_seconds', frame.device_id, frame.capture.request):
+                img = self.pipeline.decode(frame.bundle.view())
+            self.dispatcher.render(view, partial(show_image, view), img)
+            images.append(img)
+        if len(images) > 0:
+            self.analysis.submit_group(images, group)
+
+    def start_time_lapse(self, interval: float) -> None:
+        """
+        Capture a frame group every {interval} seconds until stopped or until the dissolution ends.
+        The kinetics start over, so that the curves of a former run can't end this one.
+        Must run on the GUI thread.
+        :param interval: Seconds between groups.
+        :return: None
+        """
+        self.kinetics.reset()
+        self.scheduler = CaptureScheduler(interval, self.capture_group.step, on_finished=self.on_schedule_finished)
+        self.scheduler.start()
+        self.time_lapse_button.setText('Stop')
+        self.time_lapse_interval_box.setEnabled(False)
+
+    def on_schedule_finished(self, scheduler: CaptureScheduler) -> None:
+        print(f'Schedule: finished, {scheduler.stats}')
+        self.dispatcher.call(self.reset_time_lapse_controls)
+
+    def on_saturated(self, kinetics: KineticsModel) -> None:
+        """
+        Stop the time-lapse once every curve reached its plateau. It runs on a thread of the executor.
+        :param kinetics: The saturated model.
+        :return: None
+        """
+        scheduler = self.scheduler
+        print(f'Kinetics: all {len(kinetics.curves)} curves saturated')
+        if scheduler is not None:
+            print('Schedule: stopping, the dissolution ended')
+            scheduler.interrupt()
+
+    def reset_time_lapse_controls(self) -> None:
+        self.scheduler = None
+        self.time_lapse_button.setText('Time-lapse')
+        self.time_lapse_interval_box.setEnabled(True)
+
+    def accept_client(self, handshake: Handshake, handler) -> EResponse:
+        """
+        Evaluate the role proposed by a new client and register it.
+        The views show the default device of each role.
+        :param handshake: The handshake sent by the client.
+        :param handler: The Interactor or AsyncInteractor serving the client.
+        :return: OK if the client is accepted, ERROR otherwise.
+        """
+        response = self.devices.accept(handshake, handler)
+        if response == EResponse.OK:
+            self.dispatcher.call(self.update_role_controls, handshake.role)
+        return response
+
+    def client_disconnected(self, handler) -> None:
+        """
+        Unregister a disconnected client.
+        The controls of a role are disabled once its last device is gone.
+        :param handler: The Interactor or AsyncInteractor which served the client.
+        :return: None
+        """
+        entry = self.devices.unregister(handler)
+        if entry is None:
+            return
+        device_id, role = entry
+        print(f'{role.name.capitalize()} disconnected: {device_id}')
+        self.dispatcher.call(self.update_role_controls, role)
+
+    def update_role_controls(self, role: ERequest) -> None:
+        """
+        Enable the controls of {role} while any device has it. Must run on the GUI thread.
+        :param role: CAMERA or DISPLAY.
+        :return: None
+        """
+        available = self.devices.has_role(role)
+        self.capture_all_button.setEnabled(len(self.devices) > 0)
+        theme = MainWindow.Theme.STATE_AVAILABLE if available else MainWindow.Theme.STATE_UNAVAILABLE
+        if role == ERequest.CAMERA:
+            self.torch_toggle_button.setEnabled(available)
+            self.rear_camera_capture_button.setEnabled(available)
+            self.front_camera_capture_button.setEnabled(available)
+            set_widget_background_color(self.camera_state_view, theme.value)
+        elif role == ERequest.DISPLAY:
+            self.display_camera_capture_button.setEnabled(available)
+            if not available:
+                self.send_image_to_display_button.setEnabled(False)
+            set_widget_background_color(self.display_state_view, theme.value)
+
     def listen(self):
         print('Listen: Start listening')
         while True:
             # accept client to evaluate
             try:
                 client, address = self.server.accept()
-                print(f'Listen: accept, {address}')
-                client.recv(4)  # skip message length
-                data = client.recv(Interactor.BUFFER_SIZE)
-                bundle = Bundle.from_bytes(data)
-                role = bundle.request
-
-                # evaluate proposed role
-                if role == ERequest.CAMERA:
-                    if self.camera_handler is not None:
-                        print(f'Listen: camera, error')
-                        bundle.response = EResponse.ERROR
-                    else:
-                        print(f'Listen: camera, ok')
-
-                        def on_disconnected():
-                            self.camera_handler = None
-                            self.torch_toggle_button.setEnabled(False)
-                            self.rear_camera_capture_button.setEnabled(False)
-                            self.front_camera_capture_button.setEnabled(False)
-                            set_widget_background_color(self.camera_state_view,
-                                                        MainWindow.Theme.STATE_UNAVAILABLE.value)
-                            print('Camera disconnected')
-
-                        self.camera_handler = Interactor(client,
-                                                         MainWindow.handle_client_request,
-                                                         MainWindow.digest_response,
-                                                         on_disconnected)
-                        self.camera_handler.start()
-
-                        self.torch_toggle_button.setEnabled(True)
-                        self.rear_camera_capture_button.setEnabled(True)
-                        self.front_camera_capture_button.setEnabled(True)
-                        set_widget_background_color(self.camera_state_view,
-                                                    MainWindow.Theme.STATE_AVAILABLE.value)
-                        bundle.response = EResponse.OK
-                elif role == ERequest.DISPLAY:
-                    if self.display_handler is not None:
-                        print(f'Listen: display, error')
-                        bundle.response = EResponse.ERROR
-                    else:
-                        print(f'Listen: display, ok')
-
-                        def on_disconnected():
-                            self.display_handler = None
-                            self.display_camera_capture_button.setEnabled(False)
-                            self.send_image_to_display_button.setEnabled(False)
-                            set_widget_background_color(self.display_state_view,
-                                                        MainWindow.Theme.STATE_UNAVAILABLE.value)
-                            print('Display disconnected')
-
-                        self.display_handler = Interactor(client,
-                                                          MainWindow.handle_client_request,
-                                                          MainWindow.digest_response,
-                                                          on_disconnected)
-                        self.display_handler.start()
-
-                        self.display_camera_capture_button.setEnabled(True)
-                        set_widget_background_color(self.display_state_view,
-                                                    MainWindow.Theme.STATE_AVAILABLE.value)
-                        bundle.response = EResponse.OK
+            except OSError:
+                # the server socket was closed
+                break
+            print(f'Listen: accept, {address}')
+            handler = None
+            try:
+                data = recv_handshake(client, Interactor.HANDSHAKE_TIMEOUT)
+                if data is None or len(data) < 3:
+                    print(f'Listen: invalid handshake, {address}')
+                    client.close()
+                    continue
+                try:
+                    bundle = Bundle.from_bytes(data)
+                except ValueError as e:
+                    print(f'Listen: invalid handshake, {address}, {e}')
+                    client.close()
+                    continue
+                handshake = Handshake.from_bundle(bundle)
+
+                handler = Interactor(client,
+                                     MainWindow.handle_client_request,
+                                     MainWindow.digest_response,
+                                     None,
+                                     padding=handshake.padding,
+                                     streaming=handshake.streaming,
+                                     heartbeat=handshake.heartbeat,
+                                     codec=handshake.frame_codec)
+                handler.on_disconnected = partial(self.client_disconnected, handler)
+                # other threads can send requests to the handler as soon as it is registered, e.g. broadcasts,
+                # and they wait on its send lock so that the reply is the first frame the client receives
+                with handler.send_lock:
+                    bundle.response = self.accept_client(handshake, handler)
+                    # only clients which sent handshake fields expect a reply
+                    if handshake.negotiated:
+                        send_buffers(client, Interactor.frame(handshake.reply(bundle.response), handshake.padding))
+                if bundle.response == EResponse.OK:
+                    handler.start()
                 else:
-                    print(f'Listen: unknown')
-                    bundle.response = EResponse.ERROR
+                    client.close()
 
                 MainWindow.handle_client_request(bundle)
-            except OSError:
-                break
+            except OSError as e:
+                # e.g. the client reset right after its handshake; the listener goes on
+                print(f'Listen: {address} lost during the handshake, {e}')
+                if handler is not None:
+                    self.client_disconnected(handler)
+                    handler.abandon()
+                client.close()
 
     def closeEvent(self, e: QCloseEvent) -> None:
-        if self.camera_handler is not None:
-            self.camera_handler.interrupt()
-        if self.display_handler is not None:
-            self.display_handler.interrupt()
+        if self.scheduler is not None:
+            self.scheduler.interrupt()
+        for handler in self.devices.broadcast_handlers:
+            handler.interrupt()
         self.listener.interrupt()
-        self.server.close()
+        if isinstance(self.server, socket.socket):
+            # closing alone doesn't wake up a blocking accept on every platform
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server.close()
+        self.analysis.shutdown()
+        self.frames.close()
+        self.pictures.close()
 
         super(QMainWindow, self).closeEvent(e)
 
@@ -365,6 +637,7 @@ class MainWindow(QMainWindow):
     def digest_response(bundle: Bundle) -> None:
         """
         Handles response for host request.
+        It runs on a network thread, so every widget update goes through the dispatcher.
         :param: bundle: The bundle instance for the request.
         :return: None
         """
@@ -372,43 +645,27 @@ class MainWindow(QMainWindow):
         if window is None:
             return
 
-        print(f'ClientResp: {bundle}')
-        if bundle.request == ERequest.CAMERA_TAKE_PICTURE:
-            cam_id = window.capture_requests[bundle.request_id]
-            del window.capture_requests[bundle.request_id]
-
-            is_valid = True
-            if cam_id == 0:
-                show_image(window.rear_camera_view, bundle.args)
-            elif cam_id == 1:
-                show_image(window.front_camera_view, bundle.args)
-            else:
-                is_valid = False
-
-            if is_valid:
-                window.front_camera_capture_button.setEnabled(True)
-                window.rear_camera_capture_button.setEnabled(True)
-                img = Image.open(io.BytesIO(bundle.args))
-                img = np.array(img)
-                MainWindow.process_image(img)
+        if bundle.request == ERequest.CAMERA_TAKE_PICTURE or bundle.request == ERequest.DISPLAY_TAKE_PICTURE:
+            # captures are shown by capture_received and on_frame_group, which also see the failed ones
+            pass
         elif bundle.request == ERequest.CAMERA_TOGGLE_TORCH:
             print('Toggle OK')
-            window.torch_toggle_button.setEnabled(True)
-        elif bundle.request == ERequest.DISPLAY_TAKE_PICTURE:
-            show_image(window.display_camera_view, bundle.args)
-            img = Image.open(io.BytesIO(bundle.args))
-            img = np.array(img)
-            MainWindow.process_image(img)
-            window.display_camera_capture_button.setEnabled(True)
-        elif bundle.request == ERequest.DISPLAY_SHOW_PICTURE:
+            window.dispatcher.call(window.torch_toggle_button.setEnabled, True)
+        elif bundle.request == ERequest.DISPLAY_SHOW_PICTURE or bundle.request == ERequest.DISPLAY_SHOW_CACHED_PICTURE:
+            # a display which doesn't hold a cached picture gets it in full right after, so REJECT is not an error
             if bundle.response == EResponse.OK:
-                window.image_path_label.setText('Image displayed.')
+                window.dispatcher.call(window.image_path_label.setText, 'Image displayed.')
+                # the displayed picture is the pattern the scatter of later captures is measured against
+                picture = window.displaying_picture
+                if picture is not None and picture.digest != window.pattern_digest:
+                    window.pattern_digest = picture.digest
+                    window.analyzer.set_pattern(decode_image(materialize(picture.data)))
+                    window.analysis.update(window.analyzer)
                 window.image_path = ''
             elif bundle.response == EResponse.ERROR:
-                window.image_path_label.setText('Error occurred.')
+                window.dispatcher.call(window.image_path_label.setText, 'Error occurred.')
         else:
-            print('Unknown')
-        print()
+            METRICS.count('responses_unhandled', 1, None, bundle.request)
 
     @staticmethod
     def handle_client_request(bundle: Bundle) -> Bundle:
@@ -426,10 +683,39 @@ class MainWindow(QMainWindow):
         return bundle
 
     @staticmethod
-    def process_image(image: np.array) -> Any:
-        # TODO: process image
+    def process_image(image: np.ndarray, source: str = '') -> Optional[Future]:
+        """
+        Queue a decoded capture for analysis. The result is delivered to on_analysis_result.
+        :param image: The RGB frame.
+        :param source: Where the frame comes from, e.g. the name of its view.
+        :return: The future of the AnalysisResult, or None if the frame was dropped or there is no window.
+        """
+        window: MainWindow = MainWindow.instance
+        if window is None:
+            return None
+        return window.analysis.submit(image, source)
 
-        import PIL
-        img = PIL.Image.fromarray(image)
-        img.save('./img.jpeg')
-        pass
+    def on_analysis_result(self,
+                           source: Union[str, FrameGroup],
+                           result: Union[AnalysisResult, List[AnalysisResult]]) -> None:
+        """
+        Report the analysis of a frame or a frame group. It runs on a thread of the executor.
+        :param source: The name of the view of a frame, or the frame group.
+        :param result: The metrics of every ROI of the analyzer, or a list of them for a frame group.
+        :return: None
+        """
+        if isinstance(source, FrameGroup):
+            names = [f'group {source.step} {frame.capture.name}' for frame in source.received]
+            results = result
+            if METRICS.enabled:
+                for frame, frame_result in zip(source.received, results):
+                    METRICS.observe('analysis_seconds', frame_result.elapsed, frame.device_id, frame.capture.request)
+            for frame, frame_result in zip(source.received, results):
+                self.kinetics.update(frame.capture.name, frame_result, frame.timestamp)
+        else:
+            names, results = [source], [result]
+            METRICS.observe('analysis_seconds', result.elapsed)
+        for name, result in zip(names, results):
+            for roi in result.rois:
+                print(f'Analysis: {name} {roi.name}, mean {tuple(round(v, 1) for v in roi.mean)}, '
+                      f'percentiles {roi.percentiles}, transmittance {roi.transmittance}, scatter {roi.scatter}')
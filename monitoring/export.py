@@ -0,0 +1,102 @@
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+from typing import List
+
+from monitoring.metrics import METRICS, Metrics
+
+METRICS_PORT = 9464
+DUMP_PATH = 'metrics.json'
+DUMP_INTERVAL = 10.0
+
+
+class MetricsServer(Thread):
+    """
+    Serves metrics over HTTP: Prometheus text at /metrics and JSON at /metrics.json.
+    """
+    def __init__(self, port: int = METRICS_PORT, metrics: Metrics = METRICS, host: str = '0.0.0.0'):
+        super(MetricsServer, self).__init__(daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = metrics.json(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *_):
+                # a scrape every few seconds would flood the console
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+
+    def run(self) -> None:
+        self.server.serve_forever()
+
+    def interrupt(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsDumper(Thread):
+    """
+    Writes the metrics as JSON to a file every {interval} seconds.
+    The file is replaced at once, so that a reader never sees it half written.
+    """
+    def __init__(self, path: str = DUMP_PATH, interval: float = DUMP_INTERVAL, metrics: Metrics = METRICS):
+        super(MetricsDumper, self).__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.stop_event = Event()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def dump(self) -> None:
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                file.write(self.metrics.json())
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f'Metrics: failed to write {self.path}, {e}')
+
+    def interrupt(self) -> None:
+        self.stop_event.set()
+
+
+def export_from_args(argv: List[str]) -> List[Thread]:
+    """
+    Enable the metrics and start their exporters as asked on the command line:
+        --metrics[=port]        serve them over HTTP, see MetricsServer
+        --metrics-json[=path]   dump them to a file every DUMP_INTERVAL seconds
+    Without either, metrics stay disabled and cost next to nothing.
+    :param argv: The command line arguments.
+    :return: The started exporters.
+    """
+    exporters = []
+    for arg in argv:
+        name, _, value = arg.partition('=')
+        if name == '--metrics':
+            exporters.append(MetricsServer(int(value) if value else METRICS_PORT))
+            print(f'Metrics: serving on port {exporters[-1].server.server_port}')
+        elif name == '--metrics-json':
+            exporters.append(MetricsDumper(value or DUMP_PATH))
+            print(f'Metrics: dumping to {exporters[-1].path}')
+    if len(exporters) > 0:
+        METRICS.enabled = True
+    for exporter in exporters:
+        exporter.start()
+    return exporters
@@ -0,0 +1,257 @@
+import json
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from interaction.byte_enum import ERequest
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""The upper bounds in seconds of the buckets of every histogram."""
+
+PREFIX = 'solubility_host_'
+"""The prefix of every metric name in the Prometheus export."""
+
+Key = Tuple[str, str, str]
+"""A metric name with its device and request labels."""
+
+
+class Histogram:
+    """
+    Counts of observed durations in fixed buckets, from which percentiles are estimated.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """
+        :return: The upper bound of the bucket the {q} quantile falls in, or infinity past the last bucket.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return float('inf')
+
+
+class NullTimer:
+    """
+    The timer of disabled metrics, doing nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    """
+    Observes the duration of a with block.
+    """
+    def __init__(self, metrics: 'Metrics', key: Key):
+        self.metrics = metrics
+        self.key = key
+        self.started_at = 0.0
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.metrics.observe_key(self.key, time.perf_counter() - self.started_at)
+        return False
+
+
+class Metrics:
+    """
+    Duration histograms, counters and gauges of the host, each labelled with a device ID and a request type.
+    Every method returns right away while {enabled} is False;
+    hot paths check {enabled} themselves so that they don't even build the labels.
+
+    Durations recorded by the host:
+        request_seconds     round trip of a request, from sending it to its response or failure
+        receive_seconds     receiving a frame, from its length prefix to its last byte
+        decode_seconds      decoding a captured picture
+        analysis_seconds    analyzing a captured picture on a worker process
+        write_seconds       storing a captured picture, from queueing it to its append
+    Counters: bytes_received, bytes_sent, frames_received, frames_sent, frames_dropped, requests_failed,
+    responses_unhandled.
+    Gauges: requests_in_flight.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.histograms: Dict[Key, Histogram] = {}
+        self.counters: Dict[Key, float] = {}
+        self.gauges: Dict[Key, float] = {}
+
+    @staticmethod
+    def key(name: str, device_id: Optional[str], request: Optional[ERequest]) -> Key:
+        return name, device_id or '', request.name if request is not None else ''
+
+    def observe(self, name: str, value: float, device_id: Optional[str] = None, request: Optional[ERequest] = None):
+        """
+        Record a duration in seconds.
+        """
+        if self.enabled:
+            self.observe_key(Metrics.key(name, device_id, request), value)
+
+    def observe_key(self, key: Key, value: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def count(self, name: str, amount: float = 1, device_id: Optional[str] = None, request: Optional[ERequest] = None):
+        """
+        Add to a counter.
+        """
+        if self.enabled:
+            key = Metrics.key(name, device_id, request)
+            with self.lock:
+                self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name: str, delta: float, device_id: Optional[str] = None, request: Optional[ERequest] = None):
+        """
+        Move a gauge up or down.
+        """
+        if self.enabled:
+            key = Metrics.key(name, device_id, request)
+            with self.lock:
+                self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def timer(self, name: str, device_id: Optional[str] = None, request: Optional[ERequest] = None):
+        """
+        :return: A context manager recording the duration of its block.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, Metrics.key(name, device_id, request))
+
+    def track(self, future: Future, device_id: Optional[str], request: ERequest) -> None:
+        """
+        Count a request as in flight until {future} completes, then record its round trip.
+        :param future: The future of the response.
+        :param device_id: The device the request is sent to.
+        :param request: The type of the request.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        sent_at = time.perf_counter()
+        self.gauge('requests_in_flight', 1, device_id, request)
+
+        def on_done(_: Future) -> None:
+            self.observe('request_seconds', time.perf_counter() - sent_at, device_id, request)
+            self.gauge('requests_in_flight', -1, device_id, request)
+            if future.exception() is not None:
+                self.count('requests_failed', 1, device_id, request)
+
+        future.add_done_callback(on_done)
+
+    def received(self, device_id: Optional[str], request: Optional[ERequest], size: int, elapsed: float) -> None:
+        """
+        Record a received frame.
+        :param size: The size of the frame with its length prefix.
+        :param elapsed: Seconds from its length prefix to its last byte.
+        """
+        self.count('bytes_received', size, device_id, request)
+        self.count('frames_received', 1, device_id, request)
+        self.observe('receive_seconds', elapsed, device_id, request)
+
+    def sent(self, device_id: Optional[str], request: ERequest, size: int) -> None:
+        """
+        Record a sent frame.
+        :param size: The size of the frame with its length prefix and padding.
+        """
+        self.count('bytes_sent', size, device_id, request)
+        self.count('frames_sent', 1, device_id, request)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def snapshot(self) -> dict:
+        """
+        :return: Every metric as a JSON-serializable dict, with p50 and p99 estimates for the histograms.
+        """
+        def labels(key: Key) -> dict:
+            return {'name': key[0], 'device': key[1], 'request': key[2]}
+
+        def estimate(histogram: Histogram, q: float) -> Optional[float]:
+            # past the last bucket there is no finite estimate, which JSON can't carry anyway
+            value = histogram.percentile(q)
+            return value if value != float('inf') else None
+
+        with self.lock:
+            return {
+                'time': time.time(),
+                'histograms': [dict(labels(key), count=histogram.count, sum=histogram.sum,
+                                    p50=estimate(histogram, 0.5), p99=estimate(histogram, 0.99),
+                                    buckets=list(histogram.counts))
+                               for key, histogram in self.histograms.items()],
+                'counters': [dict(labels(key), value=value) for key, value in self.counters.items()],
+                'gauges': [dict(labels(key), value=value) for key, value in self.gauges.items()],
+            }
+
+    def json(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def prometheus(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format.
+        """
+        def labels(key: Key, bound=None) -> str:
+            text = f'device="{escape_label(key[1])}",request="{escape_label(key[2])}"'
+            if bound is not None:
+                text += f',le="{bound}"'
+            return '{' + text + '}'
+
+        lines = []
+        with self.lock:
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for key, histogram in self.histograms.items():
+                    if key[0] != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{PREFIX}{name}_bucket{labels(key, bound)} {cumulative}')
+                    lines.append(f'{PREFIX}{name}_sum{labels(key)} {histogram.sum}')
+                    lines.append(f'{PREFIX}{name}_count{labels(key)} {histogram.count}')
+            for kind, values, suffix in (('counter', self.counters, '_total'), ('gauge', self.gauges, '')):
+                for name in sorted({key[0] for key in values}):
+                    lines.append(f'# TYPE {PREFIX}{name}{suffix} {kind}')
+                    for key, value in values.items():
+                        if key[0] == name:
+                            lines.append(f'{PREFIX}{name}{suffix}{labels(key)} {value}')
+        return str.join('\n', lines) + '\n'
+
+
+def escape_label(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format, e.g. a device ID chosen by the client.
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = Metrics()
+"""The metrics of this host process, disabled until enabled on the command line."""
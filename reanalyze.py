@@ -0,0 +1,90 @@
+"""
+Analyze stored frames again, without the phones, e.g. after changing the ROIs or the parameters.
+
+    python reanalyze.py frames results.parquet --roi left=0,0,0.5,1 --roi right=0.5,0,0.5,1 --blank blank.jpg
+
+The source is a frame store or a directory of pictures. The results are written as a table with one row per
+frame and ROI, in the format of the extension of the output: .csv, .npz or .parquet (needs pyarrow).
+An interrupted run resumes from {output}.journal when the same command is run again.
+"""
+import argparse
+import os
+import sys
+
+from analysis.batch import BatchAnalysis, Journal, check_table_format, columns, list_frames, write_table
+from analysis.solubility import Roi, SolubilityAnalyzer, WHOLE_FRAME
+from imaging.pipeline import decode_image
+
+
+def parse_roi(text: str) -> Roi:
+    """
+    :param text: 'name=x,y,width,height' in coordinates relative to the frame size.
+    """
+    name, _, box = text.partition('=')
+    values = [float(v) for v in box.split(',')]
+    if len(name) == 0 or len(values) != 4:
+        raise argparse.ArgumentTypeError(f'{text} is not name=x,y,width,height')
+    return Roi(name, *values)
+
+
+def read_image(path: str):
+    with open(path, 'rb') as file:
+        return decode_image(file.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze stored frames again on every core.')
+    parser.add_argument('source', help='a frame store or a directory of pictures')
+    parser.add_argument('output', help='the results table, .csv, .npz or .parquet')
+    parser.add_argument('--roi', type=parse_roi, action='append', help='name=x,y,width,height, the whole frame by default')
+    parser.add_argument('--percentiles', default='5,50,95', help='the luminance percentiles, 5,50,95 by default')
+    parser.add_argument('--blank', help='a picture of the clear solvent, for transmittance and turbidity')
+    parser.add_argument('--pattern', help='the picture displayed behind the vials, for scatter')
+    parser.add_argument('--workers', type=int, default=None, help='analysis processes, one per CPU by default')
+    parser.add_argument('--chunk', type=int, default=32, help='frames per unit of work, 32 by default')
+    parser.add_argument('--restart', action='store_true', help='discard the journal of a former run')
+    args = parser.parse_args()
+
+    try:
+        check_table_format(args.output)
+    except ValueError as e:
+        print(f'Reanalysis: {e}')
+        sys.exit(1)
+
+    analyzer = SolubilityAnalyzer(args.roi or (WHOLE_FRAME,), [float(v) for v in args.percentiles.split(',')])
+    if args.blank is not None:
+        analyzer.set_blank(read_image(args.blank))
+    if args.pattern is not None:
+        analyzer.set_pattern(read_image(args.pattern))
+
+    tasks = list_frames(args.source)
+    print(f'Reanalysis: {len(tasks)} frames in {args.source}')
+
+    journal_path = args.output + '.journal'
+    if args.restart and os.path.exists(journal_path):
+        os.remove(journal_path)
+    # a journal is only resumed by the run it was written by
+    header = {'source': os.path.abspath(args.source), 'rois': analyzer.rois, 'percentiles': args.percentiles,
+              'blank': args.blank, 'pattern': args.pattern}
+    try:
+        journal = Journal(journal_path, header)
+    except ValueError as e:
+        print(f'Reanalysis: {e}')
+        sys.exit(1)
+
+    try:
+        finished = BatchAnalysis(analyzer, args.workers, args.chunk).run(tasks, journal)
+    finally:
+        journal.close()
+    if not finished:
+        sys.exit(130)
+
+    order = {task.key: index for index, task in enumerate(tasks)}
+    table = sorted(journal.rows, key=lambda row: order.get(row[0], len(order)))
+    write_table(args.output, columns(analyzer), table)
+    os.remove(journal_path)
+    print(f'Reanalysis: wrote {len(table)} rows to {args.output}, {len(journal.failures)} frames failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+An append-only store of captured frames.
+
+Frames are appended back to back to segment files of bounded size, so a long run makes a handful of files
+rather than one per frame, and nothing is ever overwritten. An index file holds a fixed-size record per frame:
+    timestamp (f64), segment (u32), offset (u64), length (u32), request (u8), request ID (u8), camera ID (u8),
+    device (u16, a line number of the device file)
+Writes are synced to disk in batches, and any frame is read back through a memory map of its segment.
+"""
+import mmap
+import os
+import struct
+import time
+from threading import RLock
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Sequence
+
+from interaction.byte_enum import ERequest
+from interaction.payload import Payload, materialize
+
+INDEX = struct.Struct('>dIQIBBBH')
+"""Codec of an index record."""
+NO_CAMERA = 0xFF
+NO_DEVICE = 0xFFFF
+
+
+class FrameRecord(NamedTuple):
+    timestamp: float
+    """Wall-clock time the frame was received at."""
+    segment: int
+    offset: int
+    length: int
+    request: ERequest
+    request_id: int
+    cam_id: Optional[int]
+    device_id: Optional[str]
+
+
+class FrameEntry(NamedTuple):
+    """A frame to append and what is known about it."""
+    data: Payload
+    device_id: Optional[str] = None
+    cam_id: Optional[int] = None
+    request_id: int = 0
+    request: ERequest = ERequest.NONE
+    timestamp: Optional[float] = None
+
+
+class FrameStore:
+    INDEX_FILE = 'index.bin'
+    DEVICE_FILE = 'devices.txt'
+    SEGMENT_SIZE = 1 << 30
+
+    def __init__(self,
+                 directory: str,
+                 segment_size: int = SEGMENT_SIZE,
+                 sync_every: float = 64,
+                 sync_interval: float = 5.0,
+                 read_only: bool = False):
+        """
+        Open the store in {directory}, creating it if needed. A torn tail left by a crash is cut off.
+        :param directory: The directory of the store.
+        :param segment_size: The size a segment may grow to before the next one is started.
+        :param sync_every: The number of frames appended between syncs, or math.inf to sync only when asked.
+        :param sync_interval: The seconds between syncs, checked as frames are appended, or math.inf.
+        :param read_only: Only read the frames, e.g. while another process appends to the store.
+            Nothing is created nor cut off, and append raises.
+        """
+        self.directory = directory
+        self.read_only = read_only
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        self.lock = RLock()
+        self.records: List[FrameRecord] = []
+        self.devices: List[str] = []
+        self.device_numbers: Dict[str, int] = {}
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self.load_devices()
+        self.load_index()
+
+        self.segment = self.records[-1].segment if len(self.records) > 0 else 0
+        if read_only:
+            return
+        self.segment_file = self.open_segment(self.segment)
+        # drop whatever was written past the last indexed frame
+        end = self.records[-1].offset + self.records[-1].length if len(self.records) > 0 else 0
+        self.segment_file.truncate(end)
+        self.segment_file.seek(end)
+        self.index_file: BinaryIO = open(os.path.join(directory, FrameStore.INDEX_FILE), 'ab')
+        self.device_file: BinaryIO = open(os.path.join(directory, FrameStore.DEVICE_FILE), 'ab')
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, number: int) -> FrameRecord:
+        return self.records[number]
+
+    def load_devices(self) -> None:
+        path = os.path.join(self.directory, FrameStore.DEVICE_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            for line in file.read().split(b'\n')[:-1]:
+                self.device_numbers[line.decode()] = len(self.devices)
+                self.devices.append(line.decode())
+
+    def load_index(self) -> None:
+        path = os.path.join(self.directory, FrameStore.INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            data = file.read()
+
+        sizes: Dict[int, int] = {}
+        for offset in range(0, len(data) - INDEX.size + 1, INDEX.size):
+            timestamp, segment, start, length, request, request_id, cam_id, device = INDEX.unpack_from(data, offset)
+            if segment not in sizes:
+                segment_path = self.segment_path(segment)
+                sizes[segment] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            if start + length > sizes[segment] or (device != NO_DEVICE and device >= len(self.devices)):
+                # the frame didn't reach the disk before a crash
+                break
+            self.records.append(FrameRecord(timestamp, segment, start, length,
+                                            ERequest.from_int(request), request_id,
+                                            cam_id if cam_id != NO_CAMERA else None,
+                                            self.devices[device] if device != NO_DEVICE else None))
+
+        if len(self.records) * INDEX.size != len(data) and not self.read_only:
+            with open(path, 'r+b') as file:
+                file.truncate(len(self.records) * INDEX.size)
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:06d}.seg')
+
+    def open_segment(self, segment: int) -> BinaryIO:
+        path = self.segment_path(segment)
+        return open(path, 'r+b' if os.path.exists(path) else 'w+b')
+
+    def device_number(self, device_id: Optional[str]) -> int:
+        if device_id is None:
+            return NO_DEVICE
+        number = self.device_numbers.get(device_id)
+        if number is None:
+            number = len(self.devices)
+            self.devices.append(device_id)
+            self.device_numbers[device_id] = number
+            self.device_file.write(device_id.encode() + b'\n')
+        return number
+
+    def append(self,
+               data: Payload,
+               device_id: Optional[str] = None,
+               cam_id: Optional[int] = None,
+               request_id: int = 0,
+               request: ERequest = ERequest.NONE,
+               timestamp: Optional[float] = None) -> int:
+        """
+        Append a frame. It is durable once the next batch is synced.
+        :param data: The encoded frame.
+        :param device_id: The device which captured it.
+        :param cam_id: The camera of the device which captured it.
+        :param request_id: The request ID of the capture.
+        :param request: The capture request.
+        :param timestamp: The wall-clock time it was received at, or None for now.
+        :return: The number of the frame in the store.
+        """
+        return self.append_many([FrameEntry(data, device_id, cam_id, request_id, request, timestamp)])[0]
+
+    def append_many(self, entries: Sequence[FrameEntry]) -> List[int]:
+        """
+        Append several frames with one index write.
+        :param entries: The frames and what is known about them, as the arguments of append.
+        :return: The numbers of the frames in the store.
+        """
+        if self.read_only:
+            raise ValueError(f'{self.directory} is opened read-only.')
+        now = time.time()
+        index = bytearray()
+        numbers = []
+        with self.lock:
+            for entry in entries:
+                data = materialize(entry.data)
+                timestamp = entry.timestamp if entry.timestamp is not None else now
+                offset = self.segment_file.tell()
+                if offset > 0 and offset + len(data) > self.segment_size:
+                    # the records so far must reach the index before their segment is left
+                    self.index_file.write(index)
+                    index.clear()
+                    self.rotate()
+                    offset = 0
+                self.segment_file.write(data)
+
+                device = self.device_number(entry.device_id)
+                cam_id = entry.cam_id if entry.cam_id is not None else NO_CAMERA
+                index += INDEX.pack(timestamp, self.segment, offset, len(data),
+                                    entry.request.int(), entry.request_id, cam_id, device)
+                self.records.append(FrameRecord(timestamp, self.segment, offset, len(data),
+                                                entry.request, entry.request_id, entry.cam_id, entry.device_id))
+                numbers.append(len(self.records) - 1)
+            self.index_file.write(index)
+
+            self.unsynced += len(numbers)
+            if self.unsynced >= self.sync_every or time.monotonic() - self.synced_at >= self.sync_interval:
+                self.sync()
+        return numbers
+
+    def rotate(self) -> None:
+        self.sync()
+        self.segment_file.close()
+        self.segment += 1
+        self.segment_file = self.open_segment(self.segment)
+
+    def sync(self) -> None:
+        """
+        Write the appended frames through to the disk. Segments are synced before the index,
+        so the index never refers to frames which aren't on the disk.
+        :return: None
+        """
+        with self.lock:
+            for file in (self.segment_file, self.device_file, self.index_file):
+                file.flush()
+                os.fsync(file.fileno())
+            self.unsynced = 0
+            self.synced_at = time.monotonic()
+
+    def frame(self, number: int) -> memoryview:
+        """
+        :param number: The number of a frame.
+        :return: A read-only view over the frame, mapped from its segment.
+        """
+        with self.lock:
+            record = self.records[number]
+            end = record.offset + record.length
+            mapped = self.maps.get(record.segment)
+            if mapped is None or len(mapped) < end:
+                if record.segment == self.segment and not self.read_only:
+                    self.segment_file.flush()
+                # the segment is mapped again once it grew past the former map
+                with open(self.segment_path(record.segment), 'rb') as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[record.segment] = mapped
+        return memoryview(mapped)[record.offset:end]
+
+    def close(self) -> None:
+        with self.lock:
+            if self.read_only:
+                self.maps.clear()
+                return
+            self.sync()
+            for file in (self.segment_file, self.device_file, self.index_file):
+                file.close()
+            self.maps.clear()
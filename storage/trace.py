@@ -0,0 +1,215 @@
+"""
+A binary trace of the bundles exchanged with the clients, for replaying a session without the phones.
+
+The file starts with {MAGIC}, followed by records of a kind (u8) and a body length (u32):
+    PAYLOAD         payload ID (u32), the payload bytes
+    CONNECTED       time (f64), connection (u16), device ID length (u8), device ID, the role bundle of the handshake
+    FRAME_RECORD    time (f64), direction (u8), connection (u16), request ID (u8), request (u8), response (u8),
+                    payload ID (u32, NO_PAYLOAD if empty)
+    DISCONNECTED    time (f64), connection (u16)
+Times are seconds on the monotonic clock since the trace was opened.
+A payload is written once, the first time it is seen, and later frames carrying the same bytes refer to it by ID.
+A torn tail left by a crash is ignored when reading.
+"""
+import atexit
+import hashlib
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Union
+
+from interaction.bundle import Bundle
+from interaction.byte_enum import ERequest, EResponse
+
+MAGIC = b'SMTRACE1'
+
+RECORD = struct.Struct('>BI')
+"""Codec of the head of every record: its kind and the length of its body."""
+PAYLOAD_ID = struct.Struct('>I')
+CONNECTION = struct.Struct('>dHB')
+FRAME = struct.Struct('>dBHBBBI')
+DISCONNECTION = struct.Struct('>dH')
+
+PAYLOAD = 1
+CONNECTED = 2
+FRAME_RECORD = 3
+DISCONNECTED = 4
+
+INBOUND = 0
+"""A frame received from a client."""
+OUTBOUND = 1
+"""A frame sent to a client."""
+
+NO_PAYLOAD = 0xFFFFFFFF
+
+DEFAULT_PATH = 'session.trace'
+
+
+class TraceConnection(NamedTuple):
+    time: float
+    device_id: str
+    bundle: Bundle
+    """The role bundle of the handshake."""
+
+
+class TraceFrame(NamedTuple):
+    time: float
+    direction: int
+    device_id: str
+    bundle: Bundle
+
+
+class TraceDisconnection(NamedTuple):
+    time: float
+    device_id: str
+
+
+TraceEvent = Union[TraceConnection, TraceFrame, TraceDisconnection]
+
+
+class TraceRecorder:
+    """
+    Records the bundles exchanged with every client. This is safe to call from any thread.
+    Records are buffered and flushed at most every {FLUSH_INTERVAL} seconds, so a crash loses only the last of them.
+    """
+    FLUSH_INTERVAL = 1.0
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path: str):
+        """
+        :param path: The trace file to create. An existing file is overwritten.
+        """
+        self.path = path
+        self.lock = Lock()
+        self.file: BinaryIO = open(path, 'wb', buffering=TraceRecorder.BUFFER_SIZE)
+        self.file.write(MAGIC)
+        self.started_at = time.monotonic()
+        self.flushed_at = self.started_at
+        self.payloads: Dict[bytes, int] = {}
+        self.connections: Dict[str, int] = {}
+        self.next_connection = 0
+
+    def connect(self, device_id: str, bundle: Bundle) -> None:
+        """
+        Record a registered client.
+        :param device_id: The device ID it is registered with.
+        :param bundle: The role bundle of its handshake.
+        """
+        name = device_id.encode('utf-8')[:255]
+        with self.lock:
+            connection = self.next_connection
+            self.next_connection = (connection + 1) & 0xFFFF
+            self.connections[device_id] = connection
+            self.write(CONNECTED, CONNECTION.pack(self.now(), connection, len(name)) + name + bundle.bytes())
+
+    def disconnect(self, device_id: str) -> None:
+        with self.lock:
+            connection = self.connections.pop(device_id, None)
+            if connection is not None:
+                self.write(DISCONNECTED, DISCONNECTION.pack(self.now(), connection))
+
+    def record(self, direction: int, device_id: Optional[str], bundle: Bundle) -> None:
+        """
+        Record a frame sent or received.
+        :param direction: INBOUND or OUTBOUND.
+        :param device_id: The device it is exchanged with. Frames of unregistered clients are not recorded.
+        :param bundle: The bundle of the frame.
+        """
+        args = bundle.view()
+        # hashing happens outside the lock, so that clients don't wait for each other
+        digest = hashlib.blake2b(args, digest_size=16).digest() if len(args) > 0 else None
+        with self.lock:
+            connection = self.connections.get(device_id)
+            if connection is None or self.file.closed:
+                return
+            payload = NO_PAYLOAD
+            if digest is not None:
+                payload = self.payloads.get(digest)
+                if payload is None:
+                    payload = self.payloads[digest] = len(self.payloads)
+                    self.file.write(RECORD.pack(PAYLOAD, PAYLOAD_ID.size + len(args)))
+                    self.file.write(PAYLOAD_ID.pack(payload))
+                    self.file.write(args)
+            self.write(FRAME_RECORD, FRAME.pack(self.now(), direction, connection, bundle.request_id,
+                                                bundle.request.int(), bundle.response.int(), payload))
+
+    def now(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def write(self, kind: int, body: bytes) -> None:
+        if self.file.closed:
+            return
+        self.file.write(RECORD.pack(kind, len(body)))
+        self.file.write(body)
+        now = time.monotonic()
+        if now - self.flushed_at >= TraceRecorder.FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed_at = now
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+def recorder_from_args(argv: List[str]) -> Optional[TraceRecorder]:
+    """
+    Start recording if asked on the command line with --record[=path]. The trace is closed at exit.
+    :param argv: The command line arguments.
+    :return: The recorder, or None.
+    """
+    for arg in argv:
+        name, _, value = arg.partition('=')
+        if name == '--record':
+            recorder = TraceRecorder(value or DEFAULT_PATH)
+            atexit.register(recorder.close)
+            print(f'Trace: recording to {recorder.path}')
+            return recorder
+    return None
+
+
+def read_trace(path: str) -> Iterator[TraceEvent]:
+    """
+    Read the events of a trace in order. Payloads are views over a memory map of the file, never copied.
+    :param path: The trace file.
+    :return: The events.
+    :raise ValueError: if the file is not a trace.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a trace.')
+        size = os.fstat(file.fileno()).st_size
+        if size == len(MAGIC):
+            return
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+
+    payloads: Dict[int, memoryview] = {}
+    devices: Dict[int, str] = {}
+    offset = len(MAGIC)
+    while offset + RECORD.size <= size:
+        kind, length = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        if offset + length > size:
+            # a torn tail
+            break
+        body = view[offset:offset + length]
+        offset += length
+
+        if kind == PAYLOAD:
+            payloads[PAYLOAD_ID.unpack_from(body)[0]] = body[PAYLOAD_ID.size:]
+        elif kind == FRAME_RECORD:
+            at, direction, connection, request_id, request, response, payload = FRAME.unpack_from(body)
+            args = payloads[payload] if payload != NO_PAYLOAD else b''
+            bundle = Bundle(request_id, ERequest.from_int(request), args, EResponse.from_int(response))
+            yield TraceFrame(at, direction, devices.get(connection, ''), bundle)
+        elif kind == CONNECTED:
+            at, connection, name_length = CONNECTION.unpack_from(body)
+            start = CONNECTION.size + name_length
+            devices[connection] = str(body[CONNECTION.size:start], 'utf-8')
+            yield TraceConnection(at, devices[connection], Bundle.from_bytes(body[start:]))
+        elif kind == DISCONNECTED:
+            at, connection = DISCONNECTION.unpack_from(body)
+            yield TraceDisconnection(at, devices.get(connection, ''))
@@ -0,0 +1,173 @@
+import math
+import queue
+import time
+from concurrent.futures import Future
+from threading import Thread
+from typing import List, Optional, Tuple
+
+from interaction.byte_enum import ERequest
+from interaction.payload import Payload
+from monitoring.metrics import METRICS
+from storage.frame_store import FrameEntry, FrameStore
+
+Item = Tuple[FrameEntry, Future, float]
+"""A queued frame with its future and the time it was submitted at."""
+
+
+class FrameWriter(Thread):
+    """
+    Appends frames to a FrameStore on a dedicated I/O thread, so that no receive thread waits for the disk.
+    Frames queued meanwhile are coalesced into one append per wake-up.
+    The queue is bounded: when storage falls behind, the oldest queued frame is dropped to make room,
+    so that submitting never blocks a receive thread. Its future fails with queue.Full.
+    """
+    BUFFERED = 0
+    """Sync only when flushed or closed, leaving the rest to the OS."""
+    BATCHED = 1
+    """Sync in the batches of the store."""
+    SYNCED = 2
+    """Sync every coalesced write before completing its futures."""
+
+    MAX_BATCH = 64
+    BACKLOG_WARNING = 0.75
+    """The fraction of the queue which, once filled, is reported as storage falling behind."""
+
+    def __init__(self, store: FrameStore, max_queue: int = 256, durability: int = BATCHED):
+        """
+        :param store: The store to write to. The writer owns it from then on.
+        :param max_queue: The number of frames which may wait to be written.
+        :param durability: BUFFERED, BATCHED or SYNCED. It overrides the sync policy of the store.
+        """
+        super(FrameWriter, self).__init__(daemon=True)
+        self.store = store
+        self.max_queue = max_queue
+        self.durability = durability
+        if durability != FrameWriter.BATCHED:
+            self.store.sync_every = math.inf
+            self.store.sync_interval = math.inf
+
+        self.queue: 'queue.Queue[Optional[Item]]' = queue.Queue(max_queue)
+        self.peak_depth = 0
+        self.dropped = 0
+        self.behind = False
+        self.start()
+
+    @property
+    def depth(self) -> int:
+        """The number of frames waiting to be written."""
+        return self.queue.qsize()
+
+    def submit(self,
+               data: Payload,
+               device_id: Optional[str] = None,
+               cam_id: Optional[int] = None,
+               request_id: int = 0,
+               request: ERequest = ERequest.NONE,
+               timestamp: Optional[float] = None) -> Future:
+        """
+        Queue a frame to append, with the arguments of FrameStore.append. This is safe to call from any thread.
+        {data} must stay valid until the future completes.
+        :return: The future of the number of the frame in the store.
+        """
+        future = Future()
+        entry = FrameEntry(data, device_id, cam_id, request_id, request, timestamp)
+        item = (entry, future, time.perf_counter())
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                if not self.drop_oldest():
+                    future.set_exception(RuntimeError('The frame writer is closed.'))
+                    return future
+
+        depth = self.queue.qsize()
+        self.peak_depth = max(self.peak_depth, depth)
+        if not self.behind and depth >= self.max_queue * FrameWriter.BACKLOG_WARNING:
+            self.behind = True
+            print(f'Frame writer: storage is falling behind, {depth} of {self.max_queue} frames queued')
+        return future
+
+    def drop_oldest(self) -> bool:
+        """
+        Drop the oldest queued frame and fail its future.
+        :return: False if the writer is closing, in which case nothing is dropped.
+        """
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            # the writer took the whole queue meanwhile
+            return True
+        self.queue.task_done()
+        if item is None:
+            # put back behind the frames still queued, if any room is left
+            self.queue.put(None)
+            return False
+        entry, future, _ = item
+        self.dropped += 1
+        if METRICS.enabled:
+            METRICS.count('frames_dropped', 1, entry.device_id, entry.request)
+        future.set_exception(queue.Full(f'Frame dropped, {self.max_queue} frames were queued.'))
+        return True
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            batch: List[Item] = []
+            closing = item is None
+            if not closing:
+                batch.append(item)
+            # coalesce whatever else is already waiting
+            while not closing and len(batch) < FrameWriter.MAX_BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                else:
+                    batch.append(item)
+
+            if len(batch) > 0:
+                self.write(batch)
+            for _ in range(len(batch) + closing):
+                self.queue.task_done()
+            if self.behind and self.queue.qsize() < self.max_queue // 2:
+                self.behind = False
+                print('Frame writer: caught up')
+            if closing:
+                break
+
+    def write(self, batch: List[Item]) -> None:
+        try:
+            numbers = self.store.append_many([entry for entry, _, _ in batch])
+            if self.durability == FrameWriter.SYNCED:
+                self.store.sync()
+        except Exception as e:
+            print(f'Frame writer: failed, {e}')
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        if METRICS.enabled:
+            written_at = time.perf_counter()
+            for entry, _, submitted_at in batch:
+                METRICS.observe('write_seconds', written_at - submitted_at, entry.device_id, entry.request)
+        for (_, future, _), number in zip(batch, numbers):
+            future.set_result(number)
+
+    def flush(self) -> None:
+        """
+        Wait until every queued frame is written and synced.
+        :return: None
+        """
+        self.queue.join()
+        self.store.sync()
+
+    def close(self) -> None:
+        """
+        Write the queued frames, stop the thread and close the store.
+        :return: None
+        """
+        self.queue.put(None)
+        self.join()
+        self.store.close()